@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+
+    def ready(self):
+        from . import caching, scenes  # noqa: F401 (scenes registers its signal receivers)
+        caching.connect_signals()
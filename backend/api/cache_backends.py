@@ -0,0 +1,413 @@
+"""
+Cache backends for HomeForge.
+
+SharedDatabaseCache
+    A cross-process cache that needs no external server. It stores entries in
+    a table of the main database, so every web worker and the MQTT listener see
+    the same values and the same invalidations. Compared to Django's stock
+    ``DatabaseCache`` it is tuned for our access patterns (small hot keys,
+    frequent generation bumps):
+
+    - writes are a single ``INSERT ... ON CONFLICT DO UPDATE`` instead of
+      ``SELECT COUNT(*)`` + ``SELECT`` + ``INSERT``/``UPDATE`` in a transaction
+    - expired rows are swept at most every ``SWEEP_INTERVAL`` seconds instead
+      of counting the table on every write
+    - ``incr`` locks the row between its read and its write, so concurrent
+      generation bumps from several processes are all counted
+    - on PostgreSQL the table is made ``UNLOGGED`` by ``setup_shared_cache``,
+      so cache writes skip the WAL (the table is emptied after a crash, which
+      is fine for a cache)
+
+Run ``python manage.py setup_shared_cache`` once to create the table and
+``python manage.py benchmark_cache`` to compare it with LocMemCache and
+FileBasedCache.
+
+TwoTierCache
+    A bounded per-process LRU with a short TTL in front of another cache alias
+    (normally the shared cache). Hot keys such as resource generations and the
+    approved catalog are served from process memory; invalidations are
+    broadcast through a generation counter stored in the shared tier, with
+    the keys each bump invalidated so other processes drop only those.
+"""
+import base64
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+from django.core.cache.backends.db import DatabaseCache
+from django.db import DatabaseError, connections, router, transaction
+from django.utils.timezone import now as tz_now
+
+
+class SharedDatabaseCache(DatabaseCache):
+    """
+    DatabaseCache with single-statement upserts and interval-based TTL sweeping.
+
+    OPTIONS:
+    - MAX_ENTRIES: row budget enforced by the sweeper (default 300, as in Django)
+    - CULL_FREQUENCY: fraction culled when over budget (default 3, as in Django)
+    - SWEEP_INTERVAL: seconds between expired-row sweeps per process (default 60)
+    """
+
+    # Vendors that support INSERT ... ON CONFLICT (...) DO UPDATE
+    UPSERT_VENDORS = ('postgresql', 'sqlite')
+
+    def __init__(self, table, params):
+        super().__init__(table, params)
+        options = params.get('OPTIONS', {})
+        self._sweep_interval = float(options.get('SWEEP_INTERVAL', 60))
+        self._next_sweep = 0.0
+
+    def _base_set(self, mode, key, value, timeout=DEFAULT_TIMEOUT):
+        db = router.db_for_write(self.cache_model_class)
+        connection = connections[db]
+        if mode == 'touch' or connection.vendor not in self.UPSERT_VENDORS:
+            return super()._base_set(mode, key, value, timeout)
+
+        self._maybe_sweep(db)
+
+        timeout = self.get_backend_timeout(timeout)
+        if timeout is None:
+            exp = datetime.max
+        else:
+            exp = datetime.fromtimestamp(timeout, tz=timezone.utc if settings.USE_TZ else None)
+        exp = connection.ops.adapt_datetimefield_value(exp.replace(microsecond=0))
+        b64encoded = base64.b64encode(pickle.dumps(value, self.pickle_protocol)).decode('latin1')
+
+        qn = connection.ops.quote_name
+        table = qn(self._table)
+        sql = (
+            f"INSERT INTO {table} ({qn('cache_key')}, {qn('value')}, {qn('expires')}) "
+            f"VALUES (%s, %s, %s) "
+            f"ON CONFLICT ({qn('cache_key')}) DO UPDATE "
+            f"SET {qn('value')} = EXCLUDED.{qn('value')}, {qn('expires')} = EXCLUDED.{qn('expires')}"
+        )
+        params = [key, b64encoded, exp]
+        if mode == 'add':
+            # add() may only replace an entry that has already expired
+            sql += f" WHERE {table}.{qn('expires')} < %s"
+            params.append(connection.ops.adapt_datetimefield_value(tz_now().replace(microsecond=0)))
+
+        try:
+            # Outside a transaction the statement is atomic on its own; inside
+            # one, a savepoint keeps a failed write from poisoning the caller.
+            if connection.in_atomic_block:
+                with transaction.atomic(using=db):
+                    return self._execute_write(connection, sql, params)
+            return self._execute_write(connection, sql, params)
+        except DatabaseError:
+            # To be threadsafe, updates/inserts are allowed to fail silently
+            return False
+
+    def incr(self, key, delta=1, version=None):
+        """
+        Increment a value with the row locked from the read to the write, so
+        generation bumps from several processes at once are never lost
+        (``BaseCache.incr`` is a plain get then set). Raises ValueError when
+        the key is missing or expired.
+        """
+        key = self.make_and_validate_key(key, version=version)
+        db = router.db_for_write(self.cache_model_class)
+        connection = connections[db]
+        qn = connection.ops.quote_name
+        table = qn(self._table)
+        now = connection.ops.adapt_datetimefield_value(tz_now().replace(microsecond=0))
+        with transaction.atomic(using=db), connection.cursor() as cursor:
+            # The no-op UPDATE takes the row lock (the write lock on SQLite)
+            # before the value is read; concurrent increments wait for it.
+            cursor.execute(
+                f"UPDATE {table} SET {qn('expires')} = {qn('expires')} "
+                f"WHERE {qn('cache_key')} = %s AND {qn('expires')} >= %s",
+                [key, now],
+            )
+            if cursor.rowcount == 0:
+                raise ValueError("Key '%s' not found." % key)
+            cursor.execute(f"SELECT {qn('value')} FROM {table} WHERE {qn('cache_key')} = %s", [key])
+            value = connection.ops.process_clob(cursor.fetchone()[0])
+            value = pickle.loads(base64.b64decode(value.encode())) + delta
+            cursor.execute(
+                f"UPDATE {table} SET {qn('value')} = %s WHERE {qn('cache_key')} = %s",
+                [base64.b64encode(pickle.dumps(value, self.pickle_protocol)).decode('latin1'), key],
+            )
+        return value
+
+    def _execute_write(self, connection, sql, params):
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.rowcount > 0
+
+    def _maybe_sweep(self, db):
+        now = time.monotonic()
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + self._sweep_interval
+        self.sweep(using=db)
+
+    def sweep(self, using=None):
+        """
+        Delete expired rows and cull the table down to MAX_ENTRIES.
+        Returns the number of expired rows removed.
+        """
+        db = using or router.db_for_write(self.cache_model_class)
+        connection = connections[db]
+        table = connection.ops.quote_name(self._table)
+        now = tz_now().replace(microsecond=0)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"DELETE FROM {table} WHERE {connection.ops.quote_name('expires')} < %s",
+                [connection.ops.adapt_datetimefield_value(now)],
+            )
+            removed = cursor.rowcount
+            cursor.execute(f"SELECT COUNT(*) FROM {table}")
+            num = cursor.fetchone()[0]
+            if num > self._max_entries:
+                self._cull(db, cursor, now, num)
+        return removed
+
+
+_MISSING = object()
+
+# Local tiers by cache LOCATION, shared across threads of a process
+_local_tiers = {}
+
+
+class _LocalTier:
+    def __init__(self):
+        self.entries = OrderedDict()  # key -> (expires_at, pickled value)
+        self.lock = threading.Lock()
+        self.generation = _MISSING  # not observed yet
+        self.next_generation_check = 0.0
+        self.stats = dict.fromkeys(
+            ('local_hits', 'local_misses', 'shared_hits', 'shared_misses', 'local_flushes'), 0
+        )
+
+
+class TwoTierCache(BaseCache):
+    """
+    Per-process LRU (tier 1) in front of a shared cache alias (tier 2).
+
+    Reads are served locally for up to LOCAL_TIMEOUT seconds. Writes go to the
+    shared tier and refresh the local copy. ``delete``, ``incr``/``decr`` and
+    ``clear`` also bump a generation counter in the shared tier and log the
+    keys they touched under the new generation; every process compares the
+    counter at most once per GENERATION_CHECK_INTERVAL and, when it moved,
+    drops the logged keys from its local tier (the whole tier after ``clear``,
+    or when the log is incomplete). Plain ``set()`` is not broadcast, so other
+    processes may serve the previous value for up to LOCAL_TIMEOUT (keys from
+    ``api.caching.CachedResource`` are never overwritten in place, only
+    orphaned by a generation bump, so they are unaffected).
+
+    OPTIONS:
+    - SHARED_ALIAS: CACHES alias of the shared tier (default 'shared')
+    - LOCAL_TIMEOUT: max seconds a value is served from process memory (default 5)
+    - LOCAL_MAX_ENTRIES: LRU bound of the local tier (default 1000)
+    - GENERATION_CHECK_INTERVAL: seconds between shared generation checks (default 1)
+    """
+
+    GENERATION_KEY = 'two-tier:generation'
+    INVALIDATION_LOG_KEY = 'two-tier:invalidated:%d'
+    # Seconds a logged invalidation is kept; a process further behind flushes its whole tier
+    INVALIDATION_LOG_TIMEOUT = 60
+    # Generations replayed key by key before a lagging process flushes its whole tier instead
+    INVALIDATION_LOG_REPLAY = 100
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get('OPTIONS', {})
+        self._shared_alias = options.get('SHARED_ALIAS', 'shared')
+        self._local_timeout = float(options.get('LOCAL_TIMEOUT', 5))
+        self._local_max_entries = int(options.get('LOCAL_MAX_ENTRIES', 1000))
+        self._generation_check_interval = float(options.get('GENERATION_CHECK_INTERVAL', 1))
+
+        # Shared by every thread of this process, like LocMemCache's storage
+        self._tier = _local_tiers.setdefault(location or 'default', _LocalTier())
+
+    @property
+    def shared(self):
+        return caches[self._shared_alias]
+
+    # ── Local tier ──
+
+    def _local_get(self, key):
+        now = time.monotonic()
+        with self._tier.lock:
+            entry = self._tier.entries.get(key)
+            if entry is None:
+                return _MISSING
+            expires_at, pickled = entry
+            if expires_at <= now:
+                del self._tier.entries[key]
+                return _MISSING
+            self._tier.entries.move_to_end(key)
+        return pickle.loads(pickled)
+
+    def _local_set(self, key, value, timeout=DEFAULT_TIMEOUT):
+        ttl = self._local_timeout
+        backend_timeout = self.get_backend_timeout(timeout)
+        if backend_timeout is not None:
+            ttl = min(ttl, backend_timeout - time.time())
+            if ttl <= 0:
+                self._local_delete(key)
+                return
+        pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        with self._tier.lock:
+            self._tier.entries[key] = (time.monotonic() + ttl, pickled)
+            self._tier.entries.move_to_end(key)
+            while len(self._tier.entries) > self._local_max_entries:
+                self._tier.entries.popitem(last=False)
+
+    def _local_delete(self, key):
+        with self._tier.lock:
+            self._tier.entries.pop(key, None)
+
+    def _flush_local(self):
+        with self._tier.lock:
+            self._tier.entries.clear()
+            self._tier.stats['local_flushes'] += 1
+
+    # ── Generation broadcast ──
+
+    def _sync_generation(self):
+        now = time.monotonic()
+        if now < self._tier.next_generation_check:
+            return
+        self._tier.next_generation_check = now + self._generation_check_interval
+        generation = self.shared.get(self.GENERATION_KEY)
+        if generation != self._tier.generation:
+            if self._tier.generation is not _MISSING:
+                self._replay_invalidations(self._tier.generation, generation)
+            self._tier.generation = generation
+
+    def _replay_invalidations(self, since, generation):
+        """Drop the keys invalidated after generation ``since``, or everything if the log can't tell."""
+        if not isinstance(since, int) or not isinstance(generation, int) \
+                or not 0 < generation - since <= self.INVALIDATION_LOG_REPLAY:
+            self._flush_local()
+            return
+        log_keys = [self.INVALIDATION_LOG_KEY % number for number in range(since + 1, generation + 1)]
+        logged = self.shared.get_many(log_keys)
+        if len(logged) != len(log_keys):
+            # Expired, or a clear(), which logs nothing
+            self._flush_local()
+            return
+        for keys in logged.values():
+            for key in keys:
+                self._local_delete(key)
+
+    def _broadcast_invalidation(self, keys=None):
+        """Bump the shared generation, logging ``keys`` (None for every key) under the new one."""
+        try:
+            generation = self.shared.incr(self.GENERATION_KEY)
+        except ValueError:
+            self._tier.generation = int(time.time() * 1000)
+            self.shared.set(self.GENERATION_KEY, self._tier.generation, None)
+            return
+        if keys is not None:
+            self.shared.set(self.INVALIDATION_LOG_KEY % generation, list(keys), self.INVALIDATION_LOG_TIMEOUT)
+        # Skip our own bump only; one from another process in between is replayed at the next check
+        if self._tier.generation == generation - 1:
+            self._tier.generation = generation
+
+    # ── Cache API ──
+
+    def get(self, key, default=None, version=None):
+        local_key = self.make_and_validate_key(key, version=version)
+        self._sync_generation()
+        value = self._local_get(local_key)
+        if value is not _MISSING:
+            self._tier.stats['local_hits'] += 1
+            return value
+        self._tier.stats['local_misses'] += 1
+
+        value = self.shared.get(key, _MISSING, version=version)
+        if value is _MISSING:
+            self._tier.stats['shared_misses'] += 1
+            return default
+        self._tier.stats['shared_hits'] += 1
+        self._local_set(local_key, value)
+        return value
+
+    def get_many(self, keys, version=None):
+        self._sync_generation()
+        found = {}
+        missing = []
+        for key in keys:
+            value = self._local_get(self.make_and_validate_key(key, version=version))
+            if value is _MISSING:
+                missing.append(key)
+            else:
+                found[key] = value
+        self._tier.stats['local_hits'] += len(found)
+        self._tier.stats['local_misses'] += len(missing)
+        if missing:
+            fetched = self.shared.get_many(missing, version=version)
+            self._tier.stats['shared_hits'] += len(fetched)
+            self._tier.stats['shared_misses'] += len(missing) - len(fetched)
+            for key, value in fetched.items():
+                self._local_set(self.make_and_validate_key(key, version=version), value)
+            found.update(fetched)
+        return found
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self.shared.set(key, value, timeout, version=version)
+        self._local_set(self.make_and_validate_key(key, version=version), value, timeout)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        added = self.shared.add(key, value, timeout, version=version)
+        if added:
+            self._local_set(self.make_and_validate_key(key, version=version), value, timeout)
+        return added
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        return self.shared.touch(key, timeout, version=version)
+
+    def delete(self, key, version=None):
+        local_key = self.make_and_validate_key(key, version=version)
+        self._local_delete(local_key)
+        deleted = self.shared.delete(key, version=version)
+        self._broadcast_invalidation([local_key])
+        return deleted
+
+    def delete_many(self, keys, version=None):
+        local_keys = [self.make_and_validate_key(key, version=version) for key in keys]
+        for local_key in local_keys:
+            self._local_delete(local_key)
+        self.shared.delete_many(keys, version=version)
+        self._broadcast_invalidation(local_keys)
+
+    def has_key(self, key, version=None):
+        self._sync_generation()
+        if self._local_get(self.make_and_validate_key(key, version=version)) is not _MISSING:
+            return True
+        return self.shared.has_key(key, version=version)
+
+    def incr(self, key, delta=1, version=None):
+        value = self.shared.incr(key, delta, version=version)
+        local_key = self.make_and_validate_key(key, version=version)
+        self._local_set(local_key, value)
+        self._broadcast_invalidation([local_key])
+        return value
+
+    def clear(self):
+        self.shared.clear()
+        self._flush_local()
+        self._broadcast_invalidation()
+
+    def close(self, **kwargs):
+        self.shared.close(**kwargs)
+
+    def get_stats(self):
+        """Hit/miss counters and hit ratios per tier for this process."""
+        stats = dict(self._tier.stats)
+        local_total = stats['local_hits'] + stats['local_misses']
+        shared_total = stats['shared_hits'] + stats['shared_misses']
+        stats['local_hit_ratio'] = round(stats['local_hits'] / local_total, 4) if local_total else None
+        stats['shared_hit_ratio'] = round(stats['shared_hits'] / shared_total, 4) if shared_total else None
+        stats['local_entries'] = len(self._tier.entries)
+        stats['local_max_entries'] = self._local_max_entries
+        return stats
@@ -0,0 +1,273 @@
+"""
+Declarative, signal-driven caching for API resources.
+
+A ``CachedResource`` names a piece of cached data, the models it is derived
+from and how long it may live. Every key built for a resource embeds the
+resource's current *generation*; saving or deleting any model the resource
+depends on bumps that generation, which orphans all previously cached keys at
+once (they simply expire). Views never delete cache keys by hand.
+
+Usage::
+
+    approved_ids = approved_device_types.get_or_set(
+        lambda: list(CustomDeviceType.objects.filter(approved=True).values_list('id', flat=True))
+    )
+
+Declare new resources at the bottom of this module (or next to the code that
+owns them) and they are wired to ``post_save``/``post_delete``/``m2m_changed``
+automatically: by ``ApiConfig.ready`` for resources declared at import time,
+on creation for resources declared after it.
+
+Bulk ``QuerySet.update()`` calls and custom signals do not go through the
+model signals, so code performing them should call ``invalidate()`` (or list
+the custom signal in ``signals=``).
+
+The default cache is per process. A resource invalidated or read by the MQTT
+listener, which runs in a process of its own, is declared with
+``shared=True``: its generation lives in a database row
+(api/shared_state.py) instead of the cache, at the cost of one primary-key
+query per generation read. Values are still cached per process, under keys
+that embed the shared generation.
+"""
+import logging
+import time
+
+from django.apps import apps
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete, m2m_changed
+
+from . import shared_state
+from .signals import controls_changed, device_status_changed
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+_registry = {}
+_signals_connected = False
+
+
+class CachedResource:
+    """
+    A named cached resource with model dependencies.
+
+    - name: unique resource name, used as the cache key prefix
+    - depends_on: model labels ('api.Device') whose changes invalidate the resource
+    - timeout: TTL in seconds for cached values
+    - volatile_fields: fields whose ``save(update_fields=[...])`` should NOT invalidate
+      (e.g. telemetry columns that the resource does not render)
+    - signals: extra ``django.dispatch.Signal`` instances that invalidate the resource
+    - shared: keep the generation in the database so every process sees invalidations
+    """
+
+    def __init__(self, name, depends_on=(), timeout=300, volatile_fields=(), signals=(), shared=False):
+        if name in _registry:
+            raise ValueError(f"Cached resource '{name}' is already registered.")
+        self.name = name
+        self.depends_on = tuple(depends_on)
+        self.timeout = timeout
+        self.volatile_fields = frozenset(volatile_fields)
+        self.signals = tuple(signals)
+        self.shared = shared
+        _registry[name] = self
+        if _signals_connected:
+            # Declared after ApiConfig.ready(): connect_signals() has already run
+            _connect(self)
+
+    def __repr__(self):
+        return f"CachedResource({self.name!r})"
+
+    @property
+    def generation_key(self):
+        return f"res:{self.name}:gen"
+
+    def generation(self):
+        """Return the current generation, seeding it if the cache lost it."""
+        if self.shared:
+            return shared_state.generation(self.name)
+        gen = cache.get(self.generation_key)
+        if gen is None:
+            # Seed from the clock so a generation that was evicted never
+            # comes back with a value whose keys may still be cached.
+            cache.add(self.generation_key, int(time.time() * 1000), timeout=None)
+            gen = cache.get(self.generation_key)
+        return gen
+
+    def make_key(self, *parts):
+        suffix = ':'.join(str(p) for p in parts) or '_'
+        return f"res:{self.name}:{self.generation()}:{suffix}"
+
+    def get(self, *parts, default=None):
+        return cache.get(self.make_key(*parts), default)
+
+    def set(self, value, *parts):
+        cache.set(self.make_key(*parts), value, self.timeout)
+
+    def get_or_set(self, builder, *parts):
+        """Return the cached value for ``parts``, building and storing it on a miss."""
+        key = self.make_key(*parts)
+        value = cache.get(key, _MISSING)
+        if value is _MISSING:
+            value = builder()
+            cache.set(key, value, self.timeout)
+        return value
+
+    def invalidate(self):
+        """Bump the generation so every key of this resource becomes unreachable."""
+        if self.shared:
+            shared_state.bump(self.name)
+            return
+        try:
+            cache.incr(self.generation_key)
+        except ValueError:
+            # Generation was never seeded or has been evicted
+            cache.set(self.generation_key, int(time.time() * 1000), timeout=None)
+
+
+def get_resource(name):
+    return _registry[name]
+
+
+def invalidate(*names):
+    """Invalidate the named resources (all resources when called without names)."""
+    _invalidate([_registry[n] for n in names] if names else _registry.values())
+
+
+def _invalidate(resources):
+    """Invalidate ``resources``, bumping the shared generations among them in one UPDATE."""
+    shared = []
+    for resource in resources:
+        if resource.shared:
+            shared.append(resource.name)
+        else:
+            resource.invalidate()
+    shared_state.bump(*shared)
+
+
+# ── Signal wiring ──
+
+def _resources_for(model):
+    label = model._meta.label
+    return [r for r in _registry.values() if label in r.depends_on]
+
+
+def _on_save(sender, instance, update_fields=None, **kwargs):
+    _invalidate([
+        resource for resource in _resources_for(sender)
+        if not (update_fields and resource.volatile_fields.issuperset(update_fields))
+    ])
+
+
+def _on_delete(sender, instance, **kwargs):
+    _invalidate(_resources_for(sender))
+
+
+def _on_m2m_changed(sender, instance, action, model=None, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    # The relation may be changed from either side
+    affected = set(_resources_for(type(instance)))
+    if model is not None:
+        affected.update(_resources_for(model))
+    _invalidate(affected)
+
+
+def _connect(resource):
+    """Connect the receivers a resource needs. Safe to repeat (dispatch_uid)."""
+    for signal in resource.signals:
+        signal.connect(
+            lambda sender=None, _resource=resource, **kwargs: _resource.invalidate(),
+            weak=False,
+            dispatch_uid=f'caching:{resource.name}:{id(signal)}',
+        )
+    for label in resource.depends_on:
+        model = apps.get_model(label)
+        uid = f'caching:{model._meta.label}'
+        post_save.connect(_on_save, sender=model, dispatch_uid=f'{uid}:save')
+        post_delete.connect(_on_delete, sender=model, dispatch_uid=f'{uid}:delete')
+        for field in model._meta.many_to_many:
+            m2m_changed.connect(
+                _on_m2m_changed,
+                sender=field.remote_field.through,
+                dispatch_uid=f'{uid}:m2m:{field.name}',
+            )
+
+
+def connect_signals():
+    """
+    Connect model signals for every registered resource. Called from
+    ApiConfig.ready(); resources declared afterwards connect themselves.
+    """
+    global _signals_connected
+    for resource in _registry.values():
+        _connect(resource)
+    _signals_connected = True
+    logger.debug("Cache invalidation wired for %d resource(s)", len(_registry))
+
+
+# ── Resources ──
+
+# IDs of approved device types served to non-admin users
+approved_device_types = CachedResource(
+    'approved_device_types',
+    depends_on=['api.CustomDeviceType'],
+    timeout=300,
+)
+
+# Static part of the network topology graph (positions, labels, binding style).
+# Heartbeats only touch status/current_state/updated_at, which the overlay in
+# api/topology.py applies per request. The MQTT listener binds MAC addresses,
+# which the layout shows, so the generation is shared.
+topology_layout = CachedResource(
+    'topology_layout',
+    depends_on=['api.Device', 'api.Room', 'api.CustomDeviceType'],
+    timeout=3600,
+    volatile_fields=['status', 'current_state', 'desired_state', 'updated_at'],
+    shared=True,
+)
+
+# Device counts and sensor averages for /api/summary/ (api/home_summary.py).
+# Status transitions arrive via device_status_changed, which the MQTT listener
+# sends from its own process, hence the shared generation; sensor readings are
+# allowed to be one timeout old.
+home_summary = CachedResource(
+    'home_summary',
+    depends_on=['api.Device', 'api.Room', 'api.CustomDeviceType'],
+    timeout=60,
+    volatile_fields=['status', 'current_state', 'desired_state', 'updated_at'],
+    signals=[device_status_changed, controls_changed],
+    shared=True,
+)
+
+# Widget type and variable_mapping of each device type's controls, used by the
+# MQTT listener to remap firmware keys (api/device_state.py), so the
+# generation is shared: control edits made through the API must reach it.
+# Those edits go through control_sync's bulk operations, hence the
+# controls_changed signal. DeviceControl itself is not a dependency: a
+# post_delete receiver would stop Django from fast-deleting controls in bulk.
+device_type_controls = CachedResource(
+    'device_type_controls',
+    depends_on=['api.DeviceCardTemplate'],
+    timeout=300,
+    signals=[controls_changed],
+    shared=True,
+)
+
+# Nothing is cached under this resource: its generation tells the MQTT
+# listener to reload its automation rules (api/rules.py), so it is shared
+# through the database. Devices matter for their MAC (rule actions are
+# compiled with it); scene plans are rewritten with update(), so
+# api/scenes.py invalidates it when it compiles one.
+automation_rules = CachedResource(
+    'automation_rules',
+    depends_on=['api.AutomationRule', 'api.Device', 'api.Scene'],
+    volatile_fields=['status', 'current_state', 'desired_state', 'updated_at'],
+    shared=True,
+)
+
+# Same for the schedules run by the MQTT listener (api/scheduler.py)
+device_schedules = CachedResource(
+    'device_schedules',
+    depends_on=['api.Schedule', 'api.Device', 'api.Scene'],
+    volatile_fields=['status', 'current_state', 'desired_state', 'updated_at'],
+    shared=True,
+)
@@ -0,0 +1,148 @@
+"""
+Coalescing rapid device commands before they are published.
+
+Dragging a slider sends a ``PATCH /api/devices/{id}/state/`` per step. The
+coalescer throttles commands per device: the first command of a burst is
+published at once, and commands arriving within the device's window after a
+publish are merged into one pending payload (latest value wins per key) that
+is published when the window ends. A continuous drag therefore reaches the
+firmware at most once per window, always ending on the last value.
+
+The window depends on the widgets the payload's keys belong to
+(``settings.MQTT_COALESCE_WINDOWS``, milliseconds per widget type); the
+longest one applies. Keys with no window (buttons, unknown keys) are
+published immediately, after any pending payload for the device, so command
+order is kept.
+
+Windows and counters are per process. With several web workers, the commands
+of one burst that land on different workers are throttled separately (the
+device may get one command per window from each of them), and ``stats()``
+only counts the commands of the worker that answers
+``/api/admin/mqtt-stats/``.
+"""
+import collections
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+
+from .device_state import map_standard_key, type_controls
+from .mqtt_client import mqtt_client
+
+logger = logging.getLogger(__name__)
+
+
+def command_window(device_type_id, payload):
+    """Coalescing window in seconds for a command to a device of this type."""
+    windows = getattr(settings, 'MQTT_COALESCE_WINDOWS', {})
+    if not windows or device_type_id is None:
+        return 0
+    controls = type_controls(device_type_id)
+    widget_for = {mapping: widget_type for widget_type, mapping in controls}
+    window = 0
+    for key in payload:
+        mapping = key if key in widget_for else map_standard_key(controls, key)
+        window = max(window, windows.get(widget_for.get(mapping), 0))
+    return window / 1000
+
+
+class _Pending:
+    __slots__ = ('last_sent', 'payload', 'commands', 'timer')
+
+    def __init__(self):
+        self.last_sent = None
+        self.payload = None
+        self.commands = 0
+        self.timer = None
+
+
+class CommandCoalescer:
+    """Per-device command throttling in front of a publisher (``mqtt_client``)."""
+
+    def __init__(self, publisher=mqtt_client):
+        self.publisher = publisher
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _after_fork(self):
+        # Pending payloads and their timers belong to the parent process
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._devices = {}
+        self._counters = collections.Counter()
+
+    def submit(self, device_id, payload, window=0):
+        """Publish ``payload`` to a device now or merge it into its pending command."""
+        self.submit_many([(device_id, payload, window)])
+
+    def submit_many(self, commands):
+        """``submit()`` each ``(device_id, payload, window)``; the ones due now are published together."""
+        now = time.monotonic()
+        sends = []
+        with self._lock:
+            for device_id, payload, window in commands:
+                self._counters['submitted'] += 1
+                entry = self._devices.setdefault(device_id, _Pending())
+                if entry.payload is not None:
+                    entry.payload.update(payload)
+                    entry.commands += 1
+                    if window <= 0:
+                        # No window for this command: send what is pending now, in order
+                        sends.append((device_id, *self._take(entry, now)))
+                elif window > 0 and entry.last_sent is not None and now - entry.last_sent < window:
+                    entry.payload = dict(payload)
+                    entry.commands = 1
+                    entry.timer = threading.Timer(entry.last_sent + window - now, self.flush, args=(device_id,))
+                    entry.timer.daemon = True
+                    entry.timer.start()
+                else:
+                    entry.last_sent = now
+                    sends.append((device_id, dict(payload), 1))
+        self._publish(sends)
+
+    def flush(self, device_id):
+        """Publish the device's pending payload, if any (called when its window ends)."""
+        with self._lock:
+            entry = self._devices.get(device_id)
+            if entry is None or entry.payload is None:
+                return
+            send = self._take(entry, time.monotonic())
+        self._publish([(device_id, *send)])
+
+    def _take(self, entry, now):
+        """Detach the pending payload. Called with the lock held."""
+        if entry.timer is not None:
+            entry.timer.cancel()
+        send = (entry.payload, entry.commands)
+        entry.payload, entry.commands, entry.timer = None, 0, None
+        entry.last_sent = now
+        return send
+
+    def _publish(self, sends):
+        if not sends:
+            return
+        with self._lock:
+            for device_id, payload, commands in sends:
+                self._counters['published'] += 1
+                self._counters['merged'] += commands - 1
+        for device_id, payload, commands in sends:
+            if commands > 1:
+                logger.info(f"Coalesced {commands} commands for {device_id}")
+        self.publisher.publish_many([(device_id, payload) for device_id, payload, _ in sends])
+
+    def stats(self):
+        with self._lock:
+            return {
+                **{key: self._counters[key] for key in ('submitted', 'published', 'merged')},
+                "pending": sum(1 for entry in self._devices.values() if entry.payload is not None),
+            }
+
+
+command_coalescer = CommandCoalescer()
+if hasattr(os, 'register_at_fork'):
+    # Once, for the process-wide instance: a hook per instance would never be released
+    os.register_at_fork(after_in_child=command_coalescer._after_fork)
@@ -0,0 +1,87 @@
+"""
+Persistent command queues for offline devices.
+
+A command to a device that is not online would be published into the void:
+the firmware connects with a clean session, so the broker does not keep
+messages for it. With ``MQTT_OFFLINE_DELIVERY = 'queue'`` (the default) such
+commands are stored as ``QueuedCommand`` rows that expire after
+``COMMAND_QUEUE_TTL`` seconds. When the MQTT listener sees the device come
+back online it takes the unexpired rows (``take_queued``), merges them in
+order (latest value per key wins) and publishes one payload.
+
+With ``MQTT_OFFLINE_DELIVERY = 'session'`` commands are always published
+at QoS 1 (``api.mqtt_client.command_qos``) and the broker holds them for devices that connect with a persistent
+session (``cleanSession=false`` and a QoS 1 subscription in the firmware).
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Count, Max, Min
+from django.utils import timezone
+
+from .models import QueuedCommand
+
+DELIVERY_QUEUE = 'queue'
+DELIVERY_SESSION = 'session'
+
+
+def queues_offline_commands():
+    return getattr(settings, 'MQTT_OFFLINE_DELIVERY', DELIVERY_QUEUE) == DELIVERY_QUEUE
+
+
+def enqueue(commands):
+    """Queue ``[(device_id, payload)]`` in one INSERT."""
+    expires_at = timezone.now() + timedelta(seconds=getattr(settings, 'COMMAND_QUEUE_TTL', 300))
+    QueuedCommand.objects.bulk_create([
+        QueuedCommand(device_id=device_id, payload=payload, expires_at=expires_at) for device_id, payload in commands
+    ])
+
+
+def take_queued(device_id):
+    """
+    Remove a device's queued commands and return ``(merged payload, count)``
+    of the unexpired ones. Commands queued meanwhile stay for the next flush.
+    """
+    rows = list(
+        QueuedCommand.objects.filter(device_id=device_id).order_by('id').values_list('id', 'payload', 'expires_at')
+    )
+    if not rows:
+        return {}, 0
+    QueuedCommand.objects.filter(device_id=device_id, id__lte=rows[-1][0]).delete()
+    now = timezone.now()
+    merged = {}
+    count = 0
+    for _, payload, expires_at in rows:
+        if expires_at > now:
+            merged.update(payload)
+            count += 1
+    return merged, count
+
+
+def purge_expired():
+    """Delete expired commands of devices that stayed offline. Returns the row count."""
+    deleted, _ = QueuedCommand.objects.filter(expires_at__lte=timezone.now()).delete()
+    return deleted
+
+
+def queue_depths():
+    """Unexpired queued commands per device, deepest first, from one grouped query."""
+    rows = (
+        QueuedCommand.objects
+        .filter(expires_at__gt=timezone.now())
+        .order_by()
+        .values('device', 'device__name', 'device__status')
+        .annotate(depth=Count('id'), oldest=Min('created_at'), expires_at=Max('expires_at'))
+        .order_by('-depth', 'device')
+    )
+    return [
+        {
+            "device": row['device'],
+            "name": row['device__name'],
+            "status": row['device__status'],
+            "depth": row['depth'],
+            "oldest": row['oldest'],
+            "expires_at": row['expires_at'],
+        }
+        for row in rows
+    ]
@@ -0,0 +1,197 @@
+"""
+Matching published device commands with the state reports that confirm them.
+
+Every command published by ``api.mqtt_client`` carries a correlation ID under
+``_cid`` (the firmware ignores keys it does not know). The MQTT listener
+subscribes to the command topics as well as the state topics, so it sees each
+command as the broker delivers it and keeps it in a ``CommandTracker`` until:
+
+- a state report from the same device confirms it: the report echoes the
+  ``_cid``, or (current firmware) every commanded key the report contains has
+  the commanded value, with at least one key in common
+- a newer command to the same device sets the same keys (superseded)
+- ``COMMAND_ACK_TIMEOUT`` seconds pass (timed out: counted as a failure)
+
+The tracker is bounded (``COMMAND_TRACKING_MAX_PENDING``; the oldest command
+is evicted uncounted). Confirmation latencies go into a fixed-bucket
+histogram; the listener publishes ``snapshot()`` as a ``SharedState`` row
+(api/shared_state.py) for ``GET /api/admin/command-metrics/``.
+"""
+import collections
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.utils import timezone
+
+CID_KEY = '_cid'
+# SharedState row of the listener's metrics snapshot, and the age past which the API ignores it
+METRICS_STATE = 'command_metrics'
+METRICS_MAX_AGE = 120
+# Upper bounds (ms) of the latency histogram buckets; the last bucket is open
+LATENCY_BUCKETS_MS = (50, 100, 250, 500, 1000, 2500, 5000, 10000)
+TRUTHY = {'true', 'on', '1'}
+FALSY = {'false', 'off', '0'}
+
+
+def new_cid():
+    return uuid.uuid4().hex[:12]
+
+
+def normalize_value(value):
+    """Compare "on"/"off"-style strings like the firmware does (as booleans)."""
+    if isinstance(value, str):
+        lowered = value.lower()
+        if lowered in TRUTHY:
+            return True
+        if lowered in FALSY:
+            return False
+    return value
+
+
+def _matches(values, report):
+    common = values.keys() & report.keys()
+    return bool(common) and all(normalize_value(values[key]) == normalize_value(report[key]) for key in common)
+
+
+class LatencyHistogram:
+    def __init__(self, bounds=LATENCY_BUCKETS_MS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, ms):
+        index = next((i for i, bound in enumerate(self.bounds) if ms <= bound), len(self.bounds))
+        self.counts[index] += 1
+        self.count += 1
+        self.total += ms
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-quantile (None when empty or open-ended)."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total / self.count, 1) if self.count else None,
+            "p50_ms": self.quantile(0.5),
+            "p95_ms": self.quantile(0.95),
+            "buckets": [
+                {"le_ms": bound, "count": count}
+                for bound, count in zip((*self.bounds, None), self.counts)
+            ],
+        }
+
+
+class _Command:
+    __slots__ = ('cid', 'device', 'values', 'sent_at')
+
+    def __init__(self, cid, device, values, sent_at):
+        self.cid = cid
+        self.device = device
+        self.values = values
+        self.sent_at = sent_at
+
+
+class CommandTracker:
+    """Pending commands and confirmation metrics of the listener process."""
+
+    def __init__(self, timeout=None, max_pending=None, clock=time.monotonic):
+        self.timeout = timeout if timeout is not None else getattr(settings, 'COMMAND_ACK_TIMEOUT', 10)
+        self.max_pending = max_pending or getattr(settings, 'COMMAND_TRACKING_MAX_PENDING', 1000)
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._pending = collections.OrderedDict()  # cid -> _Command, oldest first
+        self._by_device = collections.defaultdict(dict)  # device -> {cid: _Command}
+        self._histogram = LatencyHistogram()
+        self._devices = collections.defaultdict(collections.Counter)
+        self._device_latency = collections.Counter()  # device -> summed ms of confirmed commands
+
+    def track(self, device, payload):
+        """Start tracking a command seen on ``homeforge/devices/{device}/command``."""
+        cid = payload.get(CID_KEY)
+        if not cid:
+            return
+        values = {key: value for key, value in payload.items() if key != CID_KEY}
+        with self._lock:
+            for pending in list(self._by_device[device].values()):
+                if pending.values.keys() <= values.keys():
+                    self._remove(pending)
+                    self._devices[device]['superseded'] += 1
+            command = _Command(cid, device, values, self.clock())
+            self._pending[cid] = command
+            self._by_device[device][cid] = command
+            self._devices[device]['sent'] += 1
+            while len(self._pending) > self.max_pending:
+                evicted = next(iter(self._pending.values()))
+                self._remove(evicted)
+                self._devices[evicted.device]['evicted'] += 1
+
+    def _remove(self, command):
+        """Stop tracking a command. Called with the lock held."""
+        del self._pending[command.cid]
+        device_commands = self._by_device[command.device]
+        del device_commands[command.cid]
+        if not device_commands:
+            del self._by_device[command.device]
+
+    def confirm(self, device, report):
+        """Confirm the device's pending commands matched by a state report. Returns their cids."""
+        now = self.clock()
+        echoed = report.get(CID_KEY)
+        with self._lock:
+            confirmed = [
+                command for command in self._by_device.get(device, {}).values()
+                if (command.cid == echoed if echoed else _matches(command.values, report))
+            ]
+            for command in confirmed:
+                self._remove(command)
+                ms = (now - command.sent_at) * 1000
+                self._histogram.observe(ms)
+                self._devices[device]['confirmed'] += 1
+                self._device_latency[device] += ms
+        return [command.cid for command in confirmed]
+
+    def expire(self):
+        """Count commands unconfirmed after the timeout as failures. Returns how many expired."""
+        deadline = self.clock() - self.timeout
+        expired = 0
+        with self._lock:
+            while self._pending:
+                command = next(iter(self._pending.values()))
+                if command.sent_at > deadline:
+                    break
+                self._remove(command)
+                self._devices[command.device]['timed_out'] += 1
+                expired += 1
+        return expired
+
+    def snapshot(self):
+        with self._lock:
+            devices = {}
+            for device, counts in self._devices.items():
+                settled = counts['confirmed'] + counts['timed_out']
+                devices[device] = {
+                    **{key: counts[key] for key in ('sent', 'confirmed', 'timed_out', 'superseded', 'evicted')},
+                    "failure_rate": round(counts['timed_out'] / settled, 3) if settled else None,
+                    "avg_latency_ms": (
+                        round(self._device_latency[device] / counts['confirmed'], 1) if counts['confirmed'] else None
+                    ),
+                }
+            return {
+                "generated_at": timezone.now().isoformat(),
+                "timeout_s": self.timeout,
+                "pending": len(self._pending),
+                "latency": self._histogram.as_dict(),
+                "devices": devices,
+            }
@@ -0,0 +1,118 @@
+"""
+Diff-based synchronisation of card template controls.
+
+Editing a device type used to delete and recreate every ``DeviceControl``,
+which changed every control ID and cost one INSERT per control. Controls are
+identified by ``variable_mapping`` (unique per template), so the incoming list
+can be diffed against the stored rows instead:
+
+- mappings that are new are inserted with one ``bulk_create``
+- mappings whose fields differ are written with one ``bulk_update``
+- mappings that disappeared are removed with one ``DELETE``
+
+Controls have no explicit position; the card renders them in ID order. The
+longest prefix of the incoming list that is already in ID order keeps its
+rows. From the first control that would be out of order onwards, existing
+rows are recreated so that the new order survives.
+"""
+from django.db import transaction
+
+from .models import DeviceControl
+from .signals import controls_changed
+
+# Fields compared and copied when a control is updated in place
+CONTROL_FIELDS = ('widget_type', 'label', 'min_value', 'max_value', 'step', 'variant', 'size', 'unit')
+
+
+class ControlDiff:
+    """The writes needed to turn a template's stored controls into the incoming list."""
+
+    def __init__(self):
+        self.to_create = []
+        self.to_update = []
+        self.update_fields = set()
+        self.delete_ids = []
+        self.added = []
+        self.changed = []
+        self.removed = []
+
+    def __bool__(self):
+        return bool(self.to_create or self.to_update or self.delete_ids)
+
+    def __repr__(self):
+        return f"ControlDiff(added={self.added}, changed={self.changed}, removed={self.removed})"
+
+
+def diff_controls(template, existing, controls_data):
+    """
+    Compute the ``ControlDiff`` between ``existing`` controls (model instances)
+    and ``controls_data`` (validated dicts, in display order).
+    """
+    diff = ControlDiff()
+    by_mapping = {c.variable_mapping: c for c in existing}
+    seen = set()
+    in_order = True
+    last_id = 0
+
+    for data in controls_data:
+        mapping = data.get('variable_mapping', '')
+        seen.add(mapping)
+        current = by_mapping.get(mapping)
+
+        if current is None:
+            in_order = False
+            diff.to_create.append(DeviceControl(template=template, **data))
+            diff.added.append(mapping)
+            continue
+
+        if not in_order or current.id < last_id:
+            # Keeping this row would put it before controls listed earlier
+            in_order = False
+            diff.delete_ids.append(current.id)
+            diff.to_create.append(DeviceControl(template=template, **data))
+            diff.changed.append(mapping)
+            continue
+
+        last_id = current.id
+        dirty = [f for f in CONTROL_FIELDS if f in data and getattr(current, f) != data[f]]
+        if dirty:
+            for field in dirty:
+                setattr(current, field, data[field])
+            diff.to_update.append(current)
+            diff.update_fields.update(dirty)
+            diff.changed.append(mapping)
+
+    for mapping, current in by_mapping.items():
+        if mapping not in seen:
+            diff.delete_ids.append(current.id)
+            diff.removed.append(mapping)
+    return diff
+
+
+def sync_controls(template, controls_data):
+    """
+    Apply ``controls_data`` to ``template`` with at most one DELETE, one bulk
+    UPDATE and one bulk INSERT, inside a transaction. ``controls_changed`` is
+    sent once the transaction commits, if anything changed.
+    """
+    with transaction.atomic():
+        existing = list(DeviceControl.objects.filter(template=template).order_by('id'))
+        diff = diff_controls(template, existing, controls_data)
+        # Delete first: recreated controls reuse their (unique) variable_mapping
+        if diff.delete_ids:
+            DeviceControl.objects.filter(pk__in=diff.delete_ids).delete()
+        if diff.to_update:
+            DeviceControl.objects.bulk_update(diff.to_update, sorted(diff.update_fields))
+        if diff.to_create:
+            DeviceControl.objects.bulk_create(diff.to_create)
+
+        if diff:
+            transaction.on_commit(lambda: controls_changed.send(
+                sender=type(template),
+                template=template,
+                device_type_id=template.device_type_id,
+                added=diff.added,
+                changed=diff.changed,
+                removed=diff.removed,
+            ))
+    return diff
@@ -0,0 +1,109 @@
+"""
+Single-request payload for the dashboard's first paint.
+
+The dashboard used to fire one request each for the profile, devices, rooms,
+device types, dashboard layout, device order and unread notification counts.
+``build_bootstrap`` assembles the same data with a fixed, small query plan:
+
+- profile:          the authenticated user + profile (1 query)
+- devices:          first page of devices with room/type names via select_related
+                    and only(), plus the total count (2)
+- rooms:            (1)
+- device_types:     lite representation (no firmware/docs/images) with the card
+                    template joined and controls prefetched (2)
+- layout:           personal and shared layout fetched together (1)
+- notifications:    unread counts grouped by type (1)
+
+Each section matches the response of the endpoint it replaces (``devices``
+is the paginated envelope of ``/api/devices/``'s first page); see API_GUIDE.md.
+"""
+import hashlib
+
+from django.db.models import Count, Prefetch, Q
+from django.urls import reverse
+from rest_framework.renderers import JSONRenderer
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+from .caching import approved_device_types
+from .models import CustomDeviceType, DashboardLayout, Device, DeviceControl, Notification, Room
+from .permissions import IsAdmin
+from .serializers import DeviceSerializer, DeviceTypeLiteSerializer, RoomSerializer, UserSerializer
+
+
+def _device_types(request):
+    qs = CustomDeviceType.objects.only('id', 'name', 'approved', 'card_template__id', 'card_template__layout_config') \
+        .select_related('card_template') \
+        .prefetch_related(Prefetch('card_template__controls', queryset=DeviceControl.objects.order_by('id')))
+    if not IsAdmin().has_permission(request, None):
+        approved_ids = approved_device_types.get_or_set(
+            lambda: list(CustomDeviceType.objects.filter(approved=True).values_list('id', flat=True))
+        )
+        qs = qs.filter(id__in=approved_ids)
+    return DeviceTypeLiteSerializer(qs, many=True).data
+
+
+def _device_page(request, devices):
+    """The first page of ``/api/devices/``, in that endpoint's pagination envelope."""
+    page_size = api_settings.DEFAULT_PAGINATION_CLASS.page_size
+    count = devices.count()
+    next_url = None
+    if count > page_size:
+        next_url = replace_query_param(request.build_absolute_uri(reverse('device-list-create')), 'page', 2)
+    return {
+        "count": count,
+        "next": next_url,
+        "previous": None,
+        "results": DeviceSerializer(devices[:page_size], many=True).data,
+    }
+
+
+def _layout(user):
+    """Personal layout, else the shared one, else the default — in one query."""
+    layouts = {
+        layout.user_id: layout
+        for layout in DashboardLayout.objects.filter(Q(user=user) | Q(user__isnull=True))
+    }
+    layout_obj = layouts.get(user.id) or layouts.get(None)
+    if layout_obj is None:
+        return {"layout": None, "device_order": DashboardLayout.ORDER_ROOM, "is_personal": False}
+    return {
+        "layout": layout_obj.layout,
+        "device_order": layout_obj.device_order,
+        "is_personal": layout_obj.user_id is not None,
+        "updated_at": layout_obj.updated_at.isoformat(),
+    }
+
+
+def _unread_counts(user):
+    by_type = dict(
+        Notification.objects.filter(user=user, is_read=False)
+        .order_by()
+        .values_list('notification_type')
+        .annotate(count=Count('id'))
+    )
+    return {"unread_count": sum(by_type.values()), "by_type": by_type}
+
+
+def build_bootstrap(request):
+    user = request.user
+    devices = Device.objects.select_related('room', 'device_type').only(
+        'id', 'name', 'ip_address', 'status', 'icon', 'current_state', 'desired_state',
+        'device_type__name', 'room__name',
+    )
+    layout = _layout(user)
+    return {
+        "profile": UserSerializer(user, context={'request': request}).data,
+        "devices": _device_page(request, devices),
+        "rooms": RoomSerializer(Room.objects.all(), many=True).data,
+        "device_types": _device_types(request),
+        "dashboard_layout": layout,
+        "device_order": layout["device_order"],
+        "notifications": _unread_counts(user),
+    }
+
+
+def render_with_etag(payload):
+    """Render ``payload`` to JSON bytes and derive a strong ETag from them."""
+    content = JSONRenderer().render(payload)
+    return content, '"%s"' % hashlib.blake2b(content, digest_size=16).hexdigest()
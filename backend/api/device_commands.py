@@ -0,0 +1,105 @@
+"""
+Turning state changes from the API into device commands.
+
+Used by ``PATCH /api/devices/{id}/state/`` (one device) and
+``POST /api/devices/bulk-state/`` (many). Commands are addressed by MAC
+address, which the firmware reports when it first checks in over MQTT;
+devices without one cannot be controlled yet.
+"""
+import logging
+
+from rest_framework.exceptions import ValidationError
+
+from .command_coalescer import command_coalescer, command_window
+from .command_queue import enqueue, queues_offline_commands
+from .models import Device
+
+logger = logging.getLogger(__name__)
+
+NO_MAC_DETAIL = "No MAC address bound yet; the device has not checked in."
+NOT_FOUND_DETAIL = "Device not found."
+# Columns needed to address and report on a command target
+TARGET_FIELDS = ('id', 'name', 'mac_address', 'device_type', 'status')
+BULK_SELECTORS = ('devices', 'room', 'type')
+
+
+def hardware_payload(state_changes):
+    """
+    The command sent to the firmware for a state change.
+
+    Compatibility layer: single-relay firmware only understands ``relay_1``,
+    so when the change has no ``relay_1``/``switch-*`` key the first boolean
+    (or "on"/"off"-style string) value is also sent as ``relay_1``.
+    """
+    payload = dict(state_changes)
+    has_relay_key = any(k == "relay_1" or k.startswith("switch-") for k in payload)
+    if not has_relay_key:
+        for value in payload.values():
+            if isinstance(value, bool) or (isinstance(value, str) and value.lower() in ['true', 'false', 'on', 'off']):
+                payload["relay_1"] = value
+                break
+    return payload
+
+
+def send_commands(devices, state_changes):
+    """
+    Send one state change to each device through the coalescer, publishing
+    all of them in one batch. Offline devices get it queued instead (see
+    ``api.command_queue``). Returns ``[{"id", "accepted", "queued", ("detail")}]``.
+    """
+    payload = hardware_payload(state_changes)
+    queue_offline = queues_offline_commands()
+    windows = {}
+    commands = []
+    offline = []
+    results = []
+    for device in devices:
+        if not device.mac_address:
+            logger.warning(f"Cannot control device {device.name} (ID: {device.id}) - No MAC address bound yet.")
+            results.append({"id": device.id, "accepted": False, "queued": False, "detail": NO_MAC_DETAIL})
+            continue
+        if queue_offline and device.status != Device.STATUS_ONLINE:
+            offline.append(device)
+            results.append({"id": device.id, "accepted": True, "queued": True})
+            continue
+        if device.device_type_id not in windows:
+            windows[device.device_type_id] = command_window(device.device_type_id, payload)
+        commands.append((device.mac_address, payload, windows[device.device_type_id]))
+        results.append({"id": device.id, "accepted": True, "queued": False})
+    if offline:
+        enqueue([(device.id, payload) for device in offline])
+    command_coalescer.submit_many(commands)
+    return results
+
+
+def _id(name, value):
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise ValidationError({"detail": f"{name} must be an integer ID."})
+    return value
+
+
+def resolve_targets(data):
+    """
+    The devices selected by a bulk request, in one query, plus the requested
+    IDs that do not exist. Exactly one of ``devices`` (list of IDs), ``room``
+    (ID or "none") and ``type`` (device type ID) selects them.
+    """
+    selectors = [name for name in BULK_SELECTORS if data.get(name) not in (None, [])]
+    if len(selectors) != 1:
+        raise ValidationError({"detail": "Provide exactly one of: devices, room, type."})
+    selector = selectors[0]
+    value = data[selector]
+    queryset = Device.objects.only(*TARGET_FIELDS).order_by('id')
+
+    if selector == 'devices':
+        if not isinstance(value, list):
+            raise ValidationError({"detail": "devices must be a list of device IDs."})
+        ids = list(dict.fromkeys(_id('devices', v) for v in value))
+        devices = list(queryset.filter(pk__in=ids))
+        found = {device.id for device in devices}
+        return devices, [pk for pk in ids if pk not in found]
+    if selector == 'room':
+        if value == 'none':
+            return list(queryset.filter(room__isnull=True)), []
+        return list(queryset.filter(room_id=_id('room', value))), []
+    return list(queryset.filter(device_type_id=_id('type', value))), []
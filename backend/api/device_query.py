@@ -0,0 +1,201 @@
+"""
+Server-side filtering, ordering and grouping for the device list.
+
+``filter_devices`` applies the ``room``, ``status``, ``type``, ``search``,
+``state.*`` and ``ordering`` query parameters; ``group_devices`` returns the
+devices grouped the way the dashboard groups them
+(``DashboardLayout.ORDER_CHOICES``) with per-group counts from one aggregate
+query. Everything runs in SQL; the supporting indexes, including the GIN
+and expression indexes on ``current_state``, are declared on ``Device.Meta``.
+
+State predicates (``state.<key>[__<op>]=<value>``, values parsed as JSON):
+
+- ``state.relay_1=true``           equality: ``current_state @> '{"relay_1": true}'`` (GIN)
+- ``state.battery__exists=true``   key existence: ``current_state ? 'battery'`` (GIN)
+- ``state.battery__lt=20``         numeric range on numeric values only. Keys in
+  ``STATE_INDEXED_KEYS`` use their expression index; other keys are narrowed
+  by the GIN index on key existence and compared on the matching rows.
+"""
+import json
+
+from django.db.models import Case, Count, F, IntegerField, Q, Value, When
+from django.db.models import lookups
+from rest_framework.exceptions import ValidationError
+
+from .expressions import JSONNumber
+from .models import STATE_INDEXED_KEYS, DashboardLayout, Device
+
+UNASSIGNED_ROOM = "Unassigned"
+ALL_DEVICES = "All devices"
+
+# ?ordering= values and the lookup they sort on
+ORDERING_FIELDS = {
+    'name': 'name',
+    'status': 'status',
+    'room': 'room__name',
+    'type': 'device_type__name',
+    'updated_at': 'updated_at',
+    'id': 'id',
+}
+
+GROUP_BY_CHOICES = [choice for choice, _ in DashboardLayout.ORDER_CHOICES]
+
+STATE_PARAM_PREFIX = 'state.'
+STATE_RANGE_LOOKUPS = {
+    'gt': lookups.GreaterThan,
+    'gte': lookups.GreaterThanOrEqual,
+    'lt': lookups.LessThan,
+    'lte': lookups.LessThanOrEqual,
+}
+STATE_OPS = ('eq', 'exists', *STATE_RANGE_LOOKUPS)
+STATUS_LABELS = dict(Device.STATUS_CHOICES)
+
+
+def _error(param, message):
+    return ValidationError({"detail": f"{param} {message}"})
+
+
+def _int_param(name, value):
+    try:
+        return int(value)
+    except ValueError:
+        raise _error(name, "must be an integer.")
+
+
+def _parse_state_param(name, raw):
+    """``state.temp__gt`` + ``"26"`` -> ``('temp', 'gt', 26)``."""
+    key, _, op = name[len(STATE_PARAM_PREFIX):].rpartition('__')
+    if not key or op not in STATE_OPS:
+        key, op = name[len(STATE_PARAM_PREFIX):], 'eq'
+    if not key or '__' in key:
+        raise _error(name, "needs a state key without '__'.")
+    try:
+        value = json.loads(raw)
+    except ValueError:
+        value = raw  # bare strings: state.mode=heat
+    if op == 'exists' and not isinstance(value, bool):
+        raise _error(name, "must be true or false.")
+    if op in STATE_RANGE_LOOKUPS and (isinstance(value, bool) or not isinstance(value, (int, float))):
+        raise _error(name, "must be a number.")
+    return key, op, value
+
+
+def state_filter(queryset, key, op, value):
+    """Filter devices on one ``current_state`` predicate."""
+    if op == 'exists':
+        has_key = Q(current_state__has_key=key)
+        return queryset.filter(has_key if value else ~has_key)
+    if op == 'eq':
+        return queryset.filter(current_state__contains={key: value})
+    number = JSONNumber('current_state', Value(key))
+    queryset = queryset.filter(STATE_RANGE_LOOKUPS[op](number, value))
+    if key not in STATE_INDEXED_KEYS:
+        queryset = queryset.filter(current_state__has_key=key)
+    return queryset
+
+
+def filter_devices(queryset, params):
+    """Apply the device list query parameters. Raises ValidationError (400) on bad input."""
+    room = params.get('room')
+    if room:
+        if room == 'none':
+            queryset = queryset.filter(room__isnull=True)
+        else:
+            queryset = queryset.filter(room_id=_int_param('room', room))
+
+    statuses = [s.strip() for s in params.get('status', '').split(',') if s.strip()]
+    if statuses:
+        unknown = [s for s in statuses if s not in STATUS_LABELS]
+        if unknown:
+            raise _error('status', f"must be one of: {', '.join(STATUS_LABELS)}.")
+        queryset = queryset.filter(status__in=statuses)
+
+    device_type = params.get('type')
+    if device_type:
+        queryset = queryset.filter(device_type_id=_int_param('type', device_type))
+
+    for name, values in params.lists():
+        if name.startswith(STATE_PARAM_PREFIX):
+            for raw in values:
+                queryset = state_filter(queryset, *_parse_state_param(name, raw))
+
+    search = params.get('search', '').strip()
+    if search:
+        queryset = queryset.filter(Q(name__icontains=search) | Q(ip_address__icontains=search))
+
+    ordering = params.get('ordering')
+    if ordering:
+        field = ORDERING_FIELDS.get(ordering.removeprefix('-'))
+        if field is None:
+            choices = ', '.join(ORDERING_FIELDS)
+            raise _error('ordering', f"must be one of: {choices} (prefix with - for descending).")
+        expression = F(field).desc(nulls_last=True) if ordering.startswith('-') else F(field).asc(nulls_last=True)
+        queryset = queryset.order_by(expression, 'id')
+    return queryset
+
+
+def _status_rank():
+    """Sort statuses in STATUS_CHOICES order (online, offline, error)."""
+    return Case(
+        *[When(status=value, then=Value(rank)) for rank, (value, _) in enumerate(Device.STATUS_CHOICES)],
+        default=Value(len(Device.STATUS_CHOICES)),
+        output_field=IntegerField(),
+    )
+
+
+def _grouping(group_by):
+    """``(key lookup, label lookup, group ordering)`` for a grouped order choice."""
+    if group_by == DashboardLayout.ORDER_ROOM:
+        return 'room', 'room__name', [F('room__name').asc(nulls_last=True), 'room']
+    if group_by == DashboardLayout.ORDER_TYPE:
+        return 'device_type', 'device_type__name', ['device_type__name', 'device_type']
+    return 'status', None, [_status_rank()]
+
+
+def _label(group_by, row, label_field):
+    if group_by == DashboardLayout.ORDER_STATUS:
+        return STATUS_LABELS.get(row['status'], row['status'])
+    if row[label_field] is None:
+        return UNASSIGNED_ROOM
+    return row[label_field]
+
+
+def group_devices(queryset, group_by, serialize):
+    """
+    Group the (filtered) device queryset.
+
+    ``serialize(devices)`` turns a list of devices into response data. Within a
+    group devices keep the queryset's ordering (``?ordering=``), else by name.
+    Returns ``{"group_by", "count", "groups": [{key, label, count, devices}]}``.
+    """
+    if group_by not in GROUP_BY_CHOICES:
+        raise _error('group_by', f"must be one of: {', '.join(GROUP_BY_CHOICES)}.")
+    inner_order = list(queryset.query.order_by) if queryset.query.order_by else ['name', 'id']
+
+    if group_by in (DashboardLayout.ORDER_NAME, DashboardLayout.ORDER_CUSTOM):
+        # Orderings rather than groupings: one group (custom order lives in the layout)
+        if group_by == DashboardLayout.ORDER_NAME:
+            queryset = queryset.order_by('name', 'id')
+        devices = list(queryset)
+        groups = [{"key": None, "label": ALL_DEVICES, "count": len(devices), "devices": serialize(devices)}]
+        return {"group_by": group_by, "count": len(devices), "groups": groups}
+
+    key, label_field, group_order = _grouping(group_by)
+    columns = [key] + ([label_field] if label_field else [])
+    counts = queryset.prefetch_related(None).order_by(*group_order).values(*columns).annotate(count=Count('pk'))
+
+    members = {}
+    # The key is annotated so it is available even when ?fields= deferred it
+    for device in queryset.annotate(group_key=F(key)).order_by(*group_order, *inner_order):
+        members.setdefault(device.group_key, []).append(device)
+
+    groups = [
+        {
+            "key": row[key],
+            "label": _label(group_by, row, label_field),
+            "count": row['count'],
+            "devices": serialize(members.get(row[key], [])),
+        }
+        for row in counts
+    ]
+    return {"group_by": group_by, "count": sum(g["count"] for g in groups), "groups": groups}
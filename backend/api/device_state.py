@@ -0,0 +1,80 @@
+"""
+Applying device state reports without read-modify-write.
+
+Firmware reports standard keys (``temperature``, ``humidity``, ``relay_1``...)
+while the card template stores values under each control's
+``variable_mapping`` (e.g. ``temperature-1771357525497``). ``remap_state``
+turns a report into a ``(delta, remove)`` pair, using the device type's
+controls from the ``device_type_controls`` cache, and ``merge_state`` applies
+it with one UPDATE (``api.expressions.JSONMerge``). The row is never loaded,
+so edits to ``name``, ``room`` or ``icon`` made at the same time survive.
+"""
+from django.utils import timezone
+
+from .caching import device_type_controls
+from .expressions import JSONMerge
+from .models import DeviceControl
+
+# Firmware key -> widget types whose control receives its value (first match wins)
+STANDARD_KEY_WIDGETS = {
+    'temperature': (DeviceControl.WIDGET_TEMPERATURE, DeviceControl.WIDGET_GAUGE),
+    'humidity': (DeviceControl.WIDGET_HUMIDITY, DeviceControl.WIDGET_GAUGE),
+    'pressure': (DeviceControl.WIDGET_PRESSURE, DeviceControl.WIDGET_GAUGE),
+    'relay_1': (DeviceControl.WIDGET_TOGGLE, DeviceControl.WIDGET_BUTTON),
+}
+SWITCH_PREFIX = 'switch-'
+
+
+def type_controls(device_type_id):
+    """``[(widget_type, variable_mapping)]`` of a device type's controls, in order."""
+    return device_type_controls.get_or_set(
+        lambda: list(
+            DeviceControl.objects.filter(template__device_type_id=device_type_id)
+            .order_by('id')
+            .values_list('widget_type', 'variable_mapping')
+        ),
+        device_type_id,
+    )
+
+
+def map_standard_key(controls, key):
+    """The ``variable_mapping`` a firmware key is stored under, or None to keep the key."""
+    if key.startswith(SWITCH_PREFIX):
+        targets = STANDARD_KEY_WIDGETS['relay_1']
+    else:
+        targets = STANDARD_KEY_WIDGETS.get(key, ())
+    return next((mapping for widget_type, mapping in controls if widget_type in targets), None)
+
+
+def remap_state(controls, data):
+    """
+    Split a state report into ``(delta, remove)``.
+
+    Mapped keys are stored under their control's ``variable_mapping``, and the
+    standard key is removed so older reports do not leave a duplicate behind.
+    """
+    delta = {}
+    remove = set()
+    for key, value in data.items():
+        mapped = map_standard_key(controls, key)
+        if mapped:
+            delta[mapped] = value
+            if mapped != key:
+                remove.add(key)
+        else:
+            delta[key] = value
+    return delta, remove - set(delta)
+
+
+def merge_state(queryset, delta, remove=(), **fields):
+    """
+    Merge ``delta`` into ``current_state`` (dropping ``remove`` keys) and set
+    ``fields`` on every row of ``queryset`` in one UPDATE. Returns the row count.
+
+    Like any ``QuerySet.update()`` this sends no model signals.
+    """
+    return queryset.update(
+        current_state=JSONMerge('current_state', delta, remove),
+        updated_at=timezone.now(),
+        **fields,
+    )
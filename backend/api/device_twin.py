@@ -0,0 +1,135 @@
+"""
+Desired/reported state reconciliation (device twin).
+
+``Device.desired_state`` holds commanded values the device has not confirmed
+yet, next to the reported ``current_state``. The API merges every command
+into it (``record_desired``), in one UPDATE for any number of devices.
+
+When a device reports, the MQTT listener compares the report with the
+desired values (``divergence``):
+
+- keys reported with the desired value are confirmed and dropped from
+  ``desired_state`` (in the same UPDATE that merges the report)
+- keys reported with another value diverge: the ``Reconciler`` re-publishes
+  just those keys, with exponential backoff per device, and gives up (drops
+  the keys) after ``RECONCILE_MAX_ATTEMPTS`` resends
+- keys the device leaves out of its reports (momentary buttons, sliders
+  without echo) are dropped once they have gone unreported for
+  ``DESIRED_STATE_TTL`` seconds, in the UPDATE of the report that expires them
+
+Dropping confirmed keys matters: a desired value that outlived its
+confirmation would undo later changes made on the device itself (a wall
+switch).
+"""
+import time
+
+from django.conf import settings
+from django.db.models import Case, F, JSONField, When
+
+from .command_tracking import normalize_value
+from .expressions import JSONMerge
+from .models import Device
+
+# Correlation ID prefix of reconciliation resends, so the listener does not
+# mistake them for new commands
+RECONCILE_CID_PREFIX = 'rc-'
+
+
+def record_desired(queryset, state_changes):
+    """Merge commanded values into ``desired_state`` of every device in ``queryset``."""
+    return queryset.update(desired_state=JSONMerge('desired_state', state_changes))
+
+
+def record_desired_many(states):
+    """Merge ``{device_id: state_changes}`` into each device's ``desired_state`` in one UPDATE."""
+    if not states:
+        return 0
+    return Device.objects.filter(pk__in=list(states)).update(desired_state=Case(
+        *[When(pk=pk, then=JSONMerge('desired_state', state)) for pk, state in states.items()],
+        default=F('desired_state'),
+        output_field=JSONField(),
+    ))
+
+
+def divergence(desired, report):
+    """``(diverged {key: desired value}, confirmed keys)`` of the desired keys in a report."""
+    diverged = {}
+    confirmed = set()
+    for key, value in (desired or {}).items():
+        if key not in report:
+            continue
+        if normalize_value(report[key]) == normalize_value(value):
+            confirmed.add(key)
+        else:
+            diverged[key] = value
+    return diverged, confirmed
+
+
+class _Retry:
+    __slots__ = ('attempts', 'next_at')
+
+    def __init__(self, next_at):
+        self.attempts = 0
+        self.next_at = next_at
+
+
+class Reconciler:
+    """Per-device resend schedule of the listener process."""
+
+    def __init__(self, max_attempts=None, base_delay=None, max_delay=None, unreported_ttl=None,
+                 clock=time.monotonic):
+        self.max_attempts = max_attempts or getattr(settings, 'RECONCILE_MAX_ATTEMPTS', 5)
+        self.base_delay = base_delay or getattr(settings, 'RECONCILE_BASE_DELAY', 5)
+        self.max_delay = max_delay or getattr(settings, 'RECONCILE_MAX_DELAY', 300)
+        self.unreported_ttl = unreported_ttl or getattr(settings, 'DESIRED_STATE_TTL', 300)
+        self.clock = clock
+        self._retries = {}
+        # {device: {key: (desired value, first report without it)}}
+        self._unreported = {}
+
+    def command_sent(self, device):
+        """A new command went out: give the device ``base_delay`` to apply it before resending."""
+        self._retries[device] = _Retry(self.clock() + self.base_delay)
+
+    def plan(self, device, diverged):
+        """
+        What to do about a report's divergent keys: ``(resend, abandon)``.
+        ``resend`` is the payload to re-publish now (empty while backing off),
+        ``abandon`` the keys to drop from ``desired_state`` after the last attempt.
+        """
+        if not diverged:
+            self._retries.pop(device, None)
+            return {}, set()
+        now = self.clock()
+        retry = self._retries.setdefault(device, _Retry(now))
+        if now < retry.next_at:
+            return {}, set()
+        if retry.attempts >= self.max_attempts:
+            del self._retries[device]
+            return {}, set(diverged)
+        retry.attempts += 1
+        retry.next_at = now + min(self.base_delay * 2 ** retry.attempts, self.max_delay)
+        return dict(diverged), set()
+
+    def expired(self, device, desired, report):
+        """
+        Desired keys to drop because the device has left them out of its reports
+        for ``unreported_ttl`` seconds. A key commanded to a new value starts over.
+        """
+        now = self.clock()
+        previous = self._unreported.pop(device, {})
+        waiting = {}
+        expired = set()
+        for key, value in (desired or {}).items():
+            if key in report:
+                continue
+            value = normalize_value(value)
+            old = previous.get(key)
+            since = old[1] if old is not None and old[0] == value else now
+            if now - since >= self.unreported_ttl:
+                expired.add(key)
+            else:
+                waiting[key] = (value, since)
+        if waiting:
+            self._unreported[device] = waiting
+        return expired
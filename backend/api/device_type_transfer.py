@@ -0,0 +1,473 @@
+"""
+Streaming export and import of device types.
+
+Exports embed every image as base64, so a catalog can easily weigh hundreds of
+megabytes. Instead of building the whole list in memory, ``stream_export``
+walks the queryset with ``iterator()`` (prefetching controls per chunk),
+serializes one device type at a time and yields encoded bytes that can be fed
+straight into a ``StreamingHttpResponse``. Memory use is bounded by the chunk
+size, not by the size of the catalog.
+
+Output formats:
+- ``json``:   a single JSON array, identical to the non-streaming export
+- ``ndjson``: one JSON object per line
+
+Optional compression (``gzip`` always, ``zstd`` when the ``zstandard``
+package is installed) is applied on the fly.
+
+Imports run the other way: ``iter_import_items`` parses an upload
+incrementally (JSON array, NDJSON or a single object, optionally gzip/zstd
+compressed) and ``import_device_types`` writes the items in chunks with
+``bulk_create`` inside one transaction.
+"""
+import codecs
+import gzip
+import json
+import logging
+import os
+import uuid
+import zlib
+from itertools import islice
+
+from django.db import transaction
+from django.db.models import Prefetch
+
+from .caching import approved_device_types
+from .models import CustomDeviceType, DeviceCardTemplate, DeviceControl
+
+logger = logging.getLogger(__name__)
+
+try:
+    import zstandard
+except ImportError:  # optional dependency
+    zstandard = None
+
+EXPORT_FORMATS = ('json', 'ndjson')
+EXPORT_COMPRESSIONS = ('gzip', 'zstd')
+
+# Device types fetched (and controls prefetched) per database round trip
+EXPORT_CHUNK_SIZE = 50
+
+CONTENT_TYPES = {
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+    'gzip': 'application/gzip',
+    'zstd': 'application/zstd',
+}
+FILE_EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+
+
+def export_queryset():
+    """Device types with everything ``serialize_for_export`` touches preloaded."""
+    return CustomDeviceType.objects.select_related('card_template').prefetch_related(
+        Prefetch('card_template__controls', queryset=DeviceControl.objects.order_by('id'))
+    )
+
+
+def serialize_for_export(dt):
+    """Return the self-contained export dict for one device type."""
+    result = {
+        'name': dt.name,
+        'definition': dt.definition,
+        'firmware_code': dt.firmware_code,
+        'wiring_diagram_text': dt.wiring_diagram_text,
+        'documentation': dt.documentation,
+        # All images stored in DB — always included in exports
+        'wiring_diagram_base64': dt.wiring_diagram_base64 or '',
+        'documentation_images_base64': dt.documentation_images_base64 or [],
+    }
+
+    tmpl = getattr(dt, 'card_template', None)
+    if tmpl:
+        controls = []
+        # Ordered by the prefetch in export_queryset(); calling order_by() here
+        # would bypass the prefetch cache and query once per device type.
+        for c in tmpl.controls.all():
+            ctrl = {
+                'widget_type': c.widget_type,
+                'label': c.label,
+                'variable_mapping': c.variable_mapping,
+            }
+            if c.unit: ctrl['unit'] = c.unit
+            if c.min_value is not None: ctrl['min_value'] = float(c.min_value)
+            if c.max_value is not None: ctrl['max_value'] = float(c.max_value)
+            if c.step is not None: ctrl['step'] = float(c.step)
+            if c.variant: ctrl['variant'] = c.variant
+            if c.size: ctrl['size'] = c.size
+            controls.append(ctrl)
+        result['card_template'] = {
+            'layout_config': tmpl.layout_config,
+            'controls': controls,
+        }
+    else:
+        result['card_template'] = None
+    return result
+
+
+def _encode_json_array(items):
+    first = True
+    yield b'['
+    for item in items:
+        yield (b'' if first else b',') + json.dumps(item).encode('utf-8')
+        first = False
+    yield b']'
+
+
+def _encode_ndjson(items):
+    for item in items:
+        yield json.dumps(item).encode('utf-8') + b'\n'
+
+
+def _gzip(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _zstd(chunks):
+    compressor = zstandard.ZstdCompressor().compressobj()
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def compression_available(name):
+    return name == 'gzip' or (name == 'zstd' and zstandard is not None)
+
+
+def stream_export(queryset, fmt='json', compress=None, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Yield the encoded export of ``queryset`` as bytes.
+
+    The queryset should come from ``export_queryset()``. Raises ValueError for
+    an unknown format or an unavailable compression.
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format '{fmt}'.")
+    if compress and not compression_available(compress):
+        raise ValueError(f"Compression '{compress}' is not available.")
+
+    items = (serialize_for_export(dt) for dt in queryset.iterator(chunk_size=chunk_size))
+    chunks = _encode_ndjson(items) if fmt == 'ndjson' else _encode_json_array(items)
+    if compress == 'gzip':
+        chunks = _gzip(chunks)
+    elif compress == 'zstd':
+        chunks = _zstd(chunks)
+    return chunks
+
+
+def export_filename(fmt='json', compress=None):
+    return f"device_types_export.{fmt}{FILE_EXTENSIONS.get(compress, '')}"
+
+
+def export_content_type(fmt='json', compress=None):
+    return CONTENT_TYPES[compress or fmt]
+
+
+# ── Import ──
+
+# Device types written per bulk_create round trip. Items carry embedded
+# images, so this also bounds how much decoded JSON is held at once.
+IMPORT_CHUNK_SIZE = 50
+
+# Bytes read from the upload per parser refill
+IMPORT_READ_SIZE = 64 * 1024
+
+NAME_MAX_LENGTH = CustomDeviceType._meta.get_field('name').max_length
+
+_GZIP_MAGIC = b'\x1f\x8b'
+_ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+_DECOMPRESS_ERRORS = (OSError, EOFError) + ((zstandard.ZstdError,) if zstandard else ())
+
+
+class ImportParseError(ValueError):
+    """The upload is not valid JSON / NDJSON."""
+
+
+def _decompressed(fileobj):
+    """Wrap ``fileobj`` in a decompressor when it starts with a gzip/zstd header."""
+    head = fileobj.read(4)
+    fileobj.seek(0)
+    if head[:2] == _GZIP_MAGIC:
+        return gzip.GzipFile(fileobj=fileobj)
+    if head == _ZSTD_MAGIC:
+        if zstandard is None:
+            raise ImportParseError("zstd-compressed uploads need the zstandard package.")
+        return zstandard.ZstdDecompressor().stream_reader(fileobj)
+    return fileobj
+
+
+def iter_import_items(fileobj, read_size=IMPORT_READ_SIZE):
+    """
+    Incrementally yield the top-level items of an uploaded export.
+
+    Accepts a JSON array (the export format), NDJSON (one object per line) or
+    a single JSON object, optionally gzip/zstd compressed. Only the item being
+    decoded is held in memory. Raises ImportParseError on malformed input.
+    """
+    stream = _decompressed(fileobj)
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buf = ''
+    pos = 0
+    eof = False
+    want = read_size
+
+    def refill():
+        nonlocal buf, pos, eof
+        try:
+            raw = stream.read(want)
+        except _DECOMPRESS_ERRORS as exc:
+            raise ImportParseError("Upload could not be decompressed.") from exc
+        if not raw:
+            eof = True
+        try:
+            text = utf8.decode(raw or b'', final=eof)
+        except UnicodeDecodeError as exc:
+            raise ImportParseError("Upload is not valid UTF-8.") from exc
+        buf = buf[pos:] + text
+        pos = 0
+
+    def skip_ws():
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n':
+                pos += 1
+            if pos < len(buf) or eof:
+                return
+            refill()
+
+    def next_value():
+        nonlocal pos, want
+        want = read_size
+        while True:
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+                # A value that ends exactly at the buffer edge may be a
+                # truncated scalar; make sure the stream really stops there.
+                if end < len(buf) or eof:
+                    pos = end
+                    return value
+            except json.JSONDecodeError as exc:
+                if eof:
+                    raise ImportParseError(f"Invalid JSON near character {exc.pos}.") from exc
+            # Grow reads geometrically so a huge item is not re-parsed O(n) times
+            want = max(want, len(buf) - pos)
+            refill()
+
+    skip_ws()
+    if pos >= len(buf):
+        return
+    if buf[pos] == '[':
+        pos += 1
+        skip_ws()
+        if buf[pos:pos + 1] == ']':
+            return
+        while True:
+            yield next_value()
+            skip_ws()
+            sep = buf[pos:pos + 1]
+            pos += 1
+            if sep == ']':
+                return
+            if sep != ',':
+                raise ImportParseError("Expected ',' or ']' between array items.")
+            skip_ws()
+    else:
+        # NDJSON or a single object: whitespace-separated values
+        while pos < len(buf):
+            yield next_value()
+            skip_ws()
+
+
+class ImportResult:
+    """Running tally of an import, also passed to progress callbacks."""
+
+    def __init__(self):
+        self.processed = 0
+        self.created = []
+        self.skipped = []
+        self.errors = []
+
+    def as_dict(self):
+        return {
+            "status": "Import complete",
+            "created": self.created,
+            "skipped": self.skipped,
+            "errors": self.errors,
+            "created_count": len(self.created),
+            "skipped_count": len(self.skipped),
+        }
+
+
+def _chunked(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def _legacy_doc_images(device_type, doc_images_from_export):
+    """
+    Convert legacy ``documentation_images`` entries (original_url/data) to the
+    ``documentation_images_base64`` format and rewrite markdown URLs to the
+    API serving endpoint. Returns True when ``device_type`` was changed.
+    """
+    if not doc_images_from_export or not isinstance(doc_images_from_export, list):
+        return False
+
+    images_list = []
+    documentation = device_type.documentation or ''
+
+    for img_entry in doc_images_from_export:
+        if not isinstance(img_entry, dict):
+            continue
+        data = img_entry.get('data', '')
+        if not data:
+            continue
+        filename = os.path.basename(img_entry.get('filename', f"{uuid.uuid4()}.png"))
+        images_list.append({'filename': filename, 'data': data})
+
+        # Rewrite old URL references in documentation to new API-based URL
+        original_url = img_entry.get('original_url') or img_entry.get('url', '')
+        new_url = f"/api/device-types/{device_type.pk}/doc-image/{filename}"
+        if original_url and original_url in documentation:
+            documentation = documentation.replace(original_url, new_url)
+
+    if not images_list:
+        return False
+    device_type.documentation_images_base64 = images_list
+    device_type.documentation = documentation
+    return True
+
+
+def _validate_item(index, dt_data):
+    """Return an error message for an item that cannot be imported, or None."""
+    if not isinstance(dt_data, dict):
+        return f"Item {index}: expected an object."
+    name = dt_data.get('name')
+    if not name:
+        return f"Item {index}: missing 'name' field."
+    if not isinstance(name, str):
+        return f"Item {index}: 'name' must be a string."
+    if len(name) > NAME_MAX_LENGTH:
+        return f"Item {index}: 'name' is longer than {NAME_MAX_LENGTH} characters."
+    if not isinstance(dt_data.get('definition', {}), dict):
+        return f"Item {index} ({name}): 'definition' must be an object."
+    card_data = dt_data.get('card_template')
+    if card_data and isinstance(card_data, dict):
+        mappings = [c.get('variable_mapping', '') for c in card_data.get('controls', []) if isinstance(c, dict)]
+        if len(mappings) != len(set(mappings)):
+            return f"Item {index} ({name}): duplicate control 'variable_mapping'."
+    return None
+
+
+def _import_chunk(chunk, existing_names, proposed_by, result):
+    pending = []
+    for index, dt_data in chunk:
+        error = _validate_item(index, dt_data)
+        if error:
+            result.errors.append(error)
+            continue
+        name = dt_data['name']
+        if name in existing_names:
+            result.skipped.append(name)
+            continue
+        existing_names.add(name)
+
+        doc_images_base64 = dt_data.get('documentation_images_base64', [])
+        device_type = CustomDeviceType(
+            name=name,
+            definition=dt_data.get('definition', {}),
+            approved=True,
+            proposed_by=proposed_by,
+            firmware_code=dt_data.get('firmware_code', ''),
+            wiring_diagram_text=dt_data.get('wiring_diagram_text', ''),
+            documentation=dt_data.get('documentation', ''),
+            # Legacy support: wiring_diagram_image_data predates wiring_diagram_base64
+            wiring_diagram_base64=dt_data.get('wiring_diagram_base64', '') or dt_data.get('wiring_diagram_image_data', ''),
+            documentation_images_base64=doc_images_base64 or [],
+        )
+        pending.append((device_type, dt_data))
+
+    if not pending:
+        return
+
+    CustomDeviceType.objects.bulk_create([dt for dt, _ in pending])
+
+    # Legacy documentation images need the new PK to rewrite their URLs
+    relinked = [
+        dt for dt, data in pending
+        if not data.get('documentation_images_base64')
+        and _legacy_doc_images(dt, data.get('documentation_images'))
+    ]
+    if relinked:
+        CustomDeviceType.objects.bulk_update(relinked, ['documentation_images_base64', 'documentation'])
+
+    templates = []
+    control_specs = []
+    for device_type, data in pending:
+        card_data = data.get('card_template')
+        if card_data and isinstance(card_data, dict):
+            templates.append(DeviceCardTemplate(
+                device_type=device_type,
+                layout_config=card_data.get('layout_config', {}),
+            ))
+            control_specs.append(card_data.get('controls', []))
+    DeviceCardTemplate.objects.bulk_create(templates)
+
+    controls = [
+        DeviceControl(
+            template=template,
+            widget_type=ctrl.get('widget_type', 'TOGGLE'),
+            label=ctrl.get('label', ''),
+            variable_mapping=ctrl.get('variable_mapping', ''),
+            unit=ctrl.get('unit', ''),
+            min_value=ctrl.get('min_value'),
+            max_value=ctrl.get('max_value'),
+            step=ctrl.get('step'),
+            variant=ctrl.get('variant', ''),
+            size=ctrl.get('size', ''),
+        )
+        for template, specs in zip(templates, control_specs)
+        for ctrl in specs
+        if isinstance(ctrl, dict)
+    ]
+    DeviceControl.objects.bulk_create(controls)
+
+    result.created.extend(dt.name for dt, _ in pending)
+
+
+def import_device_types(items, proposed_by=None, chunk_size=IMPORT_CHUNK_SIZE, progress=None):
+    """
+    Import device types from an iterable of export dicts.
+
+    Types whose name already exists (or appeared earlier in the same upload)
+    are skipped; malformed items are reported in ``errors``. Existing names
+    are loaded in a single query, and each chunk of ``chunk_size`` items is
+    written with one ``bulk_create`` per table. The whole import runs in one
+    transaction, so a parse error or database failure leaves nothing behind.
+
+    ``progress(result)`` is called after every chunk.
+    """
+    result = ImportResult()
+    with transaction.atomic():
+        existing_names = set(CustomDeviceType.objects.values_list('name', flat=True))
+        for chunk in _chunked(enumerate(items), chunk_size):
+            _import_chunk(chunk, existing_names, proposed_by, result)
+            result.processed += len(chunk)
+            if progress:
+                progress(result)
+        if result.created:
+            # bulk_create bypasses post_save, so the cached catalog is not
+            # invalidated by the signal wiring in api/caching.py
+            transaction.on_commit(approved_device_types.invalidate)
+    logger.info(
+        "Imported device types: %d processed, %d created, %d skipped, %d errors",
+        result.processed, len(result.created), len(result.skipped), len(result.errors),
+    )
+    return result
@@ -0,0 +1,69 @@
+"""
+Database expressions for querying and updating ``current_state`` and other
+JSON columns. They are written for PostgreSQL (``jsonb``), the only database
+HomeForge runs on.
+"""
+import json
+
+from django.db import NotSupportedError
+from django.db.models import FloatField, Func, JSONField
+
+
+class JSONNumber(Func):
+    """
+    Numeric value stored under ``key`` in a JSON column, or NULL when the key
+    is missing or does not hold a number.
+
+    Unlike a ``KeyTransform``, ``key`` is an expression, so it can come from
+    another column: ``JSONNumber('current_state', F('device_type__card_template__controls__variable_mapping'))``.
+    """
+    output_field = FloatField()
+    arity = 2
+
+    def _compile_args(self, compiler, connection):
+        json_expr, key_expr = self.get_source_expressions()
+        json_sql, json_params = compiler.compile(json_expr)
+        key_sql, key_params = compiler.compile(key_expr)
+        return json_sql, key_sql, (*json_params, *key_params)
+
+    def as_postgresql(self, compiler, connection, **extra_context):
+        json_sql, key_sql, params = self._compile_args(compiler, connection)
+        sql = (
+            f"CASE WHEN jsonb_typeof({json_sql} -> {key_sql}) = 'number' "
+            f"THEN ({json_sql} ->> {key_sql})::double precision END"
+        )
+        return sql, params * 2
+
+    def as_sql(self, compiler, connection, **extra_context):
+        raise NotSupportedError(f"JSONNumber is not implemented for {connection.vendor}.")
+
+
+class JSONMerge(Func):
+    """
+    A JSON object column with ``delta`` merged in and ``remove`` keys deleted,
+    computed by the database: ``(state - remove) || delta`` on PostgreSQL.
+
+    The merge is shallow (top-level keys of ``delta`` replace existing ones),
+    so ``queryset.update(current_state=JSONMerge('current_state', {...}))``
+    applies a state report in one statement without reading the row and
+    without overwriting keys or columns written concurrently.
+    """
+    output_field = JSONField()
+    arity = 1
+
+    def __init__(self, expression, delta, remove=(), **extra):
+        self.delta = dict(delta)
+        self.remove = sorted(set(remove) - set(self.delta))
+        super().__init__(expression, **extra)
+
+    def as_postgresql(self, compiler, connection, **extra_context):
+        sql, params = compiler.compile(self.get_source_expressions()[0])
+        sql, params = f"COALESCE({sql}, '{{}}'::jsonb)", list(params)
+        if self.remove:
+            sql, params = f"({sql} - %s::text[])", params + [self.remove]
+        if self.delta:
+            sql, params = f"({sql} || %s::jsonb)", params + [json.dumps(self.delta)]
+        return sql, params
+
+    def as_sql(self, compiler, connection, **extra_context):
+        raise NotSupportedError(f"JSONMerge is not implemented for {connection.vendor}.")
@@ -0,0 +1,112 @@
+"""
+In-process catalog of the platform-default device types.
+
+``api/fixtures/default_device_types.json`` lists the defaults and points at
+firmware, wiring and documentation files in the source tree. The catalog
+reads and resolves all of them once and keeps the result in process memory
+until the ``mtime`` of the fixture or of any referenced file changes, so the
+import-defaults view and the ``load_default_types`` command no longer hit the
+disk on every call.
+
+Resolved entries use the export format (``firmware_code`` etc. instead of
+``*_file`` paths), so they can be passed straight to
+``device_type_transfer.import_device_types``. Treat them as read-only.
+"""
+import json
+import os
+import threading
+
+from django.conf import settings
+
+FIXTURE_PATH = os.path.join(settings.BASE_DIR, 'api', 'fixtures', 'default_device_types.json')
+
+# Fixture keys that reference a file, and the export field they resolve to
+FILE_FIELDS = {
+    'firmware_code_file': 'firmware_code',
+    'wiring_diagram_text_file': 'wiring_diagram_text',
+    'documentation_file': 'documentation',
+}
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+class FixtureCatalog:
+    """Memoized, mtime-validated view of a default device type fixture."""
+
+    def __init__(self, path, base_dir):
+        self.path = str(path)
+        self.base_dir = str(base_dir)
+        self._lock = threading.Lock()
+        self._signature = None
+        self._raw = None
+        self._entries = None
+        self.loads = 0
+
+    def _resolve(self, relative_path):
+        return os.path.join(self.base_dir, relative_path) if relative_path else None
+
+    def _read_file(self, relative_path):
+        """Read a file relative to base_dir, return empty string if missing."""
+        full_path = self._resolve(relative_path)
+        if full_path and os.path.exists(full_path):
+            with open(full_path, 'r') as f:
+                return f.read()
+        return ''
+
+    def _current_signature(self, raw):
+        referenced = sorted({dt[key] for dt in raw for key in FILE_FIELDS if dt.get(key)})
+        return (_mtime(self.path),) + tuple((p, _mtime(self._resolve(p))) for p in referenced)
+
+    def _load(self):
+        # mtimes are taken before reading, so an edit racing the load is picked
+        # up by the next call instead of being cached under a newer signature
+        fixture_mtime = _mtime(self.path)
+        with open(self.path, 'r') as f:
+            raw = json.load(f)
+        file_mtimes = {}
+        contents = {}
+        for path in sorted({dt[key] for dt in raw for key in FILE_FIELDS if dt.get(key)}):
+            file_mtimes[path] = _mtime(self._resolve(path))
+            contents[path] = self._read_file(path)
+
+        entries = []
+        for dt in raw:
+            entry = {k: v for k, v in dt.items() if k not in FILE_FIELDS}
+            for key, field in FILE_FIELDS.items():
+                entry[field] = contents.get(dt.get(key), '')
+            entries.append(entry)
+        self.loads += 1
+        self._raw = raw
+        self._entries = entries
+        self._signature = (fixture_mtime,) + tuple(sorted(file_mtimes.items()))
+
+    def device_types(self):
+        """
+        Return the resolved default device types.
+
+        Raises FileNotFoundError when the fixture does not exist.
+        """
+        with self._lock:
+            # Cheap path: stat the fixture and referenced files, reuse the parsed data
+            if self._signature is not None and self._current_signature(self._raw) == self._signature:
+                return self._entries
+            try:
+                self._load()
+            except FileNotFoundError:
+                self.clear()
+                raise
+            return self._entries
+
+    def names(self):
+        return [dt['name'] for dt in self.device_types()]
+
+    def clear(self):
+        self._signature = self._raw = self._entries = None
+
+
+default_types = FixtureCatalog(FIXTURE_PATH, settings.BASE_DIR)
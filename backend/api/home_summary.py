@@ -0,0 +1,101 @@
+"""
+Home-wide device totals for ``GET /api/summary/``.
+
+Two queries build the whole summary:
+
+- one grouped count of devices by (room, device type, status), rolled up
+  into totals, per-room and per-type counts
+- one grouped average of the temperature and humidity readings of online
+  devices per room. A reading is the ``current_state`` value under the
+  ``variable_mapping`` of the device type's TEMPERATURE / HUMIDITY control,
+  which is where the MQTT listener stores incoming sensor values
+
+The result is cached in the ``home_summary`` resource. Device, room and type
+edits invalidate it through model signals; the listener's heartbeat saves do
+not (they only touch volatile columns) but it sends ``device_status_changed``
+on every online/offline transition. The resource's generation is shared
+through the database, so that signal reaches the web workers' caches from
+the listener process. Sensor averages may be up to the resource timeout old.
+"""
+from django.db.models import Avg, Count, F
+from django.utils import timezone
+
+from .caching import home_summary
+from .expressions import JSONNumber
+from .models import Device, DeviceControl
+
+UNASSIGNED_ROOM = "Unassigned"
+STATUSES = [value for value, _ in Device.STATUS_CHOICES]
+
+# Summary metric -> widget type whose control maps the reading
+METRICS = {
+    'temperature': DeviceControl.WIDGET_TEMPERATURE,
+    'humidity': DeviceControl.WIDGET_HUMIDITY,
+}
+
+
+def _empty_counts():
+    return {"devices": 0, **{s: 0 for s in STATUSES}}
+
+
+def _room_averages():
+    control = 'device_type__card_template__controls__'
+    rows = (
+        Device.objects
+        .filter(status=Device.STATUS_ONLINE, **{control + 'widget_type__in': list(METRICS.values())})
+        .order_by()
+        .values('room', control + 'widget_type')
+        .annotate(
+            average=Avg(JSONNumber('current_state', F(control + 'variable_mapping'))),
+            readings=Count(JSONNumber('current_state', F(control + 'variable_mapping'))),
+        )
+    )
+    metric_for = {widget: metric for metric, widget in METRICS.items()}
+    averages = {}
+    for row in rows:
+        if row['readings']:
+            metric = metric_for[row[control + 'widget_type']]
+            averages.setdefault(row['room'], {})[metric] = round(row['average'], 1)
+    return averages
+
+
+def build_summary():
+    rows = (
+        Device.objects
+        .order_by()
+        .values('room', 'room__name', 'device_type', 'device_type__name', 'status')
+        .annotate(count=Count('id'))
+    )
+    totals = _empty_counts()
+    rooms = {}
+    types = {}
+    for row in rows:
+        room = rooms.setdefault(row['room'], {
+            "id": row['room'], "name": row['room__name'] or UNASSIGNED_ROOM, **_empty_counts(),
+        })
+        device_type = types.setdefault(row['device_type'], {
+            "id": row['device_type'], "name": row['device_type__name'], **_empty_counts(),
+        })
+        for counts in (totals, room, device_type):
+            counts["devices"] += row['count']
+            counts[row['status']] = counts.get(row['status'], 0) + row['count']
+
+    averages = _room_averages()
+    for room_id, room in rooms.items():
+        for metric in METRICS:
+            room[metric] = averages.get(room_id, {}).get(metric)
+
+    def by_name(entry):
+        # Devices without a room last
+        return (entry["id"] is None, entry["name"].lower())
+
+    return {
+        "totals": totals,
+        "rooms": sorted(rooms.values(), key=by_name),
+        "types": sorted(types.values(), key=by_name),
+        "generated_at": timezone.now().isoformat(),
+    }
+
+
+def get_summary():
+    return home_summary.get_or_set(build_summary)
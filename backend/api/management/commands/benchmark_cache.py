@@ -0,0 +1,107 @@
+import shutil
+import tempfile
+import time
+
+from django.core.cache.backends.db import DatabaseCache
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management.base import BaseCommand
+from django.core.management.commands.createcachetable import Command as CreateCacheTableCommand
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from api.cache_backends import SharedDatabaseCache
+
+BENCH_TABLE = 'homeforge_cache_bench'
+STOCK_BENCH_TABLE = 'homeforge_cache_bench_stock'
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark cache backends (LocMemCache, FileBasedCache, stock DatabaseCache, '
+        'SharedDatabaseCache) '
+        'against the access patterns used by the API.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=2000, help='Operations per pattern.')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS, help='Database for the shared cache table.')
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        database = options['database']
+
+        tmpdir = tempfile.mkdtemp(prefix='homeforge-cache-bench-')
+        creator = CreateCacheTableCommand()
+        creator.verbosity = 0
+        for table in (BENCH_TABLE, STOCK_BENCH_TABLE):
+            creator.create_table(database, table, dry_run=False)
+
+        backends = [
+            ('LocMemCache', LocMemCache('homeforge-bench', {'OPTIONS': {'MAX_ENTRIES': 10000}})),
+            ('FileBasedCache', FileBasedCache(tmpdir, {'OPTIONS': {'MAX_ENTRIES': 10000}})),
+            ('DatabaseCache', DatabaseCache(STOCK_BENCH_TABLE, {'OPTIONS': {'MAX_ENTRIES': 10000}})),
+            ('SharedDatabaseCache', SharedDatabaseCache(BENCH_TABLE, {'OPTIONS': {'MAX_ENTRIES': 10000}})),
+        ]
+
+        try:
+            self.stdout.write(
+                f'{iterations} ops per pattern, database vendor: {connections[database].vendor}\n'
+            )
+            self.stdout.write(f"{'backend':<22}{'pattern':<22}{'us/op':>10}{'ops/s':>12}")
+            for name, backend in backends:
+                backend.clear()
+                for pattern, func in self._patterns(backend):
+                    elapsed = self._time(func, iterations)
+                    per_op = elapsed / iterations * 1e6
+                    self.stdout.write(f'{name:<22}{pattern:<22}{per_op:>10.1f}{iterations / elapsed:>12.0f}')
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            connection = connections[database]
+            with connection.cursor() as cursor:
+                for table in (BENCH_TABLE, STOCK_BENCH_TABLE):
+                    cursor.execute(f'DROP TABLE IF EXISTS {connection.ops.quote_name(table)}')
+
+    def _time(self, func, iterations):
+        start = time.perf_counter()
+        for i in range(iterations):
+            func(i)
+        return time.perf_counter() - start
+
+    def _patterns(self, backend):
+        """Access patterns modelled on api/caching.py resources."""
+        catalog_ids = list(range(50))
+        topology_node = {
+            'id': '1', 'type': 'device',
+            'data': {'label': 'Lamp', 'ip': '192.168.1.10', 'room': 'Living Room', 'current_state': {'relay_1': True}},
+            'position': {'x': 350.0, 'y': 0.0},
+        }
+        layout = [dict(topology_node, id=str(i)) for i in range(100)]
+
+        backend.set('res:approved_device_types:gen', 1, None)
+        backend.set('res:approved_device_types:1:_', catalog_ids)
+        backend.set('res:topology:1:_', layout)
+
+        def catalog_hit(i):
+            # generation lookup + value lookup, as CachedResource.get_or_set does
+            gen = backend.get('res:approved_device_types:gen')
+            backend.get(f'res:approved_device_types:{gen}:_')
+
+        def catalog_rebuild(i):
+            backend.set(f'res:approved_device_types:{i}:_', catalog_ids)
+
+        def invalidate(i):
+            backend.incr('res:approved_device_types:gen')
+
+        def large_value_hit(i):
+            backend.get('res:topology:1:_')
+
+        def miss(i):
+            backend.get(f'missing:{i}')
+
+        return [
+            ('catalog_hit', catalog_hit),
+            ('catalog_rebuild', catalog_rebuild),
+            ('invalidate', invalidate),
+            ('large_value_hit', large_value_hit),
+            ('miss', miss),
+        ]
@@ -0,0 +1,68 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from api.models import AutomationRule
+from api.rules import CompiledRule, RuleEngine
+
+METRICS = ('temperature', 'humidity', 'pressure', 'co2', 'relay_1')
+OPERATORS = (AutomationRule.OP_GT, AutomationRule.OP_GTE, AutomationRule.OP_LT, AutomationRule.OP_LTE)
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark the automation rules engine: per-message evaluation overhead with '
+        'the rules indexed by (device, metric), compared with scanning every rule.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rules', type=int, default=10000, help='Rules loaded.')
+        parser.add_argument('--devices', type=int, default=2000, help='Devices the rules are spread over.')
+        parser.add_argument('--messages', type=int, default=100000, help='State reports evaluated.')
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        devices = options['devices']
+        rules = [
+            CompiledRule(
+                i, f'rule {i}', rng.randrange(devices), rng.choice(METRICS[:4]), rng.choice(OPERATORS),
+                rng.uniform(0, 100), hysteresis=rng.choice((0, 2, 5)), cooldown=rng.choice((0, 60)),
+            )
+            for i in range(options['rules'])
+        ]
+        messages = [
+            (rng.randrange(devices), {metric: round(rng.uniform(0, 100), 1) for metric in METRICS[:4]} | {'relay_1': True})
+            for _ in range(options['messages'])
+        ]
+
+        clock = [0.0]
+        engine = RuleEngine(loader=lambda: rules, clock=lambda: clock[0])
+        engine.load(rules)
+
+        self.stdout.write(f"{len(rules)} rules over {devices} devices, {len(messages)} messages of {len(METRICS)} keys\n")
+        self.stdout.write(f"{'strategy':<12}{'messages':>10}{'us/msg':>10}{'msgs/s':>12}{'fired':>10}")
+
+        fired = 0
+        start = time.perf_counter()
+        for device, report in messages:
+            clock[0] += 0.01
+            fired += len(engine.evaluate(device, report))
+        self._row('indexed', len(messages), time.perf_counter() - start, fired)
+
+        # Baseline: every rule checked against every message (far fewer messages, it is slow)
+        scanned = messages[:max(1, len(messages) // 100)]
+        for rule in rules:
+            rule.armed, rule.last_fired = True, None
+        fired = 0
+        start = time.perf_counter()
+        for device, report in scanned:
+            clock[0] += 0.01
+            for rule in rules:
+                if rule.device == device and rule.metric in report and rule.update(report[rule.metric], clock[0]):
+                    fired += 1
+        self._row('scan', len(scanned), time.perf_counter() - start, fired)
+
+    def _row(self, name, count, elapsed, fired):
+        self.stdout.write(f'{name:<12}{count:>10}{elapsed / count * 1e6:>10.2f}{count / elapsed:>12.0f}{fired:>10}')
@@ -0,0 +1,65 @@
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from api.device_type_transfer import IMPORT_CHUNK_SIZE, ImportParseError, import_device_types, iter_import_items
+
+
+class Command(BaseCommand):
+    help = (
+        'Import device types from an export file (JSON array or NDJSON, optionally '
+        '.gz/.zst compressed). Streams the file, writes in bulk chunks inside one '
+        'transaction and reports progress. Skips types that already exist by name.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Export file to import.')
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=IMPORT_CHUNK_SIZE,
+            help=f'Device types per bulk insert (default: {IMPORT_CHUNK_SIZE}).',
+        )
+        parser.add_argument(
+            '--user',
+            help='Username recorded as proposer of the imported types.',
+        )
+
+    def handle(self, *args, **options):
+        proposed_by = None
+        if options['user']:
+            try:
+                proposed_by = User.objects.get(username=options['user'])
+            except User.DoesNotExist:
+                raise CommandError(f"User '{options['user']}' does not exist.")
+
+        started = time.perf_counter()
+
+        def progress(result):
+            elapsed = time.perf_counter() - started
+            self.stdout.write(
+                f'  {result.processed} processed '
+                f'({len(result.created)} created, {len(result.skipped)} skipped, '
+                f'{len(result.errors)} errors) in {elapsed:.1f}s'
+            )
+
+        try:
+            with open(options['path'], 'rb') as f:
+                result = import_device_types(
+                    iter_import_items(f),
+                    proposed_by=proposed_by,
+                    chunk_size=options['chunk_size'],
+                    progress=progress,
+                )
+        except FileNotFoundError:
+            raise CommandError(f"File not found: {options['path']}")
+        except ImportParseError as exc:
+            raise CommandError(f'Import rolled back: {exc}')
+
+        for error in result.errors:
+            self.stderr.write(self.style.WARNING(f'  {error}'))
+        self.stdout.write(self.style.SUCCESS(
+            f'\nDone. Created: {len(result.created)}, Skipped: {len(result.skipped)}, '
+            f'Errors: {len(result.errors)}'
+        ))
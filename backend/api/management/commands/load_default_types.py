@@ -1,10 +1,9 @@
-import json
-import os
-
-from django.conf import settings
 from django.core.management.base import BaseCommand
+from django.db import transaction
 
-from api.models import CustomDeviceType, DeviceCardTemplate, DeviceControl
+from api.device_type_transfer import import_device_types
+from api.fixture_catalog import default_types
+from api.models import CustomDeviceType
 
 
 class Command(BaseCommand):
@@ -18,77 +17,24 @@ class Command(BaseCommand):
         )
 
     def handle(self, *args, **options):
-        fixture_path = os.path.join(settings.BASE_DIR, 'api', 'fixtures', 'default_device_types.json')
-
-        if not os.path.exists(fixture_path):
-            self.stderr.write(self.style.ERROR(f'Fixture file not found: {fixture_path}'))
+        try:
+            device_types = default_types.device_types()
+        except FileNotFoundError:
+            self.stderr.write(self.style.ERROR(f'Fixture file not found: {default_types.path}'))
             return
 
-        with open(fixture_path, 'r') as f:
-            device_types = json.load(f)
-
-        created = 0
-        skipped = 0
-
-        for dt_data in device_types:
-            name = dt_data['name']
-            exists = CustomDeviceType.objects.filter(name=name).exists()
-
-            if exists and not options['force']:
-                self.stdout.write(f'  Skipped (exists): {name}')
-                skipped += 1
-                continue
-
-            if exists and options['force']:
-                CustomDeviceType.objects.filter(name=name).delete()
-
-            # Read file contents
-            firmware_code = self._read_file(dt_data.get('firmware_code_file', ''))
-            wiring_text = self._read_file(dt_data.get('wiring_diagram_text_file', ''))
-            documentation = self._read_file(dt_data.get('documentation_file', ''))
-
-            device_type = CustomDeviceType.objects.create(
-                name=name,
-                definition=dt_data['definition'],
-                approved=True,
-                firmware_code=firmware_code,
-                wiring_diagram_text=wiring_text,
-                documentation=documentation,
-            )
-
-            card_data = dt_data.get('card_template')
-            if card_data:
-                template = DeviceCardTemplate.objects.create(
-                    device_type=device_type,
-                    layout_config=card_data.get('layout_config', {}),
-                )
-                for ctrl in card_data.get('controls', []):
-                    DeviceControl.objects.create(
-                        template=template,
-                        widget_type=ctrl['widget_type'],
-                        label=ctrl['label'],
-                        variable_mapping=ctrl['variable_mapping'],
-                        unit=ctrl.get('unit', ''),
-                        min_value=ctrl.get('min_value'),
-                        max_value=ctrl.get('max_value'),
-                        step=ctrl.get('step'),
-                        variant=ctrl.get('variant', ''),
-                        size=ctrl.get('size', ''),
-                    )
+        with transaction.atomic():
+            if options['force']:
+                CustomDeviceType.objects.filter(name__in=[dt['name'] for dt in device_types]).delete()
+            result = import_device_types(device_types)
 
+        for name in result.skipped:
+            self.stdout.write(f'  Skipped (exists): {name}')
+        for name in result.created:
             self.stdout.write(self.style.SUCCESS(f'  Created: {name}'))
-            created += 1
+        for error in result.errors:
+            self.stderr.write(self.style.WARNING(f'  {error}'))
 
         self.stdout.write(self.style.SUCCESS(
-            f'\nDone. Created: {created}, Skipped: {skipped}'
+            f'\nDone. Created: {len(result.created)}, Skipped: {len(result.skipped)}'
         ))
-
-    def _read_file(self, relative_path):
-        """Read a file relative to BASE_DIR, return empty string if missing."""
-        if not relative_path:
-            return ''
-        full_path = os.path.join(settings.BASE_DIR, relative_path)
-        if os.path.exists(full_path):
-            with open(full_path, 'r') as f:
-                return f.read()
-        return ''
@@ -3,7 +3,18 @@ import logging
 import time
 from django.core.management.base import BaseCommand
 import paho.mqtt.client as mqtt
+from api.command_queue import purge_expired, take_queued
+from api.command_tracking import CID_KEY, METRICS_STATE, CommandTracker, new_cid
+from api.device_commands import hardware_payload
+from api.device_twin import RECONCILE_CID_PREFIX, Reconciler, divergence
+from api.expressions import JSONMerge
+from api import shared_state
 from api.models import Device
+from api.mqtt_client import command_qos
+from api.rules import RuleEngine, fire as fire_rules
+from api.scheduler import Scheduler, fire as fire_schedules
+from api.device_state import map_standard_key, merge_state, remap_state, type_controls
+from api.signals import device_status_changed
 from django.utils import timezone
 from datetime import timedelta
 
@@ -12,6 +23,17 @@ logger = logging.getLogger(__name__)
 class Command(BaseCommand):
     help = 'Starts the MQTT Listener to process device updates and monitor offline status'
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Published commands awaiting a confirming state report
+        self.tracker = CommandTracker()
+        # Resend schedule for devices whose reports diverge from desired_state
+        self.reconciler = Reconciler()
+        # Automation rules indexed by (device, metric), reloaded when they change
+        self.rules = RuleEngine()
+        # Cron and sunrise/sunset schedules, in a heap ordered by next run
+        self.scheduler = Scheduler()
+
     def handle(self, *args, **options):
         client = mqtt.Client()
         client.on_connect = self.on_connect
@@ -24,9 +46,20 @@ class Command(BaseCommand):
             
             self.stdout.write(self.style.SUCCESS('MQTT Listener running. Monitoring device heartbeats...'))
             
+            next_check = time.monotonic()
             while True:
-                self.check_offline_devices()
-                time.sleep(10) # Check every 10 seconds
+                if time.monotonic() >= next_check:
+                    self.check_offline_devices()
+                    purge_expired()
+                    self.publish_command_metrics()
+                    next_check = time.monotonic() + 10 # Check every 10 seconds
+                self.run_schedules()
+                # Sleep until the next check, the next scheduled run or the next schedule reload check
+                delays = [next_check - time.monotonic(), self.scheduler.reload_interval]
+                until_run = self.scheduler.seconds_until_next()
+                if until_run is not None:
+                    delays.append(until_run)
+                time.sleep(max(0, min(delays)))
                 
         except KeyboardInterrupt:
             client.loop_stop()
@@ -50,11 +83,19 @@ class Command(BaseCommand):
             self.stdout.write(self.style.WARNING(f"Device {device.name} timed out. Marking OFFLINE."))
             device.status = Device.STATUS_OFFLINE
             device.save(update_fields=['status'])
+            device_status_changed.send(sender=Device, device=device, previous=Device.STATUS_ONLINE)
+
+    def publish_command_metrics(self):
+        """Time out unconfirmed commands and share the metrics with the API (in the database)."""
+        expired = self.tracker.expire()
+        if expired:
+            self.stdout.write(self.style.WARNING(f"{expired} command(s) not confirmed in time"))
+        shared_state.publish(METRICS_STATE, self.tracker.snapshot())
 
     def on_connect(self, client, userdata, flags, rc):
         if rc == 0:
-            self.stdout.write(self.style.SUCCESS('Connected to MQTT Broker! Subscribing to homeforge/devices/+/state'))
-            client.subscribe("homeforge/devices/+/state")
+            self.stdout.write(self.style.SUCCESS('Connected to MQTT Broker! Subscribing to homeforge/devices/+/state and +/command'))
+            client.subscribe([("homeforge/devices/+/state", 0), ("homeforge/devices/+/command", 0)])
         else:
             self.stdout.write(self.style.ERROR(f'Connection failed with code {rc}'))
 
@@ -77,14 +118,25 @@ class Command(BaseCommand):
                 self.stdout.write(self.style.WARNING(f"Invalid JSON from device {device_mac_from_topic}"))
                 return
 
+            if parts[3] == 'command':
+                # Published by the API; wait for the device to confirm it
+                if isinstance(data, dict):
+                    self.tracker.track(device_mac_from_topic, data)
+                    if not str(data.get(CID_KEY, '')).startswith(RECONCILE_CID_PREFIX):
+                        self.reconciler.command_sent(device_mac_from_topic)
+                return
+
             # Intelligent Device Matching Logic
+            # Only identity columns and desired_state are loaded; current_state is merged by the database
+            devices = Device.objects.only('id', 'name', 'status', 'device_type', 'mac_address', 'desired_state')
+
             # 1. Try to find device by MAC address (most reliable)
-            device = Device.objects.filter(mac_address=device_mac_from_topic).first()
+            device = devices.filter(mac_address=device_mac_from_topic).first()
             
             # 2. If not found by MAC, try to find by IP address reported in payload (auto-discovery/binding)
             if not device and "ip" in data:
                 reported_ip = data["ip"]
-                device = Device.objects.filter(ip_address=reported_ip).first()
+                device = devices.filter(ip_address=reported_ip).first()
                 if device:
                     self.stdout.write(self.style.SUCCESS(f"Auto-binding MAC {device_mac_from_topic} to Device {device.name} (IP: {reported_ip})"))
                     device.mac_address = device_mac_from_topic
@@ -94,96 +146,89 @@ class Command(BaseCommand):
                 self.stdout.write(self.style.WARNING(f"Device with MAC {device_mac_from_topic} or IP {data.get('ip')} not found in DB."))
                 return
 
-            # Update current_state with new data (merge)
-            current_state = device.current_state or {}
-            
-            # Filter out system keys from state blob if desired, or keep them for display
-            # We generally want to merge sensor data: temp, humidity, etc.
-            
             # --- Auto-Mapping Logic ---
             # Firmware sends: {"temperature": 25.5, "humidity": 60}
             # Device Type has widgets mapped to: "temperature-1771357525497" and "humidity-1771357528548"
-            # We need to find which widget corresponds to the incoming key based on widget_type.
-            
-            remapped_data = {}
-            for key, value in data.items():
-                # Try to map "standard" keys to "dynamic" keys first
-                mapped_key = self.map_standard_key(device, key)
-                
-                if mapped_key:
-                    # If we found a mapping (e.g. relay_1 -> switch-123), use that
-                    remapped_data[mapped_key] = value
-                    self.stdout.write(f"Mapped incoming '{key}' -> '{mapped_key}'")
-                    
-                    # Also REMOVE the old standard key if it exists in current_state to avoid duplicates
-                    if key in current_state and key != mapped_key:
-                        try:
-                            del current_state[key]
-                        except KeyError:
-                            pass
-                
-                # If no mapping found, check if it's already a known key
-                elif key in current_state:
-                    remapped_data[key] = value
-                
-                # Otherwise keep as new unmapped data
-                else:
-                    remapped_data[key] = value
+            # remap_state stores values under those keys and drops the standard
+            # keys so they do not linger as duplicates.
+            controls = type_controls(device.device_type_id)
+            delta, remove = remap_state(controls, data)
+            for key in remove:
+                self.stdout.write(f"Mapped incoming '{key}' -> '{map_standard_key(controls, key)}'")
 
-            current_state.update(remapped_data)
-            device.current_state = current_state
-            
-            # Mark as Online
-            if device.status != 'online':
-                device.status = 'online'
+            if device.status != Device.STATUS_ONLINE:
+                # Coming back online: deliver what was queued while it was away,
+                # and give it time to apply before reconciling desired_state
+                if self.flush_queue(client, device_mac_from_topic, device):
+                    self.reconciler.command_sent(device_mac_from_topic)
+
+            # Firmware keys (relay_1) and the mapped ones (switch-...) can both confirm a command
+            report = {**data, **delta}
+            diverged, confirmed = divergence(device.desired_state, report)
+            resend, abandoned = self.reconciler.plan(device_mac_from_topic, diverged)
+            expired = self.reconciler.expired(device_mac_from_topic, device.desired_state, report)
+            twin_fields = {}
+            if confirmed or abandoned or expired:
+                twin_fields['desired_state'] = JSONMerge('desired_state', {}, confirmed | abandoned | expired)
+
+            # One UPDATE: merge the delta server-side and mark online. Only
+            # telemetry columns are written, so concurrent edits to name, room
+            # or icon are kept, and caches that render the device set ignore it.
+            merge_state(Device.objects.filter(pk=device.pk), delta, remove, status=Device.STATUS_ONLINE, **twin_fields)
+            self.tracker.confirm(device_mac_from_topic, report)
+            self.rules.refresh()
+            fired = self.rules.evaluate(device.id, report)
+            if fired:
+                self.run_rules(fired)
+            if resend:
+                self.resend(client, device_mac_from_topic, resend)
+            if abandoned:
+                self.stdout.write(self.style.WARNING(
+                    f"Device {device.name} did not apply {sorted(abandoned)} after "
+                    f"{self.reconciler.max_attempts} resends; giving up"
+                ))
+            if expired:
+                self.stdout.write(f"Device {device.name} never reported {sorted(expired)}; dropped from desired_state")
+            if device.status != Device.STATUS_ONLINE:
                 self.stdout.write(self.style.SUCCESS(f"Device {device.name} is now ONLINE"))
-            
-            device.save()
+                previous_status = device.status
+                device.status = Device.STATUS_ONLINE
+                device_status_changed.send(sender=Device, device=device, previous=previous_status)
             self.stdout.write(self.style.SUCCESS(f"Updated Device {device.name} state"))
 
         except Exception as e:
             self.stdout.write(self.style.ERROR(f"Error processing message: {e}"))
 
-    def map_standard_key(self, device, key):
-        """
-        Map standard firmware keys (temperature, humidity, relay_1) to dynamic widget IDs.
-        """
-        # Load the device's type definition
-        try:
-            # We need to access the related CardTemplate -> Controls
-            # This requires 'device_type' and 'card_template' relation prefetching or simple queries
-            # Since this is a management command loop, separate queries per message are acceptable for low volume.
-            # Ideally caches would be used.
-            
-            # Get the CustomDeviceType
-            dev_type = device.device_type
-            if not hasattr(dev_type, 'card_template'):
-                return None
-                
-            template = dev_type.card_template
-            controls = template.controls.all() # Fetch all controls
-            
-        except Exception:
-            return None
-        
-        # MAPPING RULES: firmware_key -> Widget Type
-        target_types = []
-        
-        if key == "temperature":
-            target_types = ['TEMPERATURE', 'GAUGE']
-        elif key == "humidity":
-            target_types = ['HUMIDITY', 'GAUGE']
-        elif key == "pressure":
-            target_types = ['PRESSURE', 'GAUGE']
-        elif key == "relay_1" or key.startswith("switch-"):
-            target_types = ['TOGGLE', 'BUTTON']
-        
-        if not target_types:
-            return None
-            
-        # Find the first control that matches one of the target types
-        for control in controls:
-            if control.widget_type in target_types:
-                return control.variable_mapping
-                
-        return None
+    def flush_queue(self, client, mac, device):
+        """Publish the device's queued commands as one payload. Returns how many were merged."""
+        payload, count = take_queued(device.id)
+        if count:
+            self.stdout.write(self.style.SUCCESS(f"Delivering {count} queued command(s) to {device.name}"))
+            client.publish(
+                f"homeforge/devices/{mac}/command", json.dumps({**payload, CID_KEY: new_cid()}), qos=command_qos(),
+            )
+        return count
+
+    def resend(self, client, mac, values):
+        """Re-publish the keys a device has not applied (reconciliation)."""
+        payload = {**hardware_payload(values), CID_KEY: RECONCILE_CID_PREFIX + new_cid()}
+        self.stdout.write(f"Reconciling {mac}: resending {sorted(values)}")
+        client.publish(f"homeforge/devices/{mac}/command", json.dumps(payload), qos=command_qos())
+
+    def run_rules(self, rules):
+        """Send the actions of the automation rules a report fired."""
+        for rule in rules:
+            self.stdout.write(self.style.SUCCESS(f"Rule '{rule.name}' fired ({rule.metric} {rule.op} {rule.threshold})"))
+        fire_rules(rules)
+
+    def run_schedules(self):
+        """Run the schedules that are due, then pick up schedule changes made through the API."""
+        due = self.scheduler.due()
+        if due:
+            for schedule in due:
+                self.stdout.write(self.style.SUCCESS(f"Schedule '{schedule.name}' running"))
+            try:
+                fire_schedules(due)
+            except Exception as e:
+                self.stdout.write(self.style.ERROR(f"Error running schedules: {e}"))
+        self.scheduler.refresh()
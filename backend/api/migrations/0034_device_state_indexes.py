@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-19 03:40
+
+import api.expressions
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0033_device_list_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='device',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['current_state'], name='device_state_gin_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='device',
+            index=models.Index(api.expressions.JSONNumber('current_state', models.Value('battery')), name='device_state_battery_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='device',
+            index=models.Index(api.expressions.JSONNumber('current_state', models.Value('temperature')), name='device_state_temperature_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='device',
+            index=models.Index(api.expressions.JSONNumber('current_state', models.Value('humidity')), name='device_state_humidity_idx'),
+        ),
+    ]
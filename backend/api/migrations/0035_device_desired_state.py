@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 03:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0034_device_state_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='device',
+            name='desired_state',
+            field=models.JSONField(blank=True, default=dict, help_text='Commanded values the device has not confirmed yet (api/device_twin.py)'),
+        ),
+    ]
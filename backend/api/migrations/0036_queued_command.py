@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-19 03:24
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0035_device_desired_state'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueuedCommand',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('payload', models.JSONField(help_text='Firmware payload (after the relay_1 compatibility mapping)')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('expires_at', models.DateTimeField(db_index=True)),
+                ('device', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='queued_commands', to='api.device')),
+            ],
+            options={
+                'ordering': ['id'],
+                'indexes': [models.Index(fields=['device', 'id'], name='queuedcommand_device_idx')],
+            },
+        ),
+    ]
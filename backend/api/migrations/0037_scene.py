@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-19 03:28
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0036_queued_command'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Scene',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('icon', models.CharField(blank=True, default='fa-magic', help_text='FontAwesome icon class', max_length=50)),
+                ('actions', models.JSONField(default=list, help_text='[{"device": <id>, "state": {...}}]')),
+                ('plan', models.JSONField(blank=True, default=list, help_text='Compiled publish plan (api/scenes.py)')),
+                ('compiled_at', models.DateTimeField(blank=True, null=True)),
+                ('last_activated_at', models.DateTimeField(blank=True, null=True)),
+                ('last_activation_ms', models.FloatField(blank=True, help_text='Server-side latency of the last activation', null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('devices', models.ManyToManyField(blank=True, help_text='Devices in the plan (for recompiling it when they change)', related_name='scenes', to='api.device')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='scenes', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['name'],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 03:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0037_scene'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scene',
+            name='snapshot',
+            field=models.BooleanField(default=False, help_text='Captured from live device state rather than authored'),
+        ),
+    ]
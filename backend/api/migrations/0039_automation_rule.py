@@ -0,0 +1,39 @@
+# Generated by Django 5.2.18 on 2026-10-19 03:37
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0038_scene_snapshot'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AutomationRule',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('enabled', models.BooleanField(default=True)),
+                ('metric', models.CharField(help_text='State key compared (firmware key or variable_mapping)', max_length=100)),
+                ('operator', models.CharField(choices=[('gt', '>'), ('gte', '>='), ('lt', '<'), ('lte', '<='), ('eq', '=')], max_length=3)),
+                ('threshold', models.JSONField(help_text="Number for comparisons; any value for '='")),
+                ('hysteresis', models.FloatField(default=0, help_text='Distance back past the threshold before the rule can fire again')),
+                ('cooldown', models.PositiveIntegerField(default=60, help_text='Minimum seconds between firings')),
+                ('action_state', models.JSONField(blank=True, default=dict)),
+                ('last_fired_at', models.DateTimeField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('action_device', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='triggered_by_rules', to='api.device')),
+                ('action_scene', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='automation_rules', to='api.scene')),
+                ('device', models.ForeignKey(help_text='Device whose reports trigger the rule', on_delete=django.db.models.deletion.CASCADE, related_name='automation_rules', to='api.device')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='automation_rules', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['name'],
+            },
+        ),
+    ]
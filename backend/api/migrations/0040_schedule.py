@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-19 03:41
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0039_automation_rule'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Schedule',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('enabled', models.BooleanField(default=True)),
+                ('kind', models.CharField(choices=[('cron', 'Cron'), ('sunrise', 'Sunrise'), ('sunset', 'Sunset')], default='cron', max_length=10)),
+                ('cron', models.CharField(blank=True, help_text='minute hour day-of-month month day-of-week', max_length=100)),
+                ('offset', models.IntegerField(default=0, help_text='Minutes after (negative: before) sunrise/sunset')),
+                ('action_state', models.JSONField(blank=True, default=dict)),
+                ('last_run_at', models.DateTimeField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('action_device', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='schedules', to='api.device')),
+                ('action_scene', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='schedules', to='api.scene')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='schedules', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['name'],
+            },
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-19 04:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0040_schedule'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SharedState',
+            fields=[
+                ('name', models.CharField(max_length=100, primary_key=True, serialize=False)),
+                ('generation', models.BigIntegerField(default=0)),
+                ('data', models.JSONField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
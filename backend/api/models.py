@@ -1,10 +1,13 @@
 from django.db import models
 from django.conf import settings
+from django.contrib.postgres.indexes import GinIndex
 from django.dispatch import receiver
 from django.db.models.signals import post_save, pre_save
 import os
 import uuid
 
+from .expressions import JSONNumber
+
 def avatar_upload_path(instance, filename):
     """Generate a unique path for the avatar using UUID."""
     ext = filename.split('.')[-1]
@@ -75,6 +78,11 @@ class Room(models.Model):
         return f"{self.name} ({self.user.username})"
 
 
+# current_state keys whose numeric value has an expression index, for range
+# filters such as ?state.battery__lt=20 (api/device_query.py)
+STATE_INDEXED_KEYS = ('battery', 'temperature', 'humidity')
+
+
 class Device(models.Model):
     STATUS_ONLINE = 'online'
     STATUS_OFFLINE = 'offline'
@@ -94,6 +102,7 @@ class Device(models.Model):
     room = models.ForeignKey(Room, on_delete=models.SET_NULL, null=True, blank=True, related_name='devices')
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='devices', db_index=True)
     current_state = models.JSONField(default=dict, blank=True, help_text="Current state of device controls (e.g., {'relay_1': True})")
+    desired_state = models.JSONField(default=dict, blank=True, help_text="Commanded values the device has not confirmed yet (api/device_twin.py)")
     updated_at = models.DateTimeField(auto_now=True, help_text="Last time the device reported state")
 
     class Meta:
@@ -102,6 +111,18 @@ class Device(models.Model):
             models.Index(fields=['user', 'status'], name='device_user_status_idx'),
             models.Index(fields=['room'], name='device_room_idx'),
             models.Index(fields=['device_type'], name='device_type_idx'),
+            # Device list filters, ordering and group_by (api/device_query.py)
+            models.Index(fields=['name'], name='device_name_idx'),
+            models.Index(fields=['room', 'name'], name='device_room_name_idx'),
+            models.Index(fields=['device_type', 'name'], name='device_type_name_idx'),
+            models.Index(fields=['status', 'name'], name='device_status_name_idx'),
+            # current_state filters: equality (@>) and key existence (?) on any
+            # key, numeric ranges on the standard firmware keys
+            GinIndex(fields=['current_state'], name='device_state_gin_idx'),
+            *[
+                models.Index(JSONNumber('current_state', models.Value(key)), name=f'device_state_{key}_idx')
+                for key in STATE_INDEXED_KEYS
+            ],
         ]
 
     def __str__(self):
@@ -455,3 +476,142 @@ class DashboardLayout(models.Model):
     @property
     def is_personal(self):
         return self.user is not None
+
+
+class QueuedCommand(models.Model):
+    """
+    A command for a device that was offline when it was sent. The MQTT listener
+    publishes a device's unexpired commands as one merged payload when it comes
+    back online (api/command_queue.py).
+    """
+    device = models.ForeignKey(Device, on_delete=models.CASCADE, related_name='queued_commands')
+    payload = models.JSONField(help_text="Firmware payload (after the relay_1 compatibility mapping)")
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['device', 'id'], name='queuedcommand_device_idx'),
+        ]
+
+    def __str__(self):
+        return f"Queued for {self.device_id}: {self.payload}"
+
+
+class Scene(models.Model):
+    """
+    A named set of device states applied together ("Movie night").
+
+    ``actions`` is what the user configured; ``plan`` is compiled from it at
+    save time (api/scenes.py) with each target's MAC and firmware payload, so
+    activation publishes without loading the devices.
+    """
+    name = models.CharField(max_length=100, unique=True)
+    icon = models.CharField(max_length=50, default='fa-magic', blank=True, help_text="FontAwesome icon class")
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True, related_name='scenes')
+    actions = models.JSONField(default=list, help_text='[{"device": <id>, "state": {...}}]')
+    devices = models.ManyToManyField(Device, related_name='scenes', blank=True, help_text="Devices in the plan (for recompiling it when they change)")
+    plan = models.JSONField(default=list, blank=True, help_text="Compiled publish plan (api/scenes.py)")
+    snapshot = models.BooleanField(default=False, help_text="Captured from live device state rather than authored")
+    compiled_at = models.DateTimeField(null=True, blank=True)
+    last_activated_at = models.DateTimeField(null=True, blank=True)
+    last_activation_ms = models.FloatField(null=True, blank=True, help_text="Server-side latency of the last activation")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['name']
+
+    def __str__(self):
+        return self.name
+
+
+class AutomationRule(models.Model):
+    """
+    "If <metric> of <device> crosses <threshold>, apply <state> to a device (or
+    activate a scene)". Evaluated by the MQTT listener on every state report
+    (api/rules.py).
+    """
+    OP_GT = 'gt'
+    OP_GTE = 'gte'
+    OP_LT = 'lt'
+    OP_LTE = 'lte'
+    OP_EQ = 'eq'
+    OPERATOR_CHOICES = [
+        (OP_GT, '>'),
+        (OP_GTE, '>='),
+        (OP_LT, '<'),
+        (OP_LTE, '<='),
+        (OP_EQ, '='),
+    ]
+
+    name = models.CharField(max_length=100)
+    enabled = models.BooleanField(default=True)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True, related_name='automation_rules')
+    device = models.ForeignKey(Device, on_delete=models.CASCADE, related_name='automation_rules', help_text="Device whose reports trigger the rule")
+    metric = models.CharField(max_length=100, help_text="State key compared (firmware key or variable_mapping)")
+    operator = models.CharField(max_length=3, choices=OPERATOR_CHOICES)
+    threshold = models.JSONField(help_text="Number for comparisons; any value for '='")
+    hysteresis = models.FloatField(default=0, help_text="Distance back past the threshold before the rule can fire again")
+    cooldown = models.PositiveIntegerField(default=60, help_text="Minimum seconds between firings")
+    action_device = models.ForeignKey(Device, on_delete=models.CASCADE, null=True, blank=True, related_name='triggered_by_rules')
+    action_state = models.JSONField(default=dict, blank=True)
+    action_scene = models.ForeignKey('Scene', on_delete=models.CASCADE, null=True, blank=True, related_name='automation_rules')
+    last_fired_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['name']
+
+    def __str__(self):
+        return self.name
+
+
+class Schedule(models.Model):
+    """
+    Applies a state to a device (or activates a scene) at times given by a cron
+    expression or relative to sunrise/sunset. Run by the MQTT listener
+    (api/scheduler.py).
+    """
+    KIND_CRON = 'cron'
+    KIND_SUNRISE = 'sunrise'
+    KIND_SUNSET = 'sunset'
+    KIND_CHOICES = [
+        (KIND_CRON, 'Cron'),
+        (KIND_SUNRISE, 'Sunrise'),
+        (KIND_SUNSET, 'Sunset'),
+    ]
+
+    name = models.CharField(max_length=100)
+    enabled = models.BooleanField(default=True)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True, related_name='schedules')
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES, default=KIND_CRON)
+    cron = models.CharField(max_length=100, blank=True, help_text="minute hour day-of-month month day-of-week")
+    offset = models.IntegerField(default=0, help_text="Minutes after (negative: before) sunrise/sunset")
+    action_device = models.ForeignKey(Device, on_delete=models.CASCADE, null=True, blank=True, related_name='schedules')
+    action_state = models.JSONField(default=dict, blank=True)
+    action_scene = models.ForeignKey('Scene', on_delete=models.CASCADE, null=True, blank=True, related_name='schedules')
+    last_run_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['name']
+
+    def __str__(self):
+        return self.name
+
+
+class SharedState(models.Model):
+    """
+    A named row shared by the web workers and the MQTT listener, which do not
+    share a cache: the generation of cached resources invalidated or read
+    across processes, and snapshots the listener publishes for the API
+    (api/shared_state.py).
+    """
+    name = models.CharField(max_length=100, primary_key=True)
+    generation = models.BigIntegerField(default=0)
+    data = models.JSONField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name} (generation {self.generation})"
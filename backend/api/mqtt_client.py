@@ -1,45 +1,182 @@
-import paho.mqtt.client as mqtt
+"""
+Publishing device commands to the MQTT broker from the web workers.
+
+``mqtt_client.publish()`` never touches the network in the calling (request)
+thread: the command is put in a bounded in-memory outbox and handed to
+paho, whose network thread sends it. Connecting and reconnecting also happen
+on that thread (``connect_async`` + ``loop_start``), with paho's exponential
+backoff between attempts. While the broker is unreachable commands stay in
+the outbox and are flushed in order on reconnect; when the outbox is full the
+oldest command is dropped, and commands older than ``MQTT_OUTBOX_TTL`` are
+discarded instead of being delivered late. Each command gets a correlation
+ID (``_cid``, see ``api.command_tracking``).
+
+The connection is per process. Gunicorn forks its workers after importing
+the app, and a paho client (socket + network thread) does not survive a
+fork, so a forked child drops whatever it inherited and connects on its own
+first publish.
+"""
+import collections
 import json
 import logging
+import os
+import threading
+import time
+
+import paho.mqtt.client as mqtt
 from django.conf import settings
 
+from .command_queue import DELIVERY_QUEUE, DELIVERY_SESSION
+from .command_tracking import CID_KEY, new_cid
+
 logger = logging.getLogger(__name__)
 
 MQTT_BROKER = "localhost"
 MQTT_PORT = 1883
+MQTT_KEEPALIVE = 60
 MQTT_TOPIC_PREFIX = "homeforge/devices"
+# Backoff between reconnect attempts (seconds, doubled on each failure)
+RECONNECT_MIN_DELAY = 1
+RECONNECT_MAX_DELAY = 30
+
+
+# QoS the broker needs to hold commands for devices with a persistent session
+SESSION_QOS = 1
+
+
+def command_qos():
+    """
+    QoS of published device commands: ``MQTT_COMMAND_QOS`` (0 by default), or
+    ``SESSION_QOS`` with ``MQTT_OFFLINE_DELIVERY = 'session'``.
+    """
+    if getattr(settings, 'MQTT_OFFLINE_DELIVERY', DELIVERY_QUEUE) == DELIVERY_SESSION:
+        return SESSION_QOS
+    return getattr(settings, 'MQTT_COMMAND_QOS', 0)
+
+
+def _create_client():
+    return mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+
 
-class MQTTClient:
-    _instance = None
-
-    def __new__(cls):
-        if cls._instance is None:
-            cls._instance = super(MQTTClient, cls).__new__(cls)
-            cls._instance.client = mqtt.Client()
-            cls._instance.connected = False
-        return cls._instance
-
-    def connect(self):
-        if not self.connected:
-            try:
-                self.client.connect(MQTT_BROKER, MQTT_PORT, 60)
-                self.client.loop_start()
-                self.connected = True
-                logger.info("Connected to MQTT Broker")
-            except Exception as e:
-                logger.error(f"Failed to connect to MQTT Broker: {e}")
+class MQTTPublisher:
+    """
+    Non-blocking command publisher with a per-process connection.
+
+    ``client_factory`` builds the paho client (tests pass a fake one).
+    """
+
+    def __init__(self, client_factory=_create_client):
+        self.client_factory = client_factory
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _after_fork(self):
+        # A new lock: another thread may have held the parent's at fork time
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        """Forget the connection and the outbox (they belong to another process)."""
+        self._pid = os.getpid()
+        self.client = None
+        self.connected = False
+        self._outbox = collections.deque(maxlen=getattr(settings, 'MQTT_OUTBOX_SIZE', 1000))
+        self._counters = collections.Counter()
+
+    def _ensure_client(self):
+        """Start this process's client if needed. Called with the lock held."""
+        if self._pid != os.getpid():
+            # Forked without running the at-fork hook
+            self._reset()
+        if self.client is not None:
+            return
+        client = self.client_factory()
+        client.on_connect = self._on_connect
+        client.on_disconnect = self._on_disconnect
+        client.reconnect_delay_set(min_delay=RECONNECT_MIN_DELAY, max_delay=RECONNECT_MAX_DELAY)
+        try:
+            client.connect_async(MQTT_BROKER, MQTT_PORT, MQTT_KEEPALIVE)
+            client.loop_start()
+        except Exception as e:
+            logger.error(f"Failed to start MQTT publisher: {e}")
+            return
+        self.client = client
+
+    def _on_connect(self, client, userdata, flags, reason_code, properties=None):
+        if getattr(reason_code, 'is_failure', False):
+            logger.warning(f"MQTT broker refused connection: {reason_code}")
+            return
+        with self._lock:
+            self.connected = True
+            self._counters['connects'] += 1
+            queued = len(self._outbox)
+            self._flush()
+        logger.info(f"Connected to MQTT Broker (pid {self._pid}), flushed {queued} queued command(s)")
+
+    def _on_disconnect(self, client, userdata, flags, reason_code, properties=None):
+        with self._lock:
+            self.connected = False
+        logger.warning(f"Disconnected from MQTT Broker: {reason_code}; reconnecting in the background")
+
+    def _flush(self):
+        """Hand queued commands to paho, oldest first. Called with the lock held."""
+        ttl = getattr(settings, 'MQTT_OUTBOX_TTL', 60)
+        now = time.monotonic()
+        while self._outbox and self.connected:
+            topic, payload, queued_at = self._outbox[0]
+            if ttl and now - queued_at > ttl:
+                self._outbox.popleft()
+                self._counters['expired'] += 1
+                continue
+            info = self.client.publish(topic, payload, qos=command_qos())
+            if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                # Connection lost mid-flush; keep the command for the next connect
+                break
+            self._outbox.popleft()
+            self._counters['published'] += 1
 
     def publish(self, device_id, command_data):
         """
-        Publish a command to a device.
+        Queue a command for a device and send it if the broker is connected.
         Topic: homeforge/devices/{device_id}/command
         """
-        if not self.connected:
-            self.connect()
-        
-        topic = f"{MQTT_TOPIC_PREFIX}/{device_id}/command"
-        payload = json.dumps(command_data)
-        self.client.publish(topic, payload)
-        logger.info(f"Published to {topic}: {payload}")
-
-mqtt_client = MQTTClient()
+        self.publish_many([(device_id, command_data)])
+
+    def publish_many(self, commands):
+        """Queue ``[(device_id, command_data)]`` in order and flush them together."""
+        # Every command carries a correlation ID for acknowledgement tracking
+        messages = [
+            (f"{MQTT_TOPIC_PREFIX}/{device_id}/command", json.dumps({**command_data, CID_KEY: new_cid()}))
+            for device_id, command_data in commands
+        ]
+        with self._lock:
+            self._ensure_client()
+            queued_at = time.monotonic()
+            for topic, payload in messages:
+                if len(self._outbox) == self._outbox.maxlen:
+                    self._counters['dropped'] += 1
+                    logger.warning(f"MQTT outbox full, dropping oldest command to {self._outbox[0][0]}")
+                self._outbox.append((topic, payload, queued_at))
+            if self.client is not None:
+                self._flush()
+            queued = len(self._outbox)
+        for topic, payload in messages:
+            logger.info(f"Publishing to {topic}: {payload}")
+        if queued:
+            logger.info(f"{queued} command(s) queued until the broker is reachable")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "pid": self._pid,
+                "connected": self.connected,
+                "queued": len(self._outbox),
+                "outbox_size": self._outbox.maxlen,
+                **{key: self._counters[key] for key in ('published', 'dropped', 'expired', 'connects')},
+            }
+
+
+mqtt_client = MQTTPublisher()
+if hasattr(os, 'register_at_fork'):
+    # Once, for the process-wide instance: a hook per instance would never be released
+    os.register_at_fork(after_in_child=mqtt_client._after_fork)
@@ -0,0 +1,185 @@
+"""
+Automation rules evaluated on incoming telemetry.
+
+The MQTT listener owns one ``RuleEngine``. It holds every enabled
+``AutomationRule`` compiled into a ``CompiledRule``, indexed by
+``(device ID, metric)``, so a state report only evaluates the rules that
+reference one of its keys: the cost per message is one dict lookup per
+reported key, whatever the number of rules loaded
+(``python manage.py benchmark_rules``).
+
+A rule fires when its condition becomes true, then disarms until the value
+has moved back past the threshold by ``hysteresis`` (a humidity rule at
+``> 70`` with hysteresis 5 fires again only after humidity dropped to 65).
+``cooldown`` is the minimum time between two firings. Arming state lives in
+the listener process and survives reloads.
+
+Actions are compiled like scene plans (``api.scenes.compile_action``): the
+target's MAC and firmware payload, or the plan of the scene to activate.
+``fire`` sends them through ``api.scenes.send_plan`` (queued for offline
+devices, published in one batch through the coalescer otherwise).
+
+Rules reload when the ``automation_rules`` generation moves (rule, device or
+scene changes), checked at most every ``RULES_RELOAD_INTERVAL`` seconds. The
+generation is a database row (``CachedResource(shared=True)``), so changes
+made through the API reach the listener whatever the cache backend.
+"""
+import operator
+import time
+
+from django.conf import settings
+from django.utils import timezone
+
+from .caching import automation_rules
+from .command_tracking import normalize_value
+from .models import AutomationRule
+from .scenes import compile_action, offline_targets, send_plan
+
+COMPARISONS = {
+    AutomationRule.OP_GT: operator.gt,
+    AutomationRule.OP_GTE: operator.ge,
+    AutomationRule.OP_LT: operator.lt,
+    AutomationRule.OP_LTE: operator.le,
+}
+# Operators that fire on rising values: they re-arm below the threshold
+RISING = {AutomationRule.OP_GT, AutomationRule.OP_GTE}
+
+
+def _number(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return value
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class CompiledRule:
+    """A rule's condition, its arming state and its compiled sends ``[(plan entry, state, payload)]``."""
+    __slots__ = ('id', 'name', 'device', 'metric', 'op', 'compare', 'threshold', 'hysteresis', 'cooldown',
+                 'sends', 'armed', 'last_fired')
+
+    def __init__(self, id, name, device, metric, op, threshold, hysteresis=0, cooldown=0, sends=()):
+        self.id = id
+        self.name = name
+        self.device = device
+        self.metric = metric
+        self.op = op
+        self.compare = COMPARISONS.get(op)
+        self.threshold = threshold if self.compare else normalize_value(threshold)
+        self.hysteresis = hysteresis
+        self.cooldown = cooldown
+        self.sends = list(sends)
+        self.armed = True
+        self.last_fired = None
+
+    def update(self, value, now):
+        """Feed a reported value. Returns True when the rule fires."""
+        if self.compare is None:
+            met = normalize_value(value) == self.threshold
+            rearm = not met
+        else:
+            number = _number(value)
+            if number is None:
+                return False
+            met = self.compare(number, self.threshold)
+            if self.op in RISING:
+                rearm = not met and number <= self.threshold - self.hysteresis
+            else:
+                rearm = not met and number >= self.threshold + self.hysteresis
+        if not self.armed:
+            self.armed = rearm
+            return False
+        if not met:
+            return False
+        if self.last_fired is not None and now - self.last_fired < self.cooldown:
+            # Stays armed: fires on the first report meeting the condition after the cooldown
+            return False
+        self.armed = False
+        self.last_fired = now
+        return True
+
+
+def compile_rule(rule):
+    """A ``CompiledRule`` from an ``AutomationRule`` loaded with its action device and scene."""
+    return CompiledRule(
+        rule.id, rule.name, rule.device_id, rule.metric, rule.operator, rule.threshold,
+        hysteresis=rule.hysteresis, cooldown=rule.cooldown, sends=compile_action(rule),
+    )
+
+
+def load_rules():
+    """Every enabled rule, compiled, from one query."""
+    rules = (
+        AutomationRule.objects.filter(enabled=True)
+        .select_related('action_device', 'action_scene')
+        .only(
+            'id', 'name', 'device', 'metric', 'operator', 'threshold', 'hysteresis', 'cooldown',
+            'action_device', 'action_state', 'action_scene',
+            'action_device__name', 'action_device__mac_address', 'action_scene__plan',
+        )
+    )
+    return [compile_rule(rule) for rule in rules]
+
+
+class RuleEngine:
+    def __init__(self, loader=load_rules, reload_interval=None, clock=time.monotonic):
+        self.loader = loader
+        self.reload_interval = (
+            reload_interval if reload_interval is not None else getattr(settings, 'RULES_RELOAD_INTERVAL', 2)
+        )
+        self.clock = clock
+        self.generation = None
+        self.checked_at = None
+        self.count = 0
+        self._index = {}
+
+    def load(self, rules):
+        """Replace the rules, keeping the arming state of the ones that remain."""
+        previous = {rule.id: rule for keyed in self._index.values() for rule in keyed}
+        index = {}
+        for rule in rules:
+            old = previous.get(rule.id)
+            if old is not None:
+                rule.armed, rule.last_fired = old.armed, old.last_fired
+            index.setdefault((rule.device, rule.metric), []).append(rule)
+        self._index = index
+        self.count = len(rules)
+
+    def refresh(self):
+        """Reload the rules if they changed, checking at most every ``reload_interval`` seconds."""
+        now = self.clock()
+        if self.checked_at is not None and now - self.checked_at < self.reload_interval:
+            return False
+        self.checked_at = now
+        generation = automation_rules.generation()
+        if generation == self.generation:
+            return False
+        self.load(self.loader())
+        self.generation = generation
+        return True
+
+    def evaluate(self, device_id, report):
+        """The rules fired by a device's state report."""
+        fired = []
+        now = self.clock()
+        index = self._index
+        for metric, value in report.items():
+            rules = index.get((device_id, metric))
+            if rules:
+                for rule in rules:
+                    if rule.update(value, now):
+                        fired.append(rule)
+        return fired
+
+
+def fire(rules):
+    """Send the actions of fired rules in one batch. Returns the send results."""
+    sends = [send for rule in rules for send in rule.sends]
+    if not sends:
+        return []
+    results = send_plan(sends, offline_targets([entry['device'] for entry, _, _ in sends]))
+    AutomationRule.objects.filter(pk__in=[rule.id for rule in rules]).update(last_fired_at=timezone.now())
+    return results
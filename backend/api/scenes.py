@@ -0,0 +1,216 @@
+"""
+Scenes: many device states applied with one request.
+
+A scene's ``actions`` (``[{"device": id, "state": {...}}]``) are compiled when
+the scene is saved into ``Scene.plan``: one entry per device with its MAC
+and the firmware payload after the ``relay_1`` compatibility mapping
+(``api.device_commands.hardware_payload``). ``activate_scene`` then works
+from the plan alone:
+
+- one query for which targets are offline (their commands are queued, see
+  ``api.command_queue``)
+- one UPDATE recording every target's desired state
+- one batch handed to the coalescer/publisher for the online targets
+
+``restore_scene`` sends only the keys that differ from the devices' present
+``current_state``, which suits snapshots (``snapshot_actions`` captures the
+present state of a room or the whole home).
+
+Plans follow the devices: saving a device (e.g. the listener binding its
+MAC) or deleting it recompiles the scenes that contain it.
+"""
+import time
+
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .caching import invalidate
+from .command_coalescer import command_coalescer
+from .command_queue import enqueue, queues_offline_commands
+from .command_tracking import normalize_value
+from .device_commands import NO_MAC_DETAIL, hardware_payload
+from .device_state import type_controls
+from .device_twin import record_desired_many
+from .models import Device, DeviceControl, Scene
+
+# Widget types whose values a snapshot captures
+SNAPSHOT_WIDGETS = (DeviceControl.WIDGET_TOGGLE, DeviceControl.WIDGET_SLIDER, DeviceControl.WIDGET_BUTTON)
+
+
+def plan_entry(device, state):
+    """One compiled command: the target's identity and MAC, the state and its firmware payload."""
+    return {
+        "device": device.id,
+        "name": device.name,
+        "mac": device.mac_address,
+        "state": state,
+        "payload": hardware_payload(state),
+    }
+
+
+def compile_scene(scene):
+    """Rebuild the scene's plan from its actions, dropping devices that no longer exist."""
+    ids = [action['device'] for action in scene.actions]
+    devices = Device.objects.only('id', 'name', 'mac_address').in_bulk(ids)
+    actions = [action for action in scene.actions if action['device'] in devices]
+    plan = [plan_entry(devices[action['device']], action['state']) for action in actions]
+    scene.actions, scene.plan, scene.compiled_at = actions, plan, timezone.now()
+    Scene.objects.filter(pk=scene.pk).update(actions=actions, plan=plan, compiled_at=scene.compiled_at)
+    scene.devices.set(list(devices))
+    # Automation rules and schedules that activate the scene carry a copy of its plan
+    invalidate('automation_rules', 'device_schedules')
+    return scene
+
+
+def compile_action(owner):
+    """
+    The sends ``[(plan entry, state, payload)]`` of an automation (rule or
+    schedule) that commands ``action_device`` with ``action_state`` or
+    activates ``action_scene``; both loaded with the owner.
+    """
+    if owner.action_scene_id:
+        return [(entry, entry['state'], entry['payload']) for entry in owner.action_scene.plan]
+    if owner.action_device_id:
+        entry = plan_entry(owner.action_device, owner.action_state)
+        return [(entry, entry['state'], entry['payload'])]
+    return []
+
+
+def offline_targets(device_ids):
+    """The IDs among ``device_ids`` whose commands must be queued rather than published."""
+    if not queues_offline_commands():
+        return set()
+    return set(
+        Device.objects.filter(pk__in=device_ids).exclude(status=Device.STATUS_ONLINE).values_list('id', flat=True)
+    )
+
+
+def send_plan(sends, offline):
+    """
+    Send ``[(plan entry, state, payload)]``: queue the commands of ``offline``
+    devices, record every state as desired and publish the rest in one batch.
+    Returns ``[{"id", "accepted", "queued", ("detail")}]``.
+    """
+    commands, queued, results = [], [], []
+    for entry, state, payload in sends:
+        if not entry['mac']:
+            results.append({"id": entry['device'], "accepted": False, "queued": False, "detail": NO_MAC_DETAIL})
+        elif entry['device'] in offline:
+            queued.append((entry['device'], payload))
+            results.append({"id": entry['device'], "accepted": True, "queued": True})
+        else:
+            # No coalescing window: each entry is one deliberate command to its device
+            commands.append((entry['mac'], payload, 0))
+            results.append({"id": entry['device'], "accepted": True, "queued": False})
+
+    record_desired_many({entry['device']: state for entry, state, _ in sends})
+    if queued:
+        enqueue(queued)
+    command_coalescer.submit_many(commands)
+    return results
+
+
+def _dispatch(scene, started, sends, offline):
+    results = send_plan(sends, offline)
+    latency_ms = round((time.perf_counter() - started) * 1000, 2)
+    scene.last_activated_at, scene.last_activation_ms = timezone.now(), latency_ms
+    Scene.objects.filter(pk=scene.pk).update(
+        last_activated_at=scene.last_activated_at, last_activation_ms=latency_ms,
+    )
+    return {
+        "latency_ms": latency_ms,
+        "accepted": sum(1 for result in results if result["accepted"]),
+        "results": results,
+    }
+
+
+def activate_scene(scene):
+    """
+    Send every command of the scene's plan. Returns ``{"latency_ms", "accepted",
+    "results": [{"id", "accepted", "queued", ("detail")}]}``.
+    """
+    started = time.perf_counter()
+    plan = scene.plan
+    offline = offline_targets([entry['device'] for entry in plan])
+    return _dispatch(scene, started, [(entry, entry['state'], entry['payload']) for entry in plan], offline)
+
+
+def state_diff(target, current):
+    """The keys of ``target`` whose value differs from ``current`` (missing keys differ)."""
+    return {
+        key: value for key, value in target.items()
+        if key not in current or normalize_value(current[key]) != normalize_value(value)
+    }
+
+
+def restore_scene(scene):
+    """
+    Send only what differs between the scene and the devices' present state:
+    per device the keys whose ``current_state`` value differs, and nothing to
+    devices already matching. The present state and status of all targets come
+    from one query. Returns ``activate_scene``'s result plus ``"unchanged"``
+    (IDs of the devices left alone).
+    """
+    started = time.perf_counter()
+    plan = scene.plan
+    present = {
+        pk: (state or {}, status) for pk, state, status in
+        Device.objects.filter(pk__in=[entry['device'] for entry in plan]).values_list('id', 'current_state', 'status')
+    }
+    sends, unchanged = [], []
+    for entry in plan:
+        current = present.get(entry['device'])
+        if current is None:
+            continue
+        diff = state_diff(entry['state'], current[0])
+        if diff:
+            sends.append((entry, diff, hardware_payload(diff)))
+        else:
+            unchanged.append(entry['device'])
+    offline = set()
+    if queues_offline_commands():
+        offline = {pk for pk, (_, status) in present.items() if status != Device.STATUS_ONLINE}
+    return {**_dispatch(scene, started, sends, offline), "unchanged": unchanged}
+
+
+def snapshot_actions(queryset):
+    """
+    Scene actions capturing the present state of the devices in ``queryset``,
+    from one query. Only values of the type's interactive controls (toggles,
+    sliders, buttons) are kept, so sensor readings are not replayed as
+    commands; a type without controls keeps its whole state. Devices with
+    nothing to capture are left out.
+    """
+    actions = []
+    rows = queryset.order_by('id').values_list('id', 'device_type_id', 'current_state')
+    for pk, device_type_id, state in rows:
+        state = state or {}
+        controls = type_controls(device_type_id) if device_type_id else []
+        if controls:
+            keys = {mapping for widget_type, mapping in controls if widget_type in SNAPSHOT_WIDGETS}
+            state = {key: value for key, value in state.items() if key in keys}
+        if state:
+            actions.append({"device": pk, "state": state})
+    return actions
+
+
+@receiver(post_save, sender=Device, dispatch_uid='scenes:device_saved')
+def _device_saved(sender, instance, created, update_fields=None, **kwargs):
+    # Status/state writes do not change the plan; MAC bindings and edits do
+    if created or (update_fields and 'mac_address' not in update_fields and 'name' not in update_fields):
+        return
+    for scene in instance.scenes.all():
+        compile_scene(scene)
+
+
+@receiver(pre_delete, sender=Device, dispatch_uid='scenes:device_deleting')
+def _device_deleting(sender, instance, **kwargs):
+    # The M2M rows are gone by post_delete
+    instance._scene_ids = list(instance.scenes.values_list('id', flat=True))
+
+
+@receiver(post_delete, sender=Device, dispatch_uid='scenes:device_deleted')
+def _device_deleted(sender, instance, **kwargs):
+    for scene in Scene.objects.filter(pk__in=getattr(instance, '_scene_ids', [])):
+        compile_scene(scene)
@@ -0,0 +1,269 @@
+"""
+Time-based schedules run by the MQTT listener.
+
+A ``Schedule`` fires at the times of a cron expression (evaluated in
+``TIME_ZONE``) or at sunrise/sunset plus an offset in minutes, computed for
+``HOME_LATITUDE``/``HOME_LONGITUDE``. Its action is compiled like a scene
+plan (``api.scenes.compile_action``) and sent through ``api.scenes.send_plan``.
+
+The listener keeps one ``Scheduler``: a heap of ``(next run, schedule)``.
+Between firings nothing is evaluated; the listener sleeps until the earliest
+run (or its next periodic check), pops the due schedules and pushes each one
+back with its following run. Schedule, device and scene changes bump the
+``device_schedules`` generation (a database row, so the listener sees it
+whatever the cache backend) and the heap is rebuilt within
+``RULES_RELOAD_INTERVAL`` seconds, so API changes apply without a restart.
+Runs missed while the listener was down are skipped, not caught up.
+
+Cron expressions have five fields (minute, hour, day of month, month, day of
+week with 0 or 7 = Sunday) made of ``*``, numbers, ranges ``a-b``, steps
+``/n`` and lists, plus the ``@hourly``, ``@daily``, ``@weekly``,
+``@monthly`` and ``@yearly`` aliases. As in cron, when both day fields are
+restricted a day matching either one matches.
+"""
+import heapq
+import math
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.utils import timezone
+
+from .caching import device_schedules
+from .models import Schedule
+from .scenes import compile_action, offline_targets, send_plan
+
+CRON_ALIASES = {
+    '@hourly': '0 * * * *',
+    '@daily': '0 0 * * *',
+    '@midnight': '0 0 * * *',
+    '@weekly': '0 0 * * 0',
+    '@monthly': '0 0 1 * *',
+    '@yearly': '0 0 1 1 *',
+    '@annually': '0 0 1 1 *',
+}
+# (name, lowest, highest) of the five cron fields
+CRON_FIELDS = (('minute', 0, 59), ('hour', 0, 23), ('day of month', 1, 31), ('month', 1, 12), ('day of week', 0, 7))
+# Candidate minutes examined before an expression is declared unsatisfiable (e.g. "0 0 30 2 *")
+CRON_SEARCH_LIMIT = 100000
+# Sun below the horizon at sunrise/sunset, allowing for refraction and the solar disc (degrees)
+SUN_ALTITUDE = -0.833
+J2000 = 2451545.0
+J2000_ORDINAL = date(2000, 1, 1).toordinal()
+
+
+def _int(text, name):
+    try:
+        return int(text)
+    except ValueError:
+        raise ValueError(f"{name}: '{text}' is not a number")
+
+
+def _parse_field(text, name, low, high):
+    values = set()
+    for part in text.split(','):
+        step = 1
+        if '/' in part:
+            part, step_text = part.split('/', 1)
+            step = _int(step_text, name)
+            if step < 1:
+                raise ValueError(f"{name}: step must be positive")
+        if part == '*':
+            start, end = low, high
+        elif '-' in part:
+            start, end = (_int(bound, name) for bound in part.split('-', 1))
+        else:
+            start = _int(part, name)
+            end = high if step > 1 else start
+        if not low <= start <= end <= high:
+            raise ValueError(f"{name}: {part} is outside {low}-{high}")
+        values.update(range(start, end + 1, step))
+    return frozenset(values)
+
+
+class CronExpression:
+    """A parsed five-field cron expression. Raises ValueError when invalid."""
+
+    def __init__(self, expression):
+        text = CRON_ALIASES.get(expression.strip().lower(), expression)
+        fields = text.split()
+        if len(fields) != 5:
+            raise ValueError("Expected 5 fields: minute hour day-of-month month day-of-week.")
+        parsed = [_parse_field(field, *spec) for field, spec in zip(fields, CRON_FIELDS)]
+        self.minutes, self.hours, self.days, self.months, weekdays = parsed
+        # Cron counts weekdays from Sunday (0 or 7), Python from Monday (0)
+        self.weekdays = frozenset((day - 1) % 7 for day in weekdays)
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+
+    def _day_matches(self, moment):
+        in_month = moment.day in self.days
+        in_week = moment.weekday() in self.weekdays
+        if self.any_day or self.any_weekday:
+            return in_month and in_week
+        return in_month or in_week
+
+    def next_after(self, moment, tz):
+        """The first matching minute after the aware datetime ``moment``, in ``tz``."""
+        local = moment.astimezone(tz).replace(tzinfo=None, second=0, microsecond=0) + timedelta(minutes=1)
+        for _ in range(CRON_SEARCH_LIMIT):
+            if local.month not in self.months:
+                local = (local.replace(day=1) + timedelta(days=32)).replace(day=1, hour=0, minute=0)
+            elif not self._day_matches(local):
+                local = local.replace(hour=0, minute=0) + timedelta(days=1)
+            elif local.hour not in self.hours:
+                local = local.replace(minute=0) + timedelta(hours=1)
+            elif local.minute not in self.minutes:
+                local += timedelta(minutes=1)
+            else:
+                return local.replace(tzinfo=tz)
+        raise ValueError("The expression never matches.")
+
+
+def sun_times(day, latitude, longitude):
+    """
+    ``(sunrise, sunset)`` in UTC on ``day`` (NOAA sunrise equation, accurate to
+    about a minute). ``(None, None)`` when the sun does not rise or set.
+    """
+    mean_solar_noon = day.toordinal() - J2000_ORDINAL - longitude / 360
+    anomaly = math.radians((357.5291 + 0.98560028 * mean_solar_noon) % 360)
+    center = 1.9148 * math.sin(anomaly) + 0.0200 * math.sin(2 * anomaly) + 0.0003 * math.sin(3 * anomaly)
+    ecliptic_longitude = math.radians((math.degrees(anomaly) + center + 180 + 102.9372) % 360)
+    transit = J2000 + mean_solar_noon + 0.0053 * math.sin(anomaly) - 0.0069 * math.sin(2 * ecliptic_longitude)
+    declination = math.asin(math.sin(ecliptic_longitude) * math.sin(math.radians(23.4397)))
+    phi = math.radians(latitude)
+    cos_hour_angle = (
+        (math.sin(math.radians(SUN_ALTITUDE)) - math.sin(phi) * math.sin(declination))
+        / (math.cos(phi) * math.cos(declination))
+    )
+    if not -1 <= cos_hour_angle <= 1:
+        return None, None
+    half_day = math.degrees(math.acos(cos_hour_angle)) / 360
+
+    def to_datetime(julian):
+        return datetime.fromtimestamp((julian - 2440587.5) * 86400, tz=dt_timezone.utc)
+
+    return to_datetime(transit - half_day), to_datetime(transit + half_day)
+
+
+class CompiledSchedule:
+    __slots__ = ('id', 'name', 'kind', 'cron', 'offset', 'sends')
+
+    def __init__(self, id, name, kind, cron='', offset=0, sends=()):
+        self.id = id
+        self.name = name
+        self.kind = kind
+        self.cron = CronExpression(cron) if kind == Schedule.KIND_CRON else None
+        self.offset = timedelta(minutes=offset)
+        self.sends = list(sends)
+
+    def next_after(self, moment):
+        """The next run after ``moment``, or None when there is none (impossible date, polar day/night)."""
+        if self.cron is not None:
+            try:
+                return self.cron.next_after(moment, timezone.get_default_timezone())
+            except ValueError:
+                return None
+        index = 0 if self.kind == Schedule.KIND_SUNRISE else 1
+        latitude = getattr(settings, 'HOME_LATITUDE', 0)
+        longitude = getattr(settings, 'HOME_LONGITUDE', 0)
+        day = (moment - self.offset).astimezone(dt_timezone.utc).date() - timedelta(days=1)
+        for _ in range(370):
+            event = sun_times(day, latitude, longitude)[index]
+            if event is not None and event + self.offset > moment:
+                return event + self.offset
+            day += timedelta(days=1)
+        return None
+
+
+def compile_schedule(schedule):
+    return CompiledSchedule(
+        schedule.id, schedule.name, schedule.kind, schedule.cron, schedule.offset, sends=compile_action(schedule),
+    )
+
+
+def load_schedules():
+    """Every enabled schedule, compiled, from one query. Invalid cron expressions are skipped."""
+    schedules = (
+        Schedule.objects.filter(enabled=True)
+        .select_related('action_device', 'action_scene')
+        .only(
+            'id', 'name', 'kind', 'cron', 'offset', 'action_device', 'action_state', 'action_scene',
+            'action_device__name', 'action_device__mac_address', 'action_scene__plan',
+        )
+    )
+    compiled = []
+    for schedule in schedules:
+        try:
+            compiled.append(compile_schedule(schedule))
+        except ValueError:
+            continue
+    return compiled
+
+
+class Scheduler:
+    def __init__(self, loader=load_schedules, reload_interval=None, clock=timezone.now):
+        self.loader = loader
+        self.reload_interval = (
+            reload_interval if reload_interval is not None else getattr(settings, 'RULES_RELOAD_INTERVAL', 2)
+        )
+        self.clock = clock
+        self.generation = None
+        self.checked_at = None
+        self.count = 0
+        self._heap = []
+
+    def load(self, schedules):
+        """Replace the schedules, each queued for its next run after now."""
+        now = self.clock()
+        heap = []
+        for schedule in schedules:
+            at = schedule.next_after(now)
+            if at is not None:
+                heap.append((at, schedule.id, schedule))
+        heapq.heapify(heap)
+        self._heap = heap
+        self.count = len(schedules)
+
+    def refresh(self):
+        """Reload the schedules if they changed, checking at most every ``reload_interval`` seconds."""
+        now = self.clock()
+        if self.checked_at is not None and (now - self.checked_at).total_seconds() < self.reload_interval:
+            return False
+        self.checked_at = now
+        generation = device_schedules.generation()
+        if generation == self.generation:
+            return False
+        self.load(self.loader())
+        self.generation = generation
+        return True
+
+    def due(self):
+        """Pop the schedules whose run has come, queueing their following run."""
+        now = self.clock()
+        fired = []
+        while self._heap and self._heap[0][0] <= now:
+            _, pk, schedule = heapq.heappop(self._heap)
+            fired.append(schedule)
+            at = schedule.next_after(now)
+            if at is not None:
+                heapq.heappush(self._heap, (at, pk, schedule))
+        return fired
+
+    def next_run(self):
+        return self._heap[0][0] if self._heap else None
+
+    def seconds_until_next(self):
+        """Seconds until the earliest run (0 if overdue), or None when nothing is scheduled."""
+        if not self._heap:
+            return None
+        return max(0.0, (self._heap[0][0] - self.clock()).total_seconds())
+
+
+def fire(schedules):
+    """Send the actions of due schedules in one batch. Returns the send results."""
+    sends = [send for schedule in schedules for send in schedule.sends]
+    if not sends:
+        return []
+    results = send_plan(sends, offline_targets([entry['device'] for entry, _, _ in sends]))
+    Schedule.objects.filter(pk__in=[schedule.id for schedule in schedules]).update(last_run_at=timezone.now())
+    return results
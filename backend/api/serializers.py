@@ -2,7 +2,12 @@ from rest_framework import serializers
 from rest_framework.validators import UniqueValidator
 from django.contrib.auth.models import User
 from django.contrib.auth.password_validation import validate_password
-from .models import Profile, Device, Room, CustomDeviceType, DeviceCardTemplate, DeviceControl, Notification, DashboardLayout
+from django.db import transaction
+from django.utils import timezone
+from .models import Profile, Device, Room, CustomDeviceType, DeviceCardTemplate, DeviceControl, Notification, DashboardLayout, Scene, AutomationRule, Schedule
+from .control_sync import sync_controls
+from .scheduler import CompiledSchedule, CronExpression
+from .sparse_fields import SparseFieldsMixin
 
 
 class DeviceControlSerializer(serializers.ModelSerializer):
@@ -45,7 +50,7 @@ class DeviceCardTemplateSerializer(serializers.ModelSerializer):
         fields = ['id', 'layout_config', 'controls']
 
 
-class CustomDeviceTypeSerializer(serializers.ModelSerializer):
+class CustomDeviceTypeSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     card_template = DeviceCardTemplateSerializer(required=False)
     proposed_by_username = serializers.CharField(source='proposed_by.username', read_only=True)
     wiring_diagram_base64 = serializers.CharField(required=False, allow_blank=True)
@@ -56,6 +61,12 @@ class CustomDeviceTypeSerializer(serializers.ModelSerializer):
         model = CustomDeviceType
         fields = ['id', 'name', 'definition', 'approved', 'rejection_reason', 'proposed_by', 'proposed_by_username', 'created_at', 'card_template', 'firmware_code', 'wiring_diagram_image', 'wiring_diagram_base64', 'wiring_diagram_text', 'documentation', 'documentation_images_base64']
         read_only_fields = ['id', 'created_at', 'approved', 'rejection_reason', 'proposed_by', 'proposed_by_username', 'wiring_diagram_image']
+        # Model lookups behind non-model fields, for ?fields= (see sparse_fields.py)
+        field_sources = {
+            'proposed_by_username': ['proposed_by__username'],
+            'card_template': ['card_template', 'card_template__controls'],
+            'wiring_diagram_image': ['wiring_diagram_base64'],
+        }
         extra_kwargs = {
             'name': {
                 'error_messages': {
@@ -101,12 +112,19 @@ class CustomDeviceTypeSerializer(serializers.ModelSerializer):
 
             # Check controls against defined IDs
             controls_data = card_template_data.get('controls', [])
+            seen_mappings = set()
             for control in controls_data:
                 mapping = control.get('variable_mapping')
                 if mapping and mapping not in defined_ids:
                     raise serializers.ValidationError(
                         f"Variable mapping '{mapping}' in controls does not match any ID in the device definition."
                     )
+                # Controls are identified by variable_mapping when the template is updated
+                if mapping in seen_mappings:
+                    raise serializers.ValidationError(
+                        f"Variable mapping '{mapping}' is used by more than one control."
+                    )
+                seen_mappings.add(mapping)
         
         return data
 
@@ -125,12 +143,11 @@ class CustomDeviceTypeSerializer(serializers.ModelSerializer):
         if card_template_data:
             controls_data = card_template_data.pop('controls', [])
             template = DeviceCardTemplate.objects.create(device_type=device_type, **card_template_data)
-            
-            for control_data in controls_data:
-                DeviceControl.objects.create(template=template, **control_data)
+            sync_controls(template, controls_data)
         
         return device_type
 
+    @transaction.atomic
     def update(self, instance, validated_data):
         card_template_data = validated_data.pop('card_template', None)
         
@@ -164,16 +181,26 @@ class CustomDeviceTypeSerializer(serializers.ModelSerializer):
                 template.layout_config = card_template_data.get('layout_config', template.layout_config)
                 template.save()
 
-            # For simplicity, clear old controls and re-create (full sync)
-            template.controls.all().delete()
-            for control_data in controls_data:
-                DeviceControl.objects.create(template=template, **control_data)
+            # Diff against the stored controls by variable_mapping
+            sync_controls(template, controls_data)
 
         return instance
 
 
+class DeviceTypeLiteSerializer(serializers.ModelSerializer):
+    """
+    Read-only device type with just what the dashboard needs to render cards.
+    Leaves out firmware, documentation and the base64 images.
+    """
+    card_template = DeviceCardTemplateSerializer(read_only=True)
+
+    class Meta:
+        model = CustomDeviceType
+        fields = ['id', 'name', 'approved', 'card_template']
+        read_only_fields = fields
+
 
-class RoomSerializer(serializers.ModelSerializer):
+class RoomSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Room
         fields = ['id', 'name', 'icon']
@@ -190,14 +217,20 @@ class RoomSerializer(serializers.ModelSerializer):
         return value
 
 
-class DeviceSerializer(serializers.ModelSerializer):
+class DeviceSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     room_name = serializers.CharField(source='room.name', read_only=True)
     room_id = serializers.PrimaryKeyRelatedField(read_only=True, source='room')
     device_type_name = serializers.CharField(source='device_type.name', read_only=True)
 
     class Meta:
         model = Device
-        fields = ['id', 'name', 'ip_address', 'status', 'icon', 'device_type', 'device_type_name', 'room', 'room_name', 'room_id', 'current_state']
+        fields = ['id', 'name', 'ip_address', 'status', 'icon', 'device_type', 'device_type_name', 'room', 'room_name', 'room_id', 'current_state', 'desired_state']
+        read_only_fields = ['desired_state']
+        field_sources = {
+            'device_type_name': ['device_type__name'],
+            'room_name': ['room__name'],
+            'room_id': ['room'],
+        }
 
     def validate_ip_address(self, value):
         """
@@ -235,7 +268,7 @@ class ProfileSerializer(serializers.ModelSerializer):
         return None
 
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     profile = ProfileSerializer(read_only=True)
 
     class Meta:
@@ -294,7 +327,7 @@ class RegisterSerializer(serializers.ModelSerializer):
         return user
 
 
-class NotificationSerializer(serializers.ModelSerializer):
+class NotificationSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     """Serializer for Notification model."""
     
     # Human-readable type and priority
@@ -322,6 +355,11 @@ class NotificationSerializer(serializers.ModelSerializer):
             'time_ago',
         ]
         read_only_fields = ['id', 'created_at', 'read_at', 'time_ago']
+        field_sources = {
+            'notification_type_display': ['notification_type'],
+            'priority_display': ['priority'],
+            'time_ago': ['created_at'],
+        }
     
     def get_time_ago(self, obj):
         """Calculate human-readable time since notification was created."""
@@ -517,4 +555,129 @@ class DashboardLayoutSerializer(serializers.Serializer):
         if user:
             self._check_devices_exist(all_device_ids, user, skip_ownership=skip_ownership)
 
-        return value
\ No newline at end of file
+        return value
+
+
+class SceneSerializer(serializers.ModelSerializer):
+    """Scenes; the publish plan is compiled by the view after saving (api/scenes.py)."""
+    MAX_ACTIONS = 200
+
+    device_count = serializers.SerializerMethodField()
+    created_by = serializers.CharField(source='user.username', read_only=True, default=None)
+
+    class Meta:
+        model = Scene
+        fields = ['id', 'name', 'icon', 'actions', 'device_count', 'snapshot', 'created_by', 'compiled_at',
+                  'last_activated_at', 'last_activation_ms', 'created_at']
+        read_only_fields = ['snapshot', 'compiled_at', 'last_activated_at', 'last_activation_ms', 'created_at']
+
+    def get_device_count(self, obj):
+        return len(obj.plan)
+
+    def validate_actions(self, value):
+        if not isinstance(value, list) or not value:
+            raise serializers.ValidationError("Must be a non-empty list of {device, state} objects.")
+        if len(value) > self.MAX_ACTIONS:
+            raise serializers.ValidationError(f"A scene can have at most {self.MAX_ACTIONS} actions.")
+        actions = []
+        for index, action in enumerate(value):
+            if not isinstance(action, dict):
+                raise serializers.ValidationError(f"Action {index} must be an object.")
+            device, state = action.get('device'), action.get('state')
+            if isinstance(device, bool) or not isinstance(device, int):
+                raise serializers.ValidationError(f"Action {index}: device must be a device ID.")
+            if not isinstance(state, dict) or not state:
+                raise serializers.ValidationError(f"Action {index}: state must be a non-empty object.")
+            actions.append({"device": device, "state": state})
+
+        ids = [action['device'] for action in actions]
+        duplicates = sorted({pk for pk in ids if ids.count(pk) > 1})
+        if duplicates:
+            raise serializers.ValidationError(f"Duplicate device IDs: {duplicates}")
+        missing = set(ids) - set(Device.objects.filter(id__in=ids).values_list('id', flat=True))
+        if missing:
+            raise serializers.ValidationError(f"Device IDs not found: {sorted(missing)}")
+        return actions
+
+
+def validate_action(attrs, get):
+    """The action of a rule or schedule: ``action_device`` with a state, or ``action_scene``."""
+    action_device, action_scene = get('action_device'), get('action_scene')
+    if (action_device is None) == (action_scene is None):
+        raise serializers.ValidationError("Provide exactly one of: action_device, action_scene.")
+    action_state = get('action_state')
+    if action_device is not None and (not isinstance(action_state, dict) or not action_state):
+        raise serializers.ValidationError({"action_state": "Must be a non-empty object."})
+    if action_scene is not None:
+        attrs['action_state'] = {}
+
+
+class AutomationRuleSerializer(serializers.ModelSerializer):
+    """Automation rules; the MQTT listener picks up changes within RULES_RELOAD_INTERVAL (api/rules.py)."""
+    created_by = serializers.CharField(source='user.username', read_only=True, default=None)
+
+    class Meta:
+        model = AutomationRule
+        fields = ['id', 'name', 'enabled', 'device', 'metric', 'operator', 'threshold', 'hysteresis', 'cooldown',
+                  'action_device', 'action_state', 'action_scene', 'created_by', 'last_fired_at', 'created_at']
+        read_only_fields = ['last_fired_at', 'created_at']
+
+    def validate_hysteresis(self, value):
+        if value < 0:
+            raise serializers.ValidationError("Must be zero or positive.")
+        return value
+
+    def validate(self, attrs):
+        def get(name):
+            return attrs.get(name, getattr(self.instance, name, None))
+
+        operator, threshold = get('operator'), get('threshold')
+        if operator != AutomationRule.OP_EQ and (isinstance(threshold, bool) or not isinstance(threshold, (int, float))):
+            raise serializers.ValidationError({"threshold": "Must be a number for this operator."})
+        if operator == AutomationRule.OP_EQ and isinstance(threshold, (dict, list)):
+            raise serializers.ValidationError({"threshold": "Must be a single value."})
+
+        validate_action(attrs, get)
+        return attrs
+
+
+class ScheduleSerializer(serializers.ModelSerializer):
+    """Schedules; the MQTT listener picks up changes within RULES_RELOAD_INTERVAL (api/scheduler.py)."""
+    MAX_OFFSET = 720
+
+    created_by = serializers.CharField(source='user.username', read_only=True, default=None)
+    next_run = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Schedule
+        fields = ['id', 'name', 'enabled', 'kind', 'cron', 'offset', 'action_device', 'action_state', 'action_scene',
+                  'created_by', 'next_run', 'last_run_at', 'created_at']
+        read_only_fields = ['last_run_at', 'created_at']
+
+    def get_next_run(self, obj):
+        if not obj.enabled:
+            return None
+        try:
+            schedule = CompiledSchedule(obj.id, obj.name, obj.kind, obj.cron, obj.offset)
+        except ValueError:
+            return None
+        return schedule.next_after(timezone.now())
+
+    def validate_offset(self, value):
+        if abs(value) > self.MAX_OFFSET:
+            raise serializers.ValidationError(f"Must be between -{self.MAX_OFFSET} and {self.MAX_OFFSET} minutes.")
+        return value
+
+    def validate(self, attrs):
+        def get(name):
+            return attrs.get(name, getattr(self.instance, name, None))
+
+        if (get('kind') or Schedule.KIND_CRON) == Schedule.KIND_CRON:
+            try:
+                CronExpression(get('cron') or '').next_after(timezone.now(), timezone.get_default_timezone())
+            except ValueError as e:
+                raise serializers.ValidationError({"cron": str(e)})
+        else:
+            attrs['cron'] = ''
+        validate_action(attrs, get)
+        return attrs
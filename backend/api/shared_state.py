@@ -0,0 +1,59 @@
+"""
+State shared by the web workers and the MQTT listener.
+
+The default cache (LocMemCache) lives in each process's memory, and the
+listener runs in a process of its own, so whatever one side changes and the
+other must see goes through a ``SharedState`` row instead:
+
+- generations of ``CachedResource(shared=True)`` resources (api/caching.py):
+  ``generation`` reads one row by primary key, ``bump`` increments any number
+  of them in one UPDATE
+- snapshots the listener publishes for the API (``publish``/``read``), such
+  as the command metrics served by ``/api/admin/command-metrics/``
+"""
+import time
+from datetime import timedelta
+
+from django.db.models import F
+from django.utils import timezone
+
+from .models import SharedState
+
+
+def _seed():
+    # From the clock, so a row that was deleted never comes back with a
+    # generation whose keys may still be cached
+    return int(time.time() * 1000)
+
+
+def generation(name):
+    """The current generation of ``name``, seeding the row if it is missing."""
+    value = SharedState.objects.filter(pk=name).values_list('generation', flat=True).first()
+    if value is None:
+        value = SharedState.objects.get_or_create(name=name, defaults={'generation': _seed()})[0].generation
+    return value
+
+
+def bump(*names):
+    """Increment the generation of every name in one UPDATE, creating missing rows."""
+    names = set(names)
+    if not names:
+        return
+    updated = SharedState.objects.filter(pk__in=names).update(generation=F('generation') + 1, updated_at=timezone.now())
+    if updated < len(names):
+        SharedState.objects.bulk_create(
+            [SharedState(name=name, generation=_seed()) for name in names], ignore_conflicts=True,
+        )
+
+
+def publish(name, data):
+    """Store a JSON snapshot under ``name`` for other processes."""
+    SharedState.objects.update_or_create(name=name, defaults={'data': data})
+
+
+def read(name, max_age=None):
+    """The snapshot published under ``name``, or None when missing or older than ``max_age`` seconds."""
+    rows = SharedState.objects.filter(pk=name, data__isnull=False)
+    if max_age is not None:
+        rows = rows.filter(updated_at__gte=timezone.now() - timedelta(seconds=max_age))
+    return rows.values_list('data', flat=True).first()
@@ -0,0 +1,29 @@
+"""
+Custom signals sent by the API app.
+
+``controls_changed``
+    Sent after a transaction that changed the controls of a card template
+    commits. Keyword arguments:
+
+    - template: the ``DeviceCardTemplate``
+    - device_type_id: PK of the owning ``CustomDeviceType``
+    - added / changed / removed: ``variable_mapping`` values of controls that
+      were inserted, modified in place (or recreated to keep their order) and
+      deleted
+
+    List it in a ``CachedResource(signals=[...])`` to invalidate caches that
+    render controls.
+
+``device_status_changed``
+    Sent by the MQTT listener when a device goes online or offline. Heartbeat
+    saves only touch volatile columns and do not invalidate caches through the
+    model signals, so caches that show device status listen for this one.
+    Keyword arguments:
+
+    - device: the ``Device``, already saved with its new status
+    - previous: the status before the change
+"""
+from django.dispatch import Signal
+
+controls_changed = Signal()
+device_status_changed = Signal()
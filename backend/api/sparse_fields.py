@@ -0,0 +1,146 @@
+"""
+Sparse fieldsets: ``GET /api/devices/?fields=id,name,status``.
+
+Serializers opt in with ``SparseFieldsMixin`` and views with
+``SparseFieldsViewMixin``. The view hands the requested names to the
+serializer, which drops every other field, and rebuilds the queryset's
+``select_related`` / ``prefetch_related`` / ``only()`` from just the lookups
+those fields read, so a narrow request produces narrow SQL.
+
+A serializer field reads the model field of the same name unless
+``Meta.field_sources`` maps it to other lookups:
+
+    field_sources = {
+        'room_name': ['room__name'],    # joins room, selects room.name only
+        'room_id': ['room'],            # the room_id column, no join
+        'profile': ['profile'],         # reverse one-to-one: the whole row
+        'card_template': ['card_template', 'card_template__controls'],
+        'time_ago': ['created_at'],     # SerializerMethodField input
+    }
+
+A lookup that ends on a foreign key reads just the key column; one that ends
+on a reverse one-to-one loads the related row; one that crosses a to-many
+relation is prefetched. Without ``?fields=`` nothing changes.
+"""
+from django.db.models import Prefetch
+from django.db.models.constants import LOOKUP_SEP
+from rest_framework.exceptions import ValidationError
+
+FIELDS_PARAM = 'fields'
+
+
+class SparseFieldsMixin:
+    """Serializer mixin: ``Serializer(..., fields=[...])`` keeps only those fields."""
+
+    def __init__(self, *args, **kwargs):
+        fields = kwargs.pop('fields', None)
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+
+def field_lookups(serializer_class, names):
+    """Model lookups read by the given serializer fields."""
+    sources = getattr(serializer_class.Meta, 'field_sources', {})
+    lookups = []
+    for name in names:
+        lookups.extend(sources.get(name, [name]))
+    return lookups
+
+
+def plan_lookups(model, lookups):
+    """
+    Turn lookups into ``(select_related, only, prefetch_related)`` path sets.
+
+    Raises FieldDoesNotExist for a lookup that does not resolve on ``model``.
+    """
+    select, only, prefetch = set(), {model._meta.pk.name}, set()
+    for lookup in lookups:
+        current = model
+        path = []
+        parts = lookup.split(LOOKUP_SEP)
+        for i, part in enumerate(parts):
+            field = current._meta.get_field(part)
+            path.append(part)
+            joined = LOOKUP_SEP.join(path)
+            last = i == len(parts) - 1
+
+            if field.many_to_many or field.one_to_many:
+                # Prefetched rows are loaded whole
+                prefetch.add(joined)
+                break
+            if not field.is_relation:
+                only.add(joined)
+                continue
+            if last and field.concrete:
+                # Forward FK / one-to-one as the last part: the key column
+                only.add(joined)
+                continue
+
+            # Crossing a to-one relation (or loading a reverse one-to-one): join it
+            current = field.related_model
+            select.add(joined)
+            only.add(joined + LOOKUP_SEP + current._meta.pk.name)
+            if last:
+                only.update(joined + LOOKUP_SEP + f.name for f in current._meta.concrete_fields)
+    return select, only, prefetch
+
+
+def _prefetch_path(lookup):
+    return lookup.prefetch_to if isinstance(lookup, Prefetch) else lookup
+
+
+def trim_queryset(queryset, lookups):
+    """
+    Replace the joins, prefetches and column list of ``queryset`` with what
+    ``lookups`` need. Filters and ordering are kept, and so are existing
+    ``Prefetch`` objects (e.g. with an ordered queryset) for paths still needed.
+    """
+    select, only, prefetch = plan_lookups(queryset.model, lookups)
+    kept = [lookup for lookup in queryset._prefetch_related_lookups if _prefetch_path(lookup) in prefetch]
+    missing = prefetch - {_prefetch_path(lookup) for lookup in kept}
+
+    queryset = queryset.select_related(None).prefetch_related(None)
+    if select:
+        queryset = queryset.select_related(*sorted(select))
+    if kept or missing:
+        queryset = queryset.prefetch_related(*kept, *sorted(missing))
+    return queryset.only(*sorted(only))
+
+
+class SparseFieldsViewMixin:
+    """
+    Generic view mixin: honours ``?fields=`` on GET requests.
+
+    Unknown field names are rejected with 400 so typos do not silently return
+    empty objects.
+    """
+
+    def get_sparse_fields(self):
+        if self.request.method != 'GET':
+            return None
+        raw = self.request.query_params.get(FIELDS_PARAM)
+        if not raw:
+            return None
+        names = [name.strip() for name in raw.split(',') if name.strip()]
+        available = list(self.get_serializer_class().Meta.fields)
+        unknown = [name for name in names if name not in available]
+        if unknown:
+            raise ValidationError({
+                FIELDS_PARAM: f"Unknown field(s): {', '.join(unknown)}. Available: {', '.join(available)}."
+            })
+        return names
+
+    def get_serializer(self, *args, **kwargs):
+        fields = self.get_sparse_fields()
+        if fields is not None:
+            kwargs['fields'] = fields
+        return super().get_serializer(*args, **kwargs)
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        fields = self.get_sparse_fields()
+        if fields is not None:
+            queryset = trim_queryset(queryset, field_lookups(self.get_serializer_class(), fields))
+        return queryset
@@ -1,8 +1,48 @@
-from django.test import TestCase
+import gzip
+import io
+import json
+import os
+import tempfile
+import threading
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from io import StringIO
+from types import SimpleNamespace
+from unittest import mock, skipUnless
+from zoneinfo import ZoneInfo
+
+import numpy as np
 from django.contrib.auth.models import User
-from rest_framework.test import APITestCase, APIClient
+from django.core.cache import cache, caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 from rest_framework import status
-from .models import Device, Room, CustomDeviceType, DashboardLayout, Profile
+from rest_framework.test import APIClient, APITestCase
+
+from .cache_backends import SharedDatabaseCache, TwoTierCache, _local_tiers
+from .caching import CachedResource, _registry, approved_device_types
+from .command_coalescer import CommandCoalescer, command_window
+from .command_tracking import CommandTracker
+from .control_sync import sync_controls
+from .device_query import state_filter
+from .device_state import merge_state, remap_state, type_controls
+from .device_twin import Reconciler
+from .device_type_transfer import ImportParseError, import_device_types, iter_import_items
+from .fixture_catalog import FixtureCatalog, default_types
+from .management.commands.mqtt_listener import Command
+from .models import (
+    AutomationRule, CustomDeviceType, DashboardLayout, Device, DeviceCardTemplate, DeviceControl, Notification,
+    Profile, QueuedCommand, Room, Scene, Schedule, SharedState,
+)
+from .mqtt_client import MQTTPublisher
+from .rules import CompiledRule, RuleEngine
+from .scheduler import CompiledSchedule, CronExpression, Scheduler, sun_times
+from .signals import controls_changed, device_status_changed
+from .topology_layout import NODE_SPACING, ring_positions
 
 
 class DashboardLayoutAPITest(APITestCase):
@@ -450,3 +490,1901 @@ class DashboardLayoutAPITest(APITestCase):
     def test_device_order_unauthenticated(self):
         response = self.client.get('/api/device-order/')
         self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class HomeForgeTestCase(APITestCase):
+    """API tests starting from an empty cache, with helpers for their common fixtures."""
+
+    def setUp(self):
+        cache.clear()
+
+    def create_user(self, username, admin=False):
+        user = User.objects.create_user(username=username, password='TestPass1')
+        if admin:
+            user.profile.role = Profile.ROLE_ADMIN
+            user.profile.save()
+        return user
+
+    def create_device_type(self, name, controls=(), definition=None, **fields):
+        """An approved device type whose card has one control per ``(widget_type, label, variable_mapping)``."""
+        device_type = CustomDeviceType.objects.create(name=name, definition=definition or {}, approved=True, **fields)
+        if controls:
+            template = DeviceCardTemplate.objects.create(device_type=device_type, layout_config={})
+            for widget_type, label, mapping in controls:
+                DeviceControl.objects.create(template=template, widget_type=widget_type, label=label,
+                                             variable_mapping=mapping)
+        return device_type
+
+    def patch_coalescer(self, target='api.scenes.command_coalescer', new=mock.DEFAULT):
+        """Replace the command coalescer ``target`` for the test. Returns the replacement."""
+        patcher = mock.patch(target, new)
+        coalescer = patcher.start()
+        self.addCleanup(patcher.stop)
+        return coalescer
+
+
+class CachedResourceTest(HomeForgeTestCase):
+    """Tests for signal-driven cache invalidation (api/caching.py)."""
+
+    def setUp(self):
+        super().setUp()
+        self.user = self.create_user('cacheuser')
+        self.admin = self.create_user('cacheadmin', admin=True)
+        self.approved = self.create_device_type('Approved Type')
+        self.client = APIClient()
+
+    def _listed_names(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get('/api/device-types/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return {dt['name'] for dt in response.data['results']}
+
+    def test_generation_bumps_on_save(self):
+        before = approved_device_types.generation()
+        self.approved.save()
+        self.assertNotEqual(approved_device_types.generation(), before)
+
+    def test_approval_via_model_save_invalidates_list(self):
+        pending = CustomDeviceType.objects.create(name='Pending Type', definition={}, approved=False)
+        self.assertEqual(self._listed_names(), {'Approved Type'})
+        pending.approved = True
+        pending.save()
+        self.assertEqual(self._listed_names(), {'Approved Type', 'Pending Type'})
+
+    def test_delete_invalidates_list(self):
+        self.assertEqual(self._listed_names(), {'Approved Type'})
+        self.approved.delete()
+        self.assertEqual(self._listed_names(), set())
+
+    def test_admin_approve_endpoint_invalidates_list(self):
+        pending = CustomDeviceType.objects.create(name='Pending Type', definition={}, approved=False)
+        self.assertEqual(self._listed_names(), {'Approved Type'})
+        self.client.force_authenticate(user=self.admin)
+        response = self.client.post(f'/api/admin/device-types/{pending.id}/approve/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('Pending Type', self._listed_names())
+
+    def test_volatile_fields_do_not_invalidate(self):
+        # Declared after ApiConfig.ready(): wired on creation
+        resource = CachedResource('test_devices', depends_on=['api.Device'], volatile_fields=['status'])
+        try:
+            device = Device.objects.create(
+                name='Probe', ip_address='10.0.0.1', device_type=self.approved, user=self.user
+            )
+            before = resource.generation()
+            device.status = Device.STATUS_ONLINE
+            device.save(update_fields=['status'])
+            self.assertEqual(resource.generation(), before)
+            device.name = 'Renamed'
+            device.save()
+            self.assertNotEqual(resource.generation(), before)
+        finally:
+            del _registry['test_devices']
+
+    def test_resource_declared_after_ready_is_wired(self):
+        # No resource declared at import time depends on Notification
+        resource = CachedResource('test_notifications', depends_on=['api.Notification'])
+        try:
+            before = resource.generation()
+            Notification.objects.create(user=self.user, title='t', message='m', notification_type='info')
+            self.assertNotEqual(resource.generation(), before)
+        finally:
+            del _registry['test_notifications']
+
+
+class SharedDatabaseCacheTest(TestCase):
+    """Tests for the shared database cache backend (api/cache_backends.py)."""
+
+    def setUp(self):
+        call_command('createcachetable', 'homeforge_cache_test', verbosity=0)
+        self.cache = SharedDatabaseCache('homeforge_cache_test', {'OPTIONS': {'MAX_ENTRIES': 5}})
+
+    def test_set_get_overwrite(self):
+        self.cache.set('k', {'a': 1})
+        self.cache.set('k', {'a': 2})
+        self.assertEqual(self.cache.get('k'), {'a': 2})
+
+    def test_add_only_when_absent_or_expired(self):
+        self.assertTrue(self.cache.add('k', 1))
+        self.assertFalse(self.cache.add('k', 2))
+        self.assertEqual(self.cache.get('k'), 1)
+        self.cache.set('expired', 1, timeout=-1)
+        self.assertTrue(self.cache.add('expired', 2))
+        self.assertEqual(self.cache.get('expired'), 2)
+
+    def test_incr_for_generations(self):
+        self.cache.set('gen', 1, timeout=None)
+        self.assertEqual(self.cache.incr('gen'), 2)
+        self.assertEqual(self.cache.get('gen'), 2)
+
+    def test_sweep_removes_expired_and_culls(self):
+        self.cache.set('old', 1, timeout=-1)
+        for i in range(10):
+            self.cache.set(f'k{i}', i)
+        self.assertEqual(self.cache.sweep(), 1)
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT COUNT(*) FROM homeforge_cache_test')
+            # Over MAX_ENTRIES, so a third of the remaining rows is culled
+            self.assertLess(cursor.fetchone()[0], 10)
+
+    def test_incr_missing_or_expired_key(self):
+        with self.assertRaises(ValueError):
+            self.cache.incr('missing')
+        self.cache.set('expired', 1, timeout=-1)
+        with self.assertRaises(ValueError):
+            self.cache.incr('expired')
+        self.cache.set('gen', 5, timeout=None)
+        self.assertEqual(self.cache.decr('gen', 2), 3)
+
+
+@skipUnless(connection.vendor == 'postgresql', 'concurrent connections need a server database')
+class SharedDatabaseCacheConcurrencyTest(TransactionTestCase):
+    """Concurrent increments of the shared database cache (api/cache_backends.py)."""
+
+    def test_concurrent_increments_are_all_counted(self):
+        call_command('createcachetable', 'homeforge_cache_test', verbosity=0)
+        SharedDatabaseCache('homeforge_cache_test', {}).set('gen', 0, timeout=None)
+        errors = []
+
+        def bump():
+            # A connection of its own, like another web worker
+            try:
+                shared = SharedDatabaseCache('homeforge_cache_test', {})
+                for _ in range(25):
+                    shared.incr('gen')
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=bump) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(SharedDatabaseCache('homeforge_cache_test', {}).get('gen'), 100)
+
+
+@override_settings(CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'tt-default'},
+    'shared': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'tt-shared'},
+})
+class TwoTierCacheTest(APITestCase):
+    """Tests for the two-tier cache wrapper (api/cache_backends.py)."""
+
+    def setUp(self):
+        _local_tiers.clear()
+        caches['shared'].clear()
+        self.shared = caches['shared']
+        self.a = self._make('proc-a')
+        self.b = self._make('proc-b')
+
+    def _make(self, location, **options):
+        opts = {'SHARED_ALIAS': 'shared', 'LOCAL_TIMEOUT': 60, 'GENERATION_CHECK_INTERVAL': 0}
+        opts.update(options)
+        return TwoTierCache(location, {'OPTIONS': opts})
+
+    def test_second_read_is_served_locally(self):
+        self.a.set('catalog', [1, 2, 3])
+        self.shared.set('catalog', ['changed behind our back'])
+        self.assertEqual(self.a.get('catalog'), [1, 2, 3])
+        stats = self.a.get_stats()
+        self.assertEqual(stats['local_hits'], 1)
+        self.assertEqual(stats['shared_hits'], 0)
+
+    def test_shared_hit_populates_local_tier(self):
+        self.b.set('catalog', [1])
+        self.assertEqual(self.a.get('catalog'), [1])
+        self.assertEqual(self.a.get('catalog'), [1])
+        stats = self.a.get_stats()
+        self.assertEqual((stats['shared_hits'], stats['local_hits']), (1, 1))
+        self.assertEqual(stats['local_hit_ratio'], 0.5)
+
+    def test_invalidation_in_other_process_flushes_local_tier(self):
+        self.a.set('gen', 1, None)
+        self.assertEqual(self.a.get('gen'), 1)
+        self.b.incr('gen')
+        self.assertEqual(self.a.get('gen'), 2)
+        self.b.delete('gen')
+        self.assertIsNone(self.a.get('gen'))
+
+    def _warm(self):
+        """Start both processes in sync at generation 1 with 'catalog' held locally by process a."""
+        self.shared.set(self.a.GENERATION_KEY, 1, None)
+        self.a.set('gen', 1, None)
+        self.a.set('catalog', [1])
+        self.a.get('catalog')
+        self.shared.set('catalog', ['changed behind our back'])
+
+    def test_incr_only_drops_that_key_in_other_processes(self):
+        self._warm()
+        self.b.incr('gen')
+        self.assertEqual(self.a.get('gen'), 2)
+        self.assertEqual(self.a.get('catalog'), [1])
+        self.assertEqual(self.a.get_stats()['local_flushes'], 0)
+
+    def test_clear_flushes_whole_local_tier(self):
+        self._warm()
+        self.b.clear()
+        self.shared.set('catalog', [2])
+        self.assertEqual(self.a.get('catalog'), [2])
+        self.assertEqual(self.a.get_stats()['local_flushes'], 1)
+
+    def test_expired_invalidation_log_flushes_whole_local_tier(self):
+        self._warm()
+        self.b.incr('gen')
+        self.shared.delete(self.b.INVALIDATION_LOG_KEY % 2)
+        self.assertEqual(self.a.get('catalog'), ['changed behind our back'])
+        self.assertEqual(self.a.get_stats()['local_flushes'], 1)
+
+    def test_local_tier_is_bounded(self):
+        small = self._make('proc-small', LOCAL_MAX_ENTRIES=2)
+        for i in range(5):
+            small.set(f'k{i}', i)
+        self.assertEqual(small.get_stats()['local_entries'], 2)
+        self.assertEqual(small.get('k0'), 0)  # evicted locally, still in shared tier
+
+    def test_cache_stats_endpoint_is_admin_only(self):
+        user = User.objects.create_user(username='statsuser', password='TestPass1')
+        self.client.force_authenticate(user=user)
+        response = self.client.get('/api/admin/cache-stats/')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        user.profile.role = Profile.ROLE_ADMIN
+        user.profile.save()
+        response = self.client.get('/api/admin/cache-stats/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('shared', response.data['caches'])
+
+
+class DeviceTypeExportStreamingTest(HomeForgeTestCase):
+    """Tests for the streaming bulk export (api/device_type_transfer.py)."""
+
+    def setUp(self):
+        super().setUp()
+        self.user = self.create_user('exportuser')
+        for i in range(3):
+            dt = CustomDeviceType.objects.create(
+                name=f'Export Type {i}', definition={'i': i}, approved=True,
+                wiring_diagram_base64='data:image/png;base64,AAAA',
+            )
+            tmpl = DeviceCardTemplate.objects.create(device_type=dt)
+            DeviceControl.objects.create(template=tmpl, widget_type='SLIDER', label='Level',
+                                         variable_mapping='level', min_value=0, max_value=100)
+            DeviceControl.objects.create(template=tmpl, widget_type='TOGGLE', label='Power',
+                                         variable_mapping='power')
+        CustomDeviceType.objects.create(name='Pending Type', definition={}, approved=False)
+        self.client.force_authenticate(user=self.user)
+
+    def _body(self, response):
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return b''.join(response.streaming_content)
+
+    def test_json_array_matches_single_exports(self):
+        response = self.client.get('/api/device-types/export/')
+        self.assertEqual(response['Content-Type'], 'application/json')
+        data = json.loads(self._body(response))
+        self.assertEqual([d['name'] for d in data], ['Export Type 0', 'Export Type 1', 'Export Type 2'])
+        self.assertEqual([c['variable_mapping'] for c in data[0]['card_template']['controls']], ['level', 'power'])
+        single = self.client.get(f'/api/device-types/{CustomDeviceType.objects.get(name="Export Type 0").id}/export/')
+        self.assertEqual(single.data[0], data[0])
+
+    def test_ndjson_gzip(self):
+        response = self.client.get('/api/device-types/export/?output=ndjson&compress=gzip')
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        self.assertIn('device_types_export.ndjson.gz', response['Content-Disposition'])
+        lines = gzip.decompress(self._body(response)).decode().splitlines()
+        self.assertEqual([json.loads(line)['name'] for line in lines],
+                         ['Export Type 0', 'Export Type 1', 'Export Type 2'])
+
+    def test_queries_do_not_grow_with_catalog(self):
+        # exists() + one chunk of device types + one prefetch query for controls
+        with self.assertNumQueries(3):
+            self._body(self.client.get('/api/device-types/export/'))
+
+    def test_invalid_options(self):
+        self.assertEqual(self.client.get('/api/device-types/export/?output=xml').status_code,
+                         status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get('/api/device-types/export/?compress=brotli').status_code,
+                         status.HTTP_400_BAD_REQUEST)
+        with mock.patch('api.device_type_transfer.zstandard', None):
+            self.assertEqual(self.client.get('/api/device-types/export/?compress=zstd').status_code,
+                             status.HTTP_400_BAD_REQUEST)
+
+
+class DeviceTypeImportTest(HomeForgeTestCase):
+    """Tests for the incremental parser and bulk import engine (api/device_type_transfer.py)."""
+
+    def setUp(self):
+        super().setUp()
+        self.admin = self.create_user('importadmin', admin=True)
+        self.client.force_authenticate(user=self.admin)
+
+    def _item(self, name, **extra):
+        item = {
+            'name': name, 'definition': {'n': name},
+            'wiring_diagram_base64': 'data:image/png;base64,' + 'A' * 200,
+            'card_template': {'layout_config': {}, 'controls': [
+                {'widget_type': 'SLIDER', 'label': 'Level', 'variable_mapping': 'level', 'min_value': 0.0, 'max_value': 100.0},
+                {'widget_type': 'TOGGLE', 'label': 'Power ⚡', 'variable_mapping': 'power'},
+            ]},
+        }
+        item.update(extra)
+        return item
+
+    def _upload(self, content, filename='types.json'):
+        return self.client.post('/api/device-types/import/',
+                                {'file': SimpleUploadedFile(filename, content)}, format='multipart')
+
+    def test_parser_handles_small_reads(self):
+        items = [self._item(f'T{i}') for i in range(4)]
+        array = json.dumps(items, ensure_ascii=False, indent=2).encode()
+        ndjson = b'\n'.join(json.dumps(i).encode() for i in items) + b'\n'
+        for payload in (array, ndjson):
+            self.assertEqual(list(iter_import_items(io.BytesIO(payload), read_size=7)), items)
+        self.assertEqual(list(iter_import_items(io.BytesIO(b' [ ] '))), [])
+
+    def test_parser_rejects_malformed_input(self):
+        for payload in (b'[{"name": "a"} {"name": "b"}]', b'[{"name": "a"', b'{"name": nope}'):
+            with self.assertRaises(ImportParseError):
+                list(iter_import_items(io.BytesIO(payload)))
+
+    def test_export_round_trip_gzip(self):
+        payload = gzip.compress(json.dumps([self._item('Round A'), self._item('Round B')]).encode())
+        response = self._upload(payload, 'types.json.gz')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['created'], ['Round A', 'Round B'])
+
+        exported = self.client.get('/api/device-types/export/')
+        data = json.loads(b''.join(exported.streaming_content))
+        self.assertEqual(data[1]['card_template']['controls'], self._item('Round B')['card_template']['controls'])
+
+    def test_skips_existing_and_duplicates_and_reports_errors(self):
+        self.create_device_type('Existing')
+        items = [
+            self._item('Existing'), self._item('Fresh'), self._item('Fresh'), {'definition': {}},
+            self._item('Bad Controls', card_template={'controls': [
+                {'variable_mapping': 'x'}, {'variable_mapping': 'x'}]}),
+            self._item(42), self._item({'en': 'Lamp'}), self._item('L' * 101),
+        ]
+        response = self._upload(json.dumps(items).encode())
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['created'], ['Fresh'])
+        self.assertEqual(response.data['skipped'], ['Existing', 'Fresh'])
+        self.assertEqual(len(response.data['errors']), 5)
+        self.assertIn("'name' must be a string", response.data['errors'][2])
+        self.assertFalse(CustomDeviceType.objects.filter(name='Bad Controls').exists())
+
+    def test_legacy_documentation_images_are_relinked(self):
+        response = self.client.post('/api/device-types/import/', [{
+            'name': 'Legacy', 'definition': {}, 'documentation': '![w](/media/old.png)',
+            'documentation_images': [{'filename': 'old.png', 'original_url': '/media/old.png', 'data': 'data:image/png;base64,AA'}],
+        }], format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        dt = CustomDeviceType.objects.get(name='Legacy')
+        self.assertEqual(dt.documentation, f'![w](/api/device-types/{dt.pk}/doc-image/old.png)')
+        self.assertEqual(dt.documentation_images_base64[0]['filename'], 'old.png')
+
+    def test_query_count_does_not_grow_with_items(self):
+        counts = []
+        for batch, size in (('small', 2), ('large', 20)):
+            with CaptureQueriesContext(connection) as ctx:
+                import_device_types([self._item(f'{batch}-{i}') for i in range(size)])
+            counts.append(len(ctx.captured_queries))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_parse_error_rolls_back_earlier_chunks(self):
+        payload = json.dumps([self._item('Early')]).encode()[:-1] + b', {"name": broken}]'
+        with self.assertRaises(ImportParseError):
+            import_device_types(iter_import_items(io.BytesIO(payload)), chunk_size=1)
+        self.assertFalse(CustomDeviceType.objects.filter(name='Early').exists())
+
+
+class ControlSyncTest(HomeForgeTestCase):
+    """Tests for diff-based card template control updates (api/control_sync.py)."""
+
+    def setUp(self):
+        super().setUp()
+        self.admin = self.create_user('syncadmin', admin=True)
+        self.device_type = self.create_device_type(
+            'Sync Type', controls=[('TOGGLE', mapping.upper(), mapping) for mapping in ('a', 'b', 'c')],
+            definition={'structure': [{'id': m} for m in ('a', 'b', 'c', 'd')]},
+        )
+        self.template = self.device_type.card_template
+
+    def _ids(self):
+        return dict(self.template.controls.values_list('variable_mapping', 'id'))
+
+    def _controls(self, *specs):
+        return [{'widget_type': 'TOGGLE', 'label': label, 'variable_mapping': mapping} for mapping, label in specs]
+
+    def test_edit_keeps_ids_and_sends_precise_event(self):
+        before = self._ids()
+        events = []
+        controls_changed.connect(lambda **kw: events.append(kw), weak=False, dispatch_uid='test-sync')
+        self.addCleanup(controls_changed.disconnect, dispatch_uid='test-sync')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertNumQueries(6):  # savepoint, SELECT, DELETE, UPDATE, INSERT, release
+                sync_controls(self.template, self._controls(('a', 'A'), ('b', 'Renamed'), ('d', 'D')))
+        after = self._ids()
+        self.assertEqual(after['a'], before['a'])
+        self.assertEqual(after['b'], before['b'])
+        self.assertNotIn('c', after)
+        self.assertEqual(self.template.controls.get(variable_mapping='b').label, 'Renamed')
+        self.assertEqual(len(events), 1)
+        self.assertEqual((events[0]['added'], events[0]['changed'], events[0]['removed']), (['d'], ['b'], ['c']))
+        self.assertEqual(events[0]['device_type_id'], self.device_type.id)
+
+    def test_unchanged_controls_write_nothing(self):
+        diff = sync_controls(self.template, self._controls(('a', 'A'), ('b', 'B'), ('c', 'C')))
+        self.assertFalse(diff)
+
+    def test_reorder_recreates_only_from_first_moved_control(self):
+        before = self._ids()
+        sync_controls(self.template, self._controls(('a', 'A'), ('c', 'C'), ('b', 'B')))
+        after = self._ids()
+        self.assertEqual(after['a'], before['a'])
+        self.assertEqual(after['c'], before['c'])
+        self.assertNotEqual(after['b'], before['b'])
+        ordered = list(self.template.controls.order_by('id').values_list('variable_mapping', flat=True))
+        self.assertEqual(ordered, ['a', 'c', 'b'])
+
+    def test_admin_edit_preserves_control_ids(self):
+        before = self._ids()
+        self.client.force_authenticate(user=self.admin)
+        response = self.client.patch(f'/api/admin/device-types/{self.device_type.id}/', {
+            'definition': self.device_type.definition,
+            'card_template': {'layout_config': {}, 'controls': self._controls(('a', 'A'), ('b', 'B'), ('c', 'Changed'))},
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.data)
+        self.assertEqual(self._ids(), before)
+
+    def test_duplicate_mapping_rejected(self):
+        self.client.force_authenticate(user=self.admin)
+        response = self.client.patch(f'/api/admin/device-types/{self.device_type.id}/', {
+            'definition': self.device_type.definition,
+            'card_template': {'layout_config': {}, 'controls': self._controls(('a', 'A'), ('a', 'Again'))},
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('more than one control', str(response.data))
+
+
+class FixtureCatalogTest(HomeForgeTestCase):
+    """Tests for the memoized default-types catalog (api/fixture_catalog.py)."""
+
+    def setUp(self):
+        super().setUp()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.fixture = os.path.join(self.tmp.name, 'defaults.json')
+        self.firmware = os.path.join(self.tmp.name, 'fw.ino')
+        with open(self.fixture, 'w') as f:
+            json.dump([{'name': 'Fixture Relay', 'definition': {}, 'firmware_code_file': 'fw.ino'}], f)
+        self._write(self.firmware, 'v1')
+        self.catalog = FixtureCatalog(self.fixture, self.tmp.name)
+
+    def _write(self, path, content):
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def test_loads_once_until_a_file_changes(self):
+        self.assertEqual(self.catalog.device_types()[0]['firmware_code'], 'v1')
+        self.catalog.device_types()
+        self.assertEqual(self.catalog.loads, 1)
+
+        mtime = os.stat(self.firmware).st_mtime_ns
+        self._write(self.firmware, 'v2')
+        os.utime(self.firmware, ns=(mtime + 10 ** 9, mtime + 10 ** 9))  # coarse mtime filesystems
+        self.assertEqual(self.catalog.device_types()[0]['firmware_code'], 'v2')
+        self.assertEqual(self.catalog.loads, 2)
+
+    def test_missing_fixture(self):
+        with self.assertRaises(FileNotFoundError):
+            FixtureCatalog(os.path.join(self.tmp.name, 'nope.json'), self.tmp.name).device_types()
+
+    def test_import_defaults_endpoint(self):
+        admin = self.create_user('fixtureadmin', admin=True)
+        self.client.force_authenticate(user=admin)
+
+        response = self.client.post('/api/device-types/import-defaults/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['created_count'], len(default_types.names()))
+        relay = CustomDeviceType.objects.get(name='ESP32 Relay Switch')
+        self.assertIn('wifi_ssid', relay.firmware_code)
+        self.assertTrue(relay.card_template.controls.exists())
+
+        response = self.client.get('/api/device-types/import-defaults/')
+        self.assertEqual(response.data['imported'], response.data['total'])
+        response = self.client.post('/api/device-types/import-defaults/')
+        self.assertEqual(response.data['created_count'], 0)
+
+
+class TopologyCacheTest(HomeForgeTestCase):
+    """Tests for the cached topology layout and status patches (api/topology.py)."""
+
+    def setUp(self):
+        super().setUp()
+        self.user = self.create_user('topouser')
+        self.device_type = self.create_device_type('Topo Type')
+        self.room = Room.objects.create(name='Lab', user=self.user)
+        self.online = Device.objects.create(
+            name='Sensor', ip_address='10.0.0.2', mac_address='AA:BB', status=Device.STATUS_ONLINE,
+            device_type=self.device_type, user=self.user, room=self.room, current_state={'t': 21},
+        )
+        self.offline = Device.objects.create(
+            name='Plug', ip_address='10.0.0.3', device_type=self.device_type, user=self.user,
+        )
+        self.client.force_authenticate(user=self.user)
+
+    def _node(self, data, device):
+        return next(n for n in data['nodes'] if n['id'] == str(device.id))
+
+    def test_overlay_matches_device_status(self):
+        data = self.client.get('/api/topology/').data
+        self.assertEqual(len(data['nodes']), 3)
+        node = self._node(data, self.online)
+        self.assertEqual(node['data']['status'], 'online')
+        self.assertEqual(node['data']['current_state'], {'t': 21})
+        self.assertEqual(node['data']['room'], 'Lab')
+        self.assertEqual(node['style']['borderColor'], '#10B981')
+        self.assertEqual(node['style']['borderStyle'], 'solid')
+        self.assertEqual(self._node(data, self.offline)['style']['opacity'], 0.6)
+        edge = next(e for e in data['edges'] if e['target'] == str(self.online.id))
+        self.assertTrue(edge['animated'])
+
+    def test_heartbeat_reuses_layout_and_rename_rebuilds_it(self):
+        first = self.client.get('/api/topology/').data
+        with self.assertNumQueries(2):  # layout generation + statuses
+            self.client.get('/api/topology/')
+
+        self.offline.status = Device.STATUS_ONLINE
+        self.offline.current_state = {'on': True}
+        self.offline.save(update_fields=['status', 'current_state', 'updated_at'])
+        second = self.client.get('/api/topology/').data
+        self.assertEqual(second['layout_version'], first['layout_version'])
+        self.assertEqual(self._node(second, self.offline)['data']['status'], 'online')
+
+        self.offline.name = 'Renamed Plug'
+        self.offline.save()
+        third = self.client.get('/api/topology/').data
+        self.assertNotEqual(third['layout_version'], first['layout_version'])
+        self.assertEqual(self._node(third, self.offline)['data']['label'], 'Renamed Plug')
+
+    def test_mac_bound_in_listener_process_rebuilds_layout(self):
+        node = self._node(self.client.get('/api/topology/').data, self.offline)
+        self.assertEqual((node['data']['is_bound'], node['style']['borderStyle']), (False, 'dashed'))
+        message = SimpleNamespace(topic='homeforge/devices/CC:03/state', payload=json.dumps({'ip': '10.0.0.3'}).encode())
+        # The listener has a LocMemCache of its own
+        with mock.patch('api.caching.cache', LocMemCache('topology-listener', {})):
+            Command(stdout=StringIO()).on_message(None, None, message)
+        node = self._node(self.client.get('/api/topology/').data, self.offline)
+        self.assertEqual((node['data']['mac'], node['data']['is_bound']), ('CC:03', True))
+        self.assertEqual(node['style']['borderStyle'], 'solid')
+
+    def test_status_endpoint_returns_only_changes(self):
+        first = self.client.get('/api/topology/status/').data
+        self.assertTrue(first['full'])
+        self.assertEqual(len(first['nodes']), 2)
+
+        unchanged = self.client.get('/api/topology/status/', {'since': first['cursor']}).data
+        self.assertEqual((unchanged['full'], unchanged['nodes'], unchanged['cursor']), (False, [], first['cursor']))
+
+        Device.objects.filter(pk=self.offline.pk).update(status=Device.STATUS_ERROR)
+        changed = self.client.get('/api/topology/status/', {'since': first['cursor']}).data
+        self.assertEqual([n['id'] for n in changed['nodes']], [str(self.offline.id)])
+        self.assertEqual(changed['nodes'][0]['color'], '#F59E0B')
+
+        unknown = self.client.get('/api/topology/status/', {'since': 'expired'}).data
+        self.assertTrue(unknown['full'])
+
+
+class TopologyLayoutTest(HomeForgeTestCase):
+    """Tests for the vectorized layout engine (api/topology_layout.py)."""
+
+    def setUp(self):
+        super().setUp()
+        self.user = self.create_user('layoutuser')
+        self.device_type = self.create_device_type('Layout Type')
+        self.rooms = [Room.objects.create(name=f'Room {i}', user=self.user) for i in range(3)]
+        for i in range(12):
+            Device.objects.create(name=f'D{i}', ip_address=f'10.0.1.{i + 1}', device_type=self.device_type,
+                                  user=self.user, room=self.rooms[i % 3] if i < 10 else None,
+                                  status=Device.STATUS_ONLINE if i % 2 else Device.STATUS_OFFLINE)
+        self.client.force_authenticate(user=self.user)
+
+    def _positions(self, data):
+        return {n['id']: np.array([n['position']['x'], n['position']['y']]) for n in data['nodes'] if n['type'] == 'device'}
+
+    def test_ring_engine_does_not_overlap(self):
+        _, positions = ring_positions([5, 40, 1, 200])
+        dist = np.linalg.norm(positions[:, None] - positions[None], axis=-1)
+        np.fill_diagonal(dist, np.inf)
+        self.assertGreaterEqual(dist.min(), NODE_SPACING - 1e-6)
+
+    def test_defaults_are_radial_devices(self):
+        data = self.client.get('/api/topology/').data
+        self.assertEqual((data['layout'], data['lod']), ('radial', 'devices'))
+        self.assertFalse([n for n in data['nodes'] if n['type'] == 'room'])
+        radii = {round(float(np.linalg.norm(p))) for p in self._positions(data).values()}
+        self.assertEqual(radii, {350})
+
+    def test_rings_cluster_devices_by_room(self):
+        data = self.client.get('/api/topology/', {'layout': 'rings'}).data
+        self.assertEqual((data['layout'], data['lod']), ('rings', 'devices'))
+        positions = self._positions(data)
+        rooms = {n['id']: n['data']['room'] for n in data['nodes'] if n['type'] == 'device'}
+        centroids = {r: np.mean([p for i, p in positions.items() if rooms[i] == r], axis=0) for r in set(rooms.values())}
+        for node_id, pos in positions.items():
+            nearest = min(centroids, key=lambda r: np.linalg.norm(pos - centroids[r]))
+            self.assertEqual(nearest, rooms[node_id])
+
+    def test_force_layout_stays_stable_when_a_device_is_added(self):
+        before = self._positions(self.client.get('/api/topology/', {'layout': 'force'}).data)
+        Device.objects.create(name='New', ip_address='10.0.1.99', device_type=self.device_type,
+                              user=self.user, room=self.rooms[0])
+        after = self._positions(self.client.get('/api/topology/', {'layout': 'force'}).data)
+        self.assertEqual(len(after), len(before) + 1)
+        moved = max(np.linalg.norm(after[i] - before[i]) for i in before)
+        self.assertLess(moved, 1)  # existing devices are pinned on a warm start
+
+    def test_force_layout_reports_rings_fallback(self):
+        with mock.patch('api.topology_layout.FORCE_MAX_NODES', 10):
+            data = self.client.get('/api/topology/', {'layout': 'force'}).data
+        self.assertEqual(data['layout'], 'rings')
+        rings = self.client.get('/api/topology/', {'layout': 'rings'}).data
+        self.assertEqual(self._positions(data).keys(), self._positions(rings).keys())
+        for node_id, position in self._positions(data).items():
+            np.testing.assert_allclose(position, self._positions(rings)[node_id])
+
+    def test_room_level_of_detail(self):
+        data = self.client.get('/api/topology/', {'lod': 'rooms'}).data
+        rooms = [n for n in data['nodes'] if n['type'] == 'room']
+        self.assertEqual(len(rooms), 4)  # three rooms + unassigned
+        self.assertEqual(sum(n['data']['device_count'] for n in rooms), 12)
+        unassigned = next(n for n in rooms if n['id'] == 'room-unassigned')
+        self.assertEqual(unassigned['data']['status_counts'], {'online': 1, 'offline': 1, 'error': 0})
+        self.assertEqual(unassigned['style']['borderColor'], '#F59E0B')
+
+        with override_settings(TOPOLOGY_LOD_THRESHOLD=5):
+            self.assertEqual(self.client.get('/api/topology/').data['lod'], 'devices')  # opt-in only
+            self.assertEqual(self.client.get('/api/topology/', {'lod': 'auto'}).data['lod'], 'rooms')
+        self.assertEqual(self.client.get('/api/topology/', {'layout': 'spiral'}).status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class DashboardBootstrapTest(HomeForgeTestCase):
+    """Tests for the single-request dashboard bootstrap (api/dashboard_bootstrap.py)."""
+
+    def setUp(self):
+        super().setUp()
+        self.user = self.create_user('bootuser')
+        self.room = Room.objects.create(name='Kitchen', user=self.user)
+        self.approved = self.create_device_type(
+            'Boot Light', controls=[('TOGGLE', 'Power', 'on')], firmware_code='void loop() {}'
+        )
+        CustomDeviceType.objects.create(name='Pending Type', definition={}, approved=False)
+        for i in range(3):
+            Device.objects.create(
+                name=f'Boot {i}', ip_address=f'10.1.0.{i}', device_type=self.approved,
+                user=self.user, room=self.room,
+            )
+        self.client.force_authenticate(user=self.user)
+
+    def test_payload_sections(self):
+        DashboardLayout.objects.create(user=None, layout={'tiles': []}, device_order=DashboardLayout.ORDER_ROOM)
+        Notification.objects.create(user=self.user, title='t', message='m', notification_type='info')
+        response = self.client.get('/api/dashboard/bootstrap/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.json()
+        self.assertEqual(data['profile']['username'], 'bootuser')
+        self.assertEqual((data['devices']['count'], data['devices']['next']), (3, None))
+        self.assertEqual(data['devices']['results'][0]['room_name'], 'Kitchen')
+        self.assertEqual([r['name'] for r in data['rooms']], ['Kitchen'])
+        self.assertEqual([t['name'] for t in data['device_types']], ['Boot Light'])
+        self.assertNotIn('firmware_code', data['device_types'][0])
+        self.assertEqual(data['device_types'][0]['card_template']['controls'][0]['variable_mapping'], 'on')
+        self.assertFalse(data['dashboard_layout']['is_personal'])
+        self.assertEqual(data['device_order'], DashboardLayout.ORDER_ROOM)
+        self.assertEqual(data['notifications'], {'unread_count': 1, 'by_type': {'info': 1}})
+
+    def test_query_count_is_independent_of_device_count(self):
+        self.client.get('/api/dashboard/bootstrap/')  # warm the approved-types cache
+        with self.assertNumQueries(7):
+            self.client.get('/api/dashboard/bootstrap/')
+        for i in range(3, 10):
+            Device.objects.create(
+                name=f'Boot {i}', ip_address=f'10.1.0.{i}', device_type=self.approved,
+                user=self.user, room=self.room,
+            )
+        with self.assertNumQueries(7):
+            self.client.get('/api/dashboard/bootstrap/')
+
+    def test_devices_match_first_page_of_device_list(self):
+        Device.objects.bulk_create(
+            Device(name=f'Bulk {i}', ip_address=f'10.1.1.{i}', device_type=self.approved, user=self.user)
+            for i in range(60)
+        )
+        devices = self.client.get('/api/dashboard/bootstrap/').json()['devices']
+        page = self.client.get('/api/devices/').json()
+        self.assertEqual((devices['count'], devices['previous']), (page['count'], page['previous']))
+        self.assertEqual(devices['next'], page['next'])
+        self.assertTrue(devices['next'].endswith('/api/devices/?page=2'))
+        self.assertEqual([d['id'] for d in devices['results']], [d['id'] for d in page['results']])
+
+    def test_etag_revalidation(self):
+        first = self.client.get('/api/dashboard/bootstrap/')
+        etag = first['ETag']
+        self.assertEqual(self.client.get('/api/dashboard/bootstrap/', HTTP_IF_NONE_MATCH=etag).status_code,
+                         status.HTTP_304_NOT_MODIFIED)
+        # gzip weakens the ETag; the weak form must still revalidate
+        self.assertEqual(self.client.get('/api/dashboard/bootstrap/', HTTP_IF_NONE_MATCH=f'W/{etag}').status_code,
+                         status.HTTP_304_NOT_MODIFIED)
+
+        Device.objects.filter(pk=Device.objects.first().pk).update(status=Device.STATUS_ONLINE)
+        changed = self.client.get('/api/dashboard/bootstrap/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(changed.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(changed['ETag'], etag)
+
+    def test_gzip_when_accepted(self):
+        response = self.client.get('/api/dashboard/bootstrap/', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertTrue(response['ETag'].startswith('W/'))
+        self.assertEqual(len(json.loads(gzip.decompress(response.content))['devices']['results']), 3)
+
+
+class SparseFieldsTest(HomeForgeTestCase):
+    """Tests for ?fields= on list endpoints (api/sparse_fields.py)."""
+
+    def setUp(self):
+        super().setUp()
+        self.user = self.create_user('sparseuser')
+        self.admin = self.create_user('sparseadmin', admin=True)
+        self.device_type = self.create_device_type('Sparse Type')
+        self.room = Room.objects.create(name='Office', user=self.user)
+        for i in range(3):
+            Device.objects.create(
+                name=f'Sparse {i}', ip_address=f'10.2.0.{i}', device_type=self.device_type,
+                user=self.user, room=self.room,
+            )
+        self.client.force_authenticate(user=self.user)
+
+    def test_narrow_fields_produce_narrow_sql(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get('/api/devices/', {'fields': 'id,name,status'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(set(response.data['results'][0]), {'id', 'name', 'status'})
+        select = ctx.captured_queries[-1]['sql']
+        self.assertNotIn('JOIN', select)
+        self.assertNotIn('current_state', select)
+        self.assertEqual(len(ctx.captured_queries), 2)  # count + page
+
+    def test_related_fields_join_only_what_they_read(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get('/api/devices/', {'fields': 'id,room_name,room_id,device_type'})
+        row = response.data['results'][0]
+        self.assertEqual(row, {'id': row['id'], 'room_name': 'Office', 'room_id': self.room.id,
+                               'device_type': self.device_type.id})
+        select = ctx.captured_queries[-1]['sql']
+        self.assertIn('"api_room"', select)
+        self.assertNotIn('"api_customdevicetype"', select)
+        self.assertNotIn('"api_devicecardtemplate"', select)
+
+    def test_nested_and_prefetched_fields(self):
+        template = DeviceCardTemplate.objects.create(device_type=self.device_type, layout_config={})
+        DeviceControl.objects.create(template=template, widget_type='TOGGLE', label='Power', variable_mapping='on')
+        with self.assertNumQueries(4):  # approved ids (cache fill), count, types + template join, controls
+            response = self.client.get('/api/device-types/', {'fields': 'name,card_template'})
+        row = response.data['results'][0]
+        self.assertEqual(set(row), {'name', 'card_template'})
+        self.assertEqual(row['card_template']['controls'][0]['label'], 'Power')
+
+        self.client.force_authenticate(user=self.admin)
+        with self.assertNumQueries(2):
+            users = self.client.get('/api/users/', {'fields': 'username,profile'}).data['results']
+        self.assertEqual({u['profile']['role'] for u in users}, {Profile.ROLE_USER, Profile.ROLE_ADMIN})
+
+    def test_unknown_field_and_writes(self):
+        response = self.client.get('/api/rooms/', {'fields': 'id,colour'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('colour', response.data['fields'])
+        self.assertEqual(set(self.client.get('/api/rooms/', {'fields': 'name'}).data['results'][0]), {'name'})
+
+
+class DeviceListQueryTest(HomeForgeTestCase):
+    """Tests for device list filters, ordering and group_by (api/device_query.py)."""
+
+    def setUp(self):
+        super().setUp()
+        self.user = self.create_user('queryuser')
+        self.light = self.create_device_type('Light')
+        self.sensor = self.create_device_type('Sensor')
+        self.kitchen = Room.objects.create(name='Kitchen', user=self.user)
+        self.bedroom = Room.objects.create(name='Bedroom', user=self.user)
+        specs = [
+            ('Ceiling', self.light, self.kitchen, Device.STATUS_ONLINE),
+            ('Counter', self.light, self.kitchen, Device.STATUS_OFFLINE),
+            ('Thermo', self.sensor, self.bedroom, Device.STATUS_ERROR),
+            ('Attic probe', self.sensor, None, Device.STATUS_ONLINE),
+        ]
+        for i, (name, device_type, room, device_status) in enumerate(specs):
+            Device.objects.create(
+                name=name, ip_address=f'10.3.0.{i}', device_type=device_type,
+                room=room, status=device_status, user=self.user,
+            )
+        self.client.force_authenticate(user=self.user)
+
+    def _names(self, params):
+        response = self.client.get('/api/devices/', params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [d['name'] for d in response.data['results']]
+
+    def test_filters_and_ordering(self):
+        self.assertEqual(self._names({'room': self.kitchen.id, 'ordering': 'name'}), ['Ceiling', 'Counter'])
+        self.assertEqual(self._names({'room': 'none'}), ['Attic probe'])
+        self.assertEqual(self._names({'status': 'online,error', 'ordering': '-name'}), ['Thermo', 'Ceiling', 'Attic probe'])
+        self.assertEqual(self._names({'type': self.sensor.id, 'ordering': 'room'}), ['Thermo', 'Attic probe'])
+        self.assertEqual(self._names({'search': 'cou'}), ['Counter'])
+        self.assertEqual(self._names({'search': '10.3.0.2'}), ['Thermo'])
+        for params in ({'status': 'sleeping'}, {'ordering': 'ip'}, {'room': 'kitchen'}, {'group_by': 'colour'}):
+            self.assertEqual(self.client.get('/api/devices/', params).status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_group_by_room_with_counts(self):
+        with self.assertNumQueries(2):  # counts + devices
+            data = self.client.get('/api/devices/', {'group_by': 'room', 'fields': 'name'}).data
+        self.assertEqual(data['count'], 4)
+        self.assertEqual(
+            [(g['label'], g['count'], [d['name'] for d in g['devices']]) for g in data['groups']],
+            [('Bedroom', 1, ['Thermo']), ('Kitchen', 2, ['Ceiling', 'Counter']), ('Unassigned', 1, ['Attic probe'])],
+        )
+        self.assertEqual(data['groups'][2]['key'], None)
+
+    def test_group_by_status_type_and_name(self):
+        data = self.client.get('/api/devices/', {'group_by': 'status'}).data
+        self.assertEqual([(g['key'], g['count']) for g in data['groups']], [('online', 2), ('offline', 1), ('error', 1)])
+        self.assertEqual(data['groups'][0]['label'], 'Online')
+
+        data = self.client.get('/api/devices/', {'group_by': 'type', 'room': self.kitchen.id}).data
+        self.assertEqual([(g['label'], g['count']) for g in data['groups']], [('Light', 2)])
+
+        data = self.client.get('/api/devices/', {'group_by': 'name'}).data
+        self.assertEqual(len(data['groups']), 1)
+        self.assertEqual([d['name'] for d in data['groups'][0]['devices']], ['Attic probe', 'Ceiling', 'Counter', 'Thermo'])
+
+
+class HomeSummaryTest(HomeForgeTestCase):
+    """Tests for GET /api/summary/ (api/home_summary.py)."""
+
+    def setUp(self):
+        super().setUp()
+        self.user = self.create_user('summaryuser')
+        self.sensor = self.create_device_type(
+            'Climate', controls=[('TEMPERATURE', 'Temp', 'temp-1'), ('HUMIDITY', 'Hum', 'hum-1')]
+        )
+        self.light = self.create_device_type('Light')
+        self.kitchen = Room.objects.create(name='Kitchen', user=self.user)
+        self.sensors = [
+            Device.objects.create(
+                name=f'Climate {i}', ip_address=f'10.4.0.{i}', device_type=self.sensor, room=self.kitchen,
+                user=self.user, status=Device.STATUS_ONLINE, current_state=state,
+            )
+            for i, state in enumerate([{'temp-1': 20, 'hum-1': 40}, {'temp-1': 23.5, 'hum-1': 'n/a'}])
+        ]
+        # Offline readings are stale and not averaged
+        Device.objects.create(
+            name='Old climate', ip_address='10.4.0.9', device_type=self.sensor, room=self.kitchen,
+            user=self.user, current_state={'temp-1': 99},
+        )
+        Device.objects.create(
+            name='Lamp', ip_address='10.4.0.10', device_type=self.light, user=self.user, status=Device.STATUS_ERROR,
+        )
+        self.client.force_authenticate(user=self.user)
+
+    def test_counts_and_averages(self):
+        with self.assertNumQueries(3):  # shared generation + the two aggregates
+            data = self.client.get('/api/summary/').data
+        self.assertEqual(data['totals'], {'devices': 4, 'online': 2, 'offline': 1, 'error': 1})
+        kitchen, unassigned = data['rooms']
+        self.assertEqual((kitchen['name'], kitchen['devices'], kitchen['online'], kitchen['offline']), ('Kitchen', 3, 2, 1))
+        self.assertEqual(kitchen['temperature'], 21.8)
+        self.assertEqual(kitchen['humidity'], 40.0)
+        self.assertEqual((unassigned['id'], unassigned['name'], unassigned['error']), (None, 'Unassigned', 1))
+        self.assertIsNone(unassigned['temperature'])
+        self.assertEqual([(t['name'], t['devices']) for t in data['types']], [('Climate', 3), ('Light', 1)])
+
+    def test_cached_until_status_changes(self):
+        self.client.get('/api/summary/')
+        device = self.sensors[0]
+        device.current_state = {'temp-1': 30}
+        device.save(update_fields=['current_state', 'status', 'updated_at'])  # heartbeat
+        with self.assertNumQueries(1):  # shared generation only
+            self.assertEqual(self.client.get('/api/summary/').data['totals']['online'], 2)
+
+        device.status = Device.STATUS_OFFLINE
+        device.save(update_fields=['status'])
+        device_status_changed.send(sender=Device, device=device, previous=Device.STATUS_ONLINE)
+        data = self.client.get('/api/summary/').data
+        self.assertEqual(data['totals']['online'], 1)
+        self.assertEqual(data['rooms'][0]['temperature'], 23.5)
+
+        Room.objects.create(name='Attic', user=self.user)
+        self.sensors[1].room = Room.objects.get(name='Attic')
+        self.sensors[1].save()
+        self.assertEqual([r['name'] for r in self.client.get('/api/summary/').data['rooms']], ['Attic', 'Kitchen', 'Unassigned'])
+
+    def test_status_change_in_listener_process_invalidates_api_cache(self):
+        self.assertEqual(self.client.get('/api/summary/').data['totals']['online'], 2)
+        # The listener has a LocMemCache of its own
+        with mock.patch('api.caching.cache', LocMemCache('listener', {})):
+            Device.objects.filter(pk=self.sensors[0].pk).update(status=Device.STATUS_OFFLINE)
+            device_status_changed.send(sender=Device, device=self.sensors[0], previous=Device.STATUS_ONLINE)
+        self.assertEqual(self.client.get('/api/summary/').data['totals']['online'], 1)
+
+
+class DeviceStateQueryTest(HomeForgeTestCase):
+    """Tests for state.* predicates on the device list (api/device_query.py)."""
+
+    def setUp(self):
+        super().setUp()
+        self.user = self.create_user('stateuser')
+        device_type = self.create_device_type('State Type')
+        states = {
+            'Relay on': {'relay_1': True, 'battery': 80},
+            'Relay off': {'relay_1': False, 'battery': 15},
+            'Hot sensor': {'temp-1': 27.5, 'battery': 'low', 'mode': 'heat'},
+            'Cold sensor': {'temp-1': 19},
+        }
+        for i, (name, state) in enumerate(states.items()):
+            Device.objects.create(
+                name=name, ip_address=f'10.5.0.{i}', device_type=device_type, user=self.user, current_state=state,
+            )
+        self.client.force_authenticate(user=self.user)
+
+    def _names(self, params):
+        response = self.client.get('/api/devices/', {'ordering': 'name', **params})
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.data)
+        return [d['name'] for d in response.data['results']]
+
+    def test_equality_existence_and_range(self):
+        self.assertEqual(self._names({'state.relay_1': 'true'}), ['Relay on'])
+        self.assertEqual(self._names({'state.mode': 'heat'}), ['Hot sensor'])
+        self.assertEqual(self._names({'state.relay_1__exists': 'true'}), ['Relay off', 'Relay on'])
+        self.assertEqual(self._names({'state.battery__exists': 'false'}), ['Cold sensor'])
+        # Non-numeric values never match a range
+        self.assertEqual(self._names({'state.battery__lt': '20'}), ['Relay off'])
+        self.assertEqual(self._names({'state.temp-1__gt': '26'}), ['Hot sensor'])
+        self.assertEqual(self._names({'state.temp-1__gte': '19', 'state.temp-1__lte': '19'}), ['Cold sensor'])
+
+    def test_combines_with_grouping_and_rejects_bad_values(self):
+        data = self.client.get('/api/devices/', {'state.battery__gte': '0', 'group_by': 'status'}).data
+        self.assertEqual(data['count'], 2)
+        for params in ({'state.battery__lt': 'low'}, {'state.relay_1__exists': 'yes'}, {'state.': '1'}):
+            self.assertEqual(self.client.get('/api/devices/', params).status_code, status.HTTP_400_BAD_REQUEST)
+
+    @skipUnless(connection.vendor == 'postgresql', 'JSONB indexes are PostgreSQL-only')
+    def test_predicates_use_indexes(self):
+        with connection.cursor() as cursor:
+            cursor.execute('SET enable_seqscan = off')
+        try:
+            devices = Device.objects.all()
+            self.assertIn('device_state_gin_idx', state_filter(devices, 'relay_1', 'eq', True).explain())
+            self.assertIn('device_state_gin_idx', state_filter(devices, 'relay_1', 'exists', True).explain())
+            self.assertIn('device_state_gin_idx', state_filter(devices, 'temp-1', 'gt', 26).explain())
+            self.assertIn('device_state_battery_idx', state_filter(devices, 'battery', 'lt', 20).explain())
+        finally:
+            with connection.cursor() as cursor:
+                cursor.execute('SET enable_seqscan = on')
+
+
+class DeviceStateMergeTest(HomeForgeTestCase):
+    """Tests for server-side state merges (api/device_state.py) and the MQTT listener."""
+
+    def setUp(self):
+        super().setUp()
+        self.user = self.create_user('mergeuser')
+        self.device_type = self.create_device_type(
+            'Merge Type', controls=[('TEMPERATURE', 'Temp', 'temp-1'), ('TOGGLE', 'Power', 'power-1')]
+        )
+        self.device = Device.objects.create(
+            name='Merge', ip_address='10.6.0.1', mac_address='AA:01', device_type=self.device_type, user=self.user,
+            current_state={'temperature': 18, 'temp-1': 18, 'note': 'keep'},
+        )
+
+    def _message(self, payload):
+        return SimpleNamespace(topic='homeforge/devices/AA:01/state', payload=json.dumps(payload).encode())
+
+    def test_merge_is_one_update_and_keeps_other_keys(self):
+        with self.assertNumQueries(1):
+            merge_state(Device.objects.filter(pk=self.device.pk), {'temp-1': 21.5, 'extra': {'a': [1]}}, ['temperature'],
+                        status=Device.STATUS_ONLINE)
+        self.device.refresh_from_db()
+        self.assertEqual(self.device.current_state, {'temp-1': 21.5, 'note': 'keep', 'extra': {'a': [1]}})
+        self.assertEqual(self.device.status, Device.STATUS_ONLINE)
+
+    def test_remap_state(self):
+        controls = type_controls(self.device_type.id)
+        self.assertEqual(
+            remap_state(controls, {'temperature': 20, 'relay_1': True, 'rssi': -60}),
+            ({'temp-1': 20, 'power-1': True, 'rssi': -60}, {'temperature', 'relay_1'}),
+        )
+
+    def test_listener_merges_without_clobbering_concurrent_edits(self):
+        received = []
+        handler = lambda sender, device, previous, **kwargs: received.append((device.pk, previous))
+        device_status_changed.connect(handler)
+        self.addCleanup(device_status_changed.disconnect, handler)
+
+        command = Command(stdout=StringIO())
+        # Renamed via the API; the merge must only write telemetry columns
+        Device.objects.filter(pk=self.device.pk).update(name='Renamed')
+        command.on_message(None, None, self._message({'temperature': 22, 'relay_1': False}))
+
+        self.device.refresh_from_db()
+        self.assertEqual(self.device.name, 'Renamed')
+        self.assertEqual(self.device.current_state, {'temp-1': 22, 'note': 'keep', 'power-1': False})
+        self.assertEqual(received, [(self.device.pk, Device.STATUS_OFFLINE)])
+
+        # Already online: no status event, controls come from the cache
+        with self.assertNumQueries(3):  # identity lookup + controls generation + merge
+            command.on_message(None, None, self._message({'temperature': 23}))
+        self.assertEqual(len(received), 1)
+
+    def test_control_edit_in_api_process_reaches_listener(self):
+        command = Command(stdout=StringIO())
+        # The listener has a LocMemCache of its own
+        listener_cache = LocMemCache('controls-listener', {})
+        with mock.patch('api.caching.cache', listener_cache):
+            command.on_message(None, None, self._message({'temperature': 22}))
+        with self.captureOnCommitCallbacks(execute=True):
+            sync_controls(self.device_type.card_template, [
+                {'widget_type': 'TEMPERATURE', 'label': 'Temp', 'variable_mapping': 'temp-2'},
+                {'widget_type': 'TOGGLE', 'label': 'Power', 'variable_mapping': 'power-1'},
+            ])
+        with mock.patch('api.caching.cache', listener_cache):
+            command.on_message(None, None, self._message({'temperature': 23}))
+        self.device.refresh_from_db()
+        self.assertEqual(self.device.current_state['temp-2'], 23)
+        self.assertEqual(self.device.current_state['temp-1'], 22)
+
+
+class MQTTPublisherTest(TestCase):
+    """Tests for the non-blocking command publisher (api/mqtt_client.py)."""
+
+    class FakeClient:
+        def __init__(self):
+            self.sent = []
+            self.cids = []
+            self.qos = []
+            self.rc = 0
+            self.started = False
+
+        def reconnect_delay_set(self, min_delay, max_delay):
+            self.delays = (min_delay, max_delay)
+
+        def connect_async(self, host, port, keepalive):
+            pass
+
+        def loop_start(self):
+            self.started = True
+
+        def publish(self, topic, payload, qos=0):
+            if self.rc == 0:
+                data = json.loads(payload)
+                self.cids.append(data.pop('_cid'))
+                self.sent.append((topic, json.dumps(data)))
+                self.qos.append(qos)
+            return SimpleNamespace(rc=self.rc)
+
+    def _publisher(self):
+        self.clients = []
+
+        def factory():
+            self.clients.append(self.FakeClient())
+            return self.clients[-1]
+        return MQTTPublisher(client_factory=factory)
+
+    @override_settings(MQTT_OUTBOX_SIZE=2)
+    def test_buffers_while_disconnected_and_flushes_on_connect(self):
+        publisher = self._publisher()
+        for n in range(3):
+            publisher.publish('AA:01', {'relay_1': n})
+        client = self.clients[0]
+        self.assertTrue(client.started)
+        self.assertEqual(client.sent, [])
+        self.assertEqual(publisher.stats()['queued'], 2)
+        self.assertEqual(publisher.stats()['dropped'], 1)
+
+        publisher._on_connect(client, None, None, 0)
+        self.assertEqual(client.sent, [
+            ('homeforge/devices/AA:01/command', '{"relay_1": 1}'),
+            ('homeforge/devices/AA:01/command', '{"relay_1": 2}'),
+        ])
+        publisher.publish('AA:01', {'relay_1': 3})
+        self.assertEqual(len(client.sent), 3)
+        self.assertEqual(publisher.stats()['queued'], 0)
+
+        # Lost connection mid-publish: the command waits for the next connect
+        client.rc = 4
+        publisher.publish('AA:01', {'relay_1': 4})
+        publisher._on_disconnect(client, None, None, 7)
+        client.rc = 0
+        publisher._on_connect(client, None, None, 0)
+        self.assertEqual(client.sent[-1], ('homeforge/devices/AA:01/command', '{"relay_1": 4}'))
+        self.assertEqual(len(set(client.cids)), len(client.cids))  # one correlation ID per command
+
+    @override_settings(MQTT_OUTBOX_TTL=1)
+    def test_expired_commands_are_not_delivered(self):
+        publisher = self._publisher()
+        publisher.publish('AA:01', {'relay_1': True})
+        topic, payload, queued_at = publisher._outbox[0]
+        publisher._outbox[0] = (topic, payload, queued_at - 5)
+        publisher._on_connect(self.clients[0], None, None, 0)
+        self.assertEqual(self.clients[0].sent, [])
+        self.assertEqual(publisher.stats()['expired'], 1)
+
+    def test_commands_publish_at_configured_qos(self):
+        publisher = self._publisher()
+        publisher.publish('AA:01', {'relay_1': True})
+        publisher._on_connect(self.clients[0], None, None, 0)
+        with override_settings(MQTT_COMMAND_QOS=1):
+            publisher.publish('AA:01', {'relay_1': False})
+        with override_settings(MQTT_OFFLINE_DELIVERY='queue'):
+            publisher.publish('AA:01', {'relay_1': True})
+        with override_settings(MQTT_OFFLINE_DELIVERY='session'):
+            publisher.publish('AA:01', {'relay_1': False})
+        self.assertEqual(self.clients[0].qos, [0, 1, 0, 1])
+
+    def test_forked_process_starts_its_own_client(self):
+        publisher = self._publisher()
+        publisher.publish('AA:01', {'relay_1': True})
+        publisher._on_connect(self.clients[0], None, None, 0)
+        publisher.publish('AA:01', {'relay_1': False})
+        self.assertEqual(len(self.clients), 1)
+
+        publisher._pid = -1  # as seen from a forked child
+        publisher.publish('AA:01', {'relay_1': True})
+        self.assertEqual(len(self.clients), 2)
+        self.assertEqual(publisher.stats()['queued'], 1)  # new client not connected yet
+        self.assertEqual(publisher.stats()['published'], 0)
+
+        publisher._after_fork()
+        self.assertIsNone(publisher.client)
+        self.assertEqual(publisher.stats()['queued'], 0)
+
+
+class CommandCoalescerTest(HomeForgeTestCase):
+    """Tests for per-device command coalescing (api/command_coalescer.py)."""
+
+    class FakePublisher:
+        def __init__(self):
+            self.sent = []
+
+        def publish_many(self, commands):
+            self.sent.extend(commands)
+
+    def setUp(self):
+        super().setUp()
+        self.publisher = self.FakePublisher()
+        self.coalescer = CommandCoalescer(publisher=self.publisher)
+
+    def test_commands_within_window_are_merged(self):
+        self.coalescer.submit('AA:01', {'bright-1': 10}, window=60)
+        self.assertEqual(self.publisher.sent, [('AA:01', {'bright-1': 10})])
+        for value in (20, 30, 40):
+            self.coalescer.submit('AA:01', {'bright-1': value, 'step': value}, window=60)
+        self.coalescer.submit('AA:02', {'bright-1': 5}, window=60)  # other devices are independent
+        self.assertEqual(len(self.publisher.sent), 2)
+        self.assertEqual(self.coalescer.stats()['pending'], 1)
+
+        self.coalescer.flush('AA:01')  # window ended
+        self.assertEqual(self.publisher.sent[-1], ('AA:01', {'bright-1': 40, 'step': 40}))
+        self.assertEqual(self.coalescer.stats(), {'submitted': 5, 'published': 3, 'merged': 2, 'pending': 0})
+
+    def test_unwindowed_command_flushes_pending_in_order(self):
+        self.coalescer.submit('AA:01', {'bright-1': 10}, window=60)
+        self.coalescer.submit('AA:01', {'bright-1': 20}, window=60)
+        self.coalescer.submit('AA:01', {'button-1': True})
+        self.assertEqual(self.publisher.sent, [
+            ('AA:01', {'bright-1': 10}),
+            ('AA:01', {'bright-1': 20, 'button-1': True}),
+        ])
+        self.coalescer.submit('AA:01', {'button-1': True})
+        self.assertEqual(len(self.publisher.sent), 3)
+
+    @override_settings(MQTT_COALESCE_WINDOWS={'SLIDER': 150, 'TOGGLE': 100})
+    def test_window_follows_widget_types(self):
+        device_type = self.create_device_type('Dimmer')
+        template = DeviceCardTemplate.objects.create(device_type=device_type, layout_config={})
+        DeviceControl.objects.create(template=template, widget_type='SLIDER', label='Level', variable_mapping='level-1')
+        DeviceControl.objects.create(template=template, widget_type='TOGGLE', label='Power', variable_mapping='power-1')
+        DeviceControl.objects.create(template=template, widget_type='BUTTON', label='Scene', variable_mapping='scene-1')
+
+        self.assertEqual(command_window(device_type.id, {'level-1': 3}), 0.15)
+        self.assertEqual(command_window(device_type.id, {'relay_1': True}), 0.1)  # standard key -> TOGGLE
+        self.assertEqual(command_window(device_type.id, {'scene-1': True, 'power-1': True}), 0.1)
+        self.assertEqual(command_window(device_type.id, {'scene-1': True}), 0)
+        self.assertEqual(command_window(None, {'level-1': 3}), 0)
+
+    def test_mqtt_stats_endpoint_is_admin_only(self):
+        user = self.create_user('mqttstats')
+        self.client.force_authenticate(user=user)
+        response = self.client.get('/api/admin/mqtt-stats/')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        user.profile.role = Profile.ROLE_ADMIN
+        user.profile.save()
+        response = self.client.get('/api/admin/mqtt-stats/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('merged', response.data['coalescer'])
+        self.assertIn('queued', response.data['publisher'])
+
+
+class DeviceBulkStateTest(HomeForgeTestCase):
+    """Tests for POST /api/devices/bulk-state/ (api/device_commands.py)."""
+
+    def setUp(self):
+        super().setUp()
+        self.user = self.create_user('bulkuser')
+        self.client.force_authenticate(user=self.user)
+        self.room = Room.objects.create(name='Living', user=self.user)
+        device_type = self.create_device_type('Bulk Light')
+        self.lights = [
+            Device.objects.create(name=f'Light {i}', ip_address=f'10.7.0.{i}', mac_address=f'BB:0{i}',
+                                  room=self.room, device_type=device_type, user=self.user, status=Device.STATUS_ONLINE)
+            for i in range(3)
+        ]
+        self.unbound = Device.objects.create(name='New', ip_address='10.7.0.9', room=self.room,
+                                              device_type=device_type, user=self.user)
+        self.other = Device.objects.create(name='Hall', ip_address='10.7.1.1', mac_address='BB:99',
+                                           device_type=device_type, user=self.user, status=Device.STATUS_ONLINE)
+
+        self.sent = []
+        publisher = mock.Mock()
+        publisher.publish_many.side_effect = lambda commands: self.sent.append(list(commands))
+        self.patch_coalescer('api.device_commands.command_coalescer', CommandCoalescer(publisher=publisher))
+
+    def test_room_selector_resolves_in_one_query_and_publishes_once(self):
+        type_controls(self.other.device_type_id)  # controls come from the cache
+        with self.assertNumQueries(3):  # targets + controls generation + desired_state of all of them
+            response = self.client.post('/api/devices/bulk-state/', {'room': self.room.id, 'state': {'power': False}},
+                                        format='json')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.data['accepted'], 3)
+        by_id = {result['id']: result for result in response.data['results']}
+        self.assertFalse(by_id[self.unbound.id]['accepted'])
+        self.assertNotIn(self.other.id, by_id)
+        # One batch, with the single-relay compatibility key added
+        self.assertEqual(self.sent, [[(f'BB:0{i}', {'power': False, 'relay_1': False}) for i in range(3)]])
+
+    def test_device_ids_report_missing_devices(self):
+        response = self.client.post('/api/devices/bulk-state/', {
+            'devices': [self.other.id, self.lights[0].id, 999999, self.other.id],
+            'state': {'relay_1': True},
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(
+            [(r['id'], r['accepted']) for r in response.data['results']],
+            [(self.lights[0].id, True), (self.other.id, True), (999999, False)],
+        )
+        self.assertEqual(len(self.sent[0]), 2)
+
+    def test_validation(self):
+        for body in (
+            {'state': {'relay_1': True}},
+            {'room': self.room.id, 'devices': [self.other.id], 'state': {'relay_1': True}},
+            {'room': self.room.id, 'state': {}},
+            {'devices': ['x'], 'state': {'relay_1': True}},
+        ):
+            response = self.client.post('/api/devices/bulk-state/', body, format='json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, body)
+            self.assertIn('detail', response.data)
+        self.assertEqual(self.sent, [])
+
+
+class CommandTrackingTest(HomeForgeTestCase):
+    """Tests for command acknowledgement tracking (api/command_tracking.py)."""
+
+    def setUp(self):
+        super().setUp()
+        self.now = 100.0
+        self.tracker = CommandTracker(timeout=10, max_pending=3, clock=lambda: self.now)
+
+    def test_report_confirms_matching_command(self):
+        self.tracker.track('AA:01', {'switch-1': 'on', 'relay_1': 'on', '_cid': 'c1'})
+        self.now += 0.2
+        self.assertEqual(self.tracker.confirm('AA:01', {'relay_1': False}), [])  # not applied yet
+        self.assertEqual(self.tracker.confirm('AA:02', {'relay_1': True}), [])  # other device
+        self.assertEqual(self.tracker.confirm('AA:01', {'relay_1': True, 'temperature': 21}), ['c1'])
+
+        snapshot = self.tracker.snapshot()
+        self.assertEqual(snapshot['pending'], 0)
+        self.assertEqual(snapshot['latency']['count'], 1)
+        self.assertEqual(snapshot['latency']['p50_ms'], 250)
+        self.assertEqual(snapshot['devices']['AA:01']['confirmed'], 1)
+        self.assertEqual(snapshot['devices']['AA:01']['failure_rate'], 0)
+
+    def test_timeouts_supersession_and_bound(self):
+        self.tracker.track('AA:01', {'relay_1': True, '_cid': 'c1'})
+        self.tracker.track('AA:01', {'relay_1': False, '_cid': 'c2'})  # supersedes c1
+        self.tracker.track('AA:02', {'level': 5, '_cid': 'c3'})
+        self.now += 11
+        self.tracker.track('AA:03', {'level': 1, '_cid': 'c4'})
+        self.assertEqual(self.tracker.expire(), 2)
+        self.assertEqual(self.tracker.confirm('AA:03', {'_cid': 'c4'}), ['c4'])  # echoed correlation ID
+
+        for cid in ('c5', 'c6', 'c7', 'c8'):
+            self.tracker.track('AA:04', {cid: True, '_cid': cid})
+        devices = self.tracker.snapshot()['devices']
+        self.assertEqual(devices['AA:01']['superseded'], 1)
+        self.assertEqual(devices['AA:01']['failure_rate'], 1.0)
+        self.assertEqual(devices['AA:04']['evicted'], 1)
+        self.assertEqual(self.tracker.snapshot()['pending'], 3)
+
+    def test_listener_tracks_commands_and_metrics_endpoint(self):
+        user = self.create_user('ackuser')
+        device_type = self.create_device_type('Ack Relay')
+        device = Device.objects.create(name='Ack', ip_address='10.8.0.1', mac_address='CC:01',
+                                       device_type=device_type, user=user)
+
+        command = Command(stdout=StringIO())
+        message = lambda kind, data: SimpleNamespace(topic=f'homeforge/devices/CC:01/{kind}',
+                                                     payload=json.dumps(data).encode())
+        command.on_message(None, None, message('command', {'relay_1': True, '_cid': 'abc'}))
+        command.on_message(None, None, message('state', {'relay_1': True}))
+        command.publish_command_metrics()
+        cache.clear()  # the listener does not share the web workers' cache
+
+        self.client.force_authenticate(user=user)
+        self.assertEqual(self.client.get('/api/admin/command-metrics/').status_code, status.HTTP_403_FORBIDDEN)
+        user.profile.role = Profile.ROLE_ADMIN
+        user.profile.save()
+        response = self.client.get('/api/admin/command-metrics/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['latency']['count'], 1)
+        entry = response.data['devices'][0]
+        self.assertEqual((entry['id'], entry['name'], entry['confirmed']), (device.id, 'Ack', 1))
+
+        # A snapshot the listener stopped refreshing is not served
+        SharedState.objects.filter(pk='command_metrics').update(updated_at=timezone.now() - timedelta(minutes=5))
+        self.assertEqual(self.client.get('/api/admin/command-metrics/').status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+
+
+class DeviceTwinTest(HomeForgeTestCase):
+    """Tests for desired/reported state reconciliation (api/device_twin.py)."""
+
+    def setUp(self):
+        super().setUp()
+        self.user = self.create_user('twinuser')
+        self.client.force_authenticate(user=self.user)
+        self.device_type = self.create_device_type('Twin Relay', controls=[('TOGGLE', 'Power', 'power-1')])
+        self.device = Device.objects.create(name='Twin', ip_address='10.9.0.1', mac_address='DD:01',
+                                            device_type=self.device_type, user=self.user,
+                                            status=Device.STATUS_ONLINE)
+
+    def test_reconciler_backs_off_and_gives_up(self):
+        now = [0.0]
+        reconciler = Reconciler(max_attempts=2, base_delay=5, max_delay=300, clock=lambda: now[0])
+        reconciler.command_sent('DD:01')
+        self.assertEqual(reconciler.plan('DD:01', {'power-1': True}), ({}, set()))  # device still applying
+        now[0] = 5
+        self.assertEqual(reconciler.plan('DD:01', {'power-1': True}), ({'power-1': True}, set()))
+        now[0] = 14
+        self.assertEqual(reconciler.plan('DD:01', {'power-1': True}), ({}, set()))  # next try at 15
+        now[0] = 15
+        self.assertEqual(reconciler.plan('DD:01', {'power-1': True}), ({'power-1': True}, set()))
+        now[0] = 100
+        self.assertEqual(reconciler.plan('DD:01', {'power-1': True}), ({}, {'power-1'}))
+        self.assertEqual(reconciler.plan('DD:01', {}), ({}, set()))
+
+    def test_unreported_desired_keys_expire(self):
+        now = [0.0]
+        reconciler = Reconciler(unreported_ttl=300, clock=lambda: now[0])
+        desired = {'button-1': 'press', 'power-1': True}
+        self.assertEqual(reconciler.expired('DD:01', desired, {'power-1': False}), set())
+        now[0] = 200
+        self.assertEqual(reconciler.expired('DD:01', desired, {'t': 20}), set())  # power-1 waits from 200
+        now[0] = 250
+        desired['button-1'] = 'hold'  # commanded again with a new value: waits from now
+        self.assertEqual(reconciler.expired('DD:01', desired, {'t': 20}), set())
+        now[0] = 500
+        self.assertEqual(reconciler.expired('DD:01', desired, {'t': 20}), {'power-1'})
+        now[0] = 550
+        self.assertEqual(reconciler.expired('DD:01', {'button-1': 'hold'}, {'t': 20}), {'button-1'})
+        self.assertEqual(reconciler.expired('DD:01', {}, {'t': 20}), set())
+
+    def test_listener_resends_divergent_keys_and_clears_confirmed_ones(self):
+        with mock.patch('api.device_commands.command_coalescer'):
+            response = self.client.patch(f'/api/devices/{self.device.id}/state/',
+                                         {'power-1': True, 'label': 'x'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.device.refresh_from_db()
+        self.assertEqual(self.device.desired_state, {'power-1': True, 'label': 'x'})
+
+        command = Command(stdout=StringIO())
+        broker = mock.Mock()
+        report = lambda data: SimpleNamespace(topic='homeforge/devices/DD:01/state', payload=json.dumps(data).encode())
+
+        # Back online with the relay still off: only the divergent key is resent
+        command.on_message(broker, None, report({'relay_1': False}))
+        topic, payload = broker.publish.call_args.args
+        self.assertEqual(topic, 'homeforge/devices/DD:01/command')
+        sent = json.loads(payload)
+        self.assertTrue(sent.pop('_cid').startswith('rc-'))
+        self.assertEqual(sent, {'power-1': True, 'relay_1': True})
+
+        command.on_message(broker, None, report({'relay_1': True}))
+        self.device.refresh_from_db()
+        self.assertEqual(self.device.desired_state, {'label': 'x'})  # not reported yet: kept for now
+        self.assertEqual(self.device.current_state, {'power-1': True})
+        self.assertEqual(broker.publish.call_count, 1)
+
+        # Still unreported after DESIRED_STATE_TTL: dropped with the next report's UPDATE
+        command.reconciler.unreported_ttl = 0
+        command.on_message(broker, None, report({'relay_1': True}))
+        self.device.refresh_from_db()
+        self.assertEqual(self.device.desired_state, {})
+
+
+class CommandQueueTest(HomeForgeTestCase):
+    """Tests for queued commands for offline devices (api/command_queue.py)."""
+
+    def setUp(self):
+        super().setUp()
+        self.user = self.create_user('queueuser')
+        self.client.force_authenticate(user=self.user)
+        device_type = self.create_device_type('Queue Relay')
+        self.device = Device.objects.create(name='Sleepy', ip_address='10.10.0.1', mac_address='EE:01',
+                                            device_type=device_type, user=self.user)
+        self.coalescer = self.patch_coalescer('api.device_commands.command_coalescer')
+
+    def test_offline_commands_are_queued_and_delivered_merged(self):
+        response = self.client.patch(f'/api/devices/{self.device.id}/state/', {'relay_1': True, 'level': 3}, format='json')
+        self.assertEqual(response.data['status'], 'Command queued')
+        self.client.post('/api/devices/bulk-state/', {'devices': [self.device.id], 'state': {'level': 7}}, format='json')
+        self.assertEqual(self.coalescer.submit_many.call_args.args[0], [])  # nothing published
+        stale = QueuedCommand.objects.create(device=self.device, payload={'level': 1},
+                                             expires_at=timezone.now() - timedelta(seconds=1))
+
+        response = self.client.get('/api/devices/command-queue/')
+        self.assertEqual(response.data['total'], 2)  # expired command not counted
+        self.assertEqual(response.data['devices'][0]['depth'], 2)
+
+        broker = mock.Mock()
+        command = Command(stdout=StringIO())
+        command.on_message(broker, None, SimpleNamespace(topic='homeforge/devices/EE:01/state',
+                                                        payload=json.dumps({'relay_1': False}).encode()))
+        topic, payload = broker.publish.call_args.args
+        delivered = json.loads(payload)
+        delivered.pop('_cid')
+        self.assertEqual(topic, 'homeforge/devices/EE:01/command')
+        self.assertEqual(delivered, {'relay_1': True, 'level': 7})
+        self.assertEqual(broker.publish.call_args.kwargs['qos'], 0)  # queue mode: MQTT_COMMAND_QOS
+        self.assertEqual(broker.publish.call_count, 1)  # reconciliation waits for the queued command
+        self.assertFalse(QueuedCommand.objects.filter(pk=stale.pk).exists())
+        self.assertEqual(QueuedCommand.objects.count(), 0)
+
+    @override_settings(MQTT_OFFLINE_DELIVERY='session')
+    def test_session_mode_publishes_to_offline_devices(self):
+        self.client.patch(f'/api/devices/{self.device.id}/state/', {'relay_1': True}, format='json')
+        self.assertEqual(QueuedCommand.objects.count(), 0)
+        self.assertEqual(len(self.coalescer.submit_many.call_args.args[0]), 1)
+
+    def test_listener_publishes_at_session_qos_only_in_session_mode(self):
+        command = Command(stdout=StringIO())
+        for mode, qos in (('queue', 0), ('session', 1)):
+            with override_settings(MQTT_OFFLINE_DELIVERY=mode):
+                broker = mock.Mock()
+                QueuedCommand.objects.create(device=self.device, payload={'level': 1},
+                                             expires_at=timezone.now() + timedelta(seconds=60))
+                command.flush_queue(broker, 'EE:01', self.device)
+                command.resend(broker, 'EE:01', {'level': 1})
+                self.assertEqual([call.kwargs['qos'] for call in broker.publish.call_args_list], [qos, qos], mode)
+
+
+class SceneTest(HomeForgeTestCase):
+    """Tests for scenes and their precompiled plans (api/scenes.py)."""
+
+    def setUp(self):
+        super().setUp()
+        self.user = self.create_user('sceneuser')
+        self.admin = self.create_user('sceneadmin', admin=True)
+        self.client.force_authenticate(user=self.admin)
+        device_type = self.create_device_type('Scene Relay')
+        self.devices = [
+            Device.objects.create(name=f'Lamp {i}', ip_address=f'10.20.0.{i}', mac_address=f'SC:{i:02d}',
+                                  device_type=device_type, user=self.admin, status=Device.STATUS_ONLINE)
+            for i in range(12)
+        ]
+        self.coalescer = self.patch_coalescer()
+
+    def create_scene(self, actions):
+        response = self.client.post('/api/scenes/', {'name': 'Movie night', 'actions': actions}, format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+        return response.data['id']
+
+    def test_plan_is_compiled_on_save(self):
+        scene_id = self.create_scene([
+            {'device': self.devices[0].id, 'state': {'power': 'off'}},
+            {'device': self.devices[1].id, 'state': {'relay_1': True, 'level': 20}},
+        ])
+        scene = Scene.objects.get(pk=scene_id)
+        self.assertEqual(scene.plan[0]['mac'], 'SC:00')
+        self.assertEqual(scene.plan[0]['payload'], {'power': 'off', 'relay_1': 'off'})  # compatibility mapping
+        self.assertEqual(scene.plan[1]['payload'], {'relay_1': True, 'level': 20})
+        self.assertEqual(set(scene.devices.values_list('id', flat=True)), {self.devices[0].id, self.devices[1].id})
+        self.assertIsNotNone(scene.compiled_at)
+
+    def test_invalid_actions_rejected(self):
+        for actions in ([], [{'device': 999999, 'state': {'power': True}}],
+                        [{'device': self.devices[0].id, 'state': {}}],
+                        [{'device': self.devices[0].id, 'state': {'a': 1}}, {'device': self.devices[0].id, 'state': {'b': 2}}]):
+            response = self.client.post('/api/scenes/', {'name': 'Bad', 'actions': actions}, format='json')
+            self.assertEqual(response.status_code, 400, actions)
+
+    def test_only_admins_write_scenes(self):
+        scene_id = self.create_scene([{'device': self.devices[0].id, 'state': {'power': True}}])
+        self.client.force_authenticate(user=self.user)
+        response = self.client.post('/api/scenes/', {'name': 'Mine', 'actions': [
+            {'device': self.devices[0].id, 'state': {'power': True}}]}, format='json')
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(self.client.delete(f'/api/scenes/{scene_id}/').status_code, 403)
+        self.assertEqual(self.client.get('/api/scenes/').status_code, 200)
+        self.assertEqual(self.client.post(f'/api/scenes/{scene_id}/activate/').status_code, 202)
+
+    def test_activation_is_one_batch_with_constant_queries(self):
+        scene_id = self.create_scene([
+            {'device': device.id, 'state': {'power': True, 'level': 50}} for device in self.devices
+        ])
+        self.client.force_authenticate(user=self.user)
+        # scene lookup, offline check, desired_state UPDATE, activation stamp (+ auth/profile)
+        with self.assertNumQueries(4):
+            response = self.client.post(f'/api/scenes/{scene_id}/activate/')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data['accepted'], 12)
+        self.assertIn('latency_ms', response.data)
+        self.coalescer.submit_many.assert_called_once()
+        commands = self.coalescer.submit_many.call_args.args[0]
+        self.assertEqual(len(commands), 12)
+        self.assertEqual(commands[0], ('SC:00', {'power': True, 'level': 50, 'relay_1': True}, 0))
+        self.assertEqual(Device.objects.get(pk=self.devices[5].id).desired_state, {'power': True, 'level': 50})
+        self.assertIsNotNone(Scene.objects.get(pk=scene_id).last_activation_ms)
+
+    def test_offline_targets_are_queued(self):
+        Device.objects.filter(pk=self.devices[1].id).update(status=Device.STATUS_OFFLINE)
+        scene_id = self.create_scene([
+            {'device': self.devices[0].id, 'state': {'power': True}},
+            {'device': self.devices[1].id, 'state': {'power': True}},
+        ])
+        response = self.client.post(f'/api/scenes/{scene_id}/activate/')
+        self.assertEqual([r['queued'] for r in response.data['results']], [False, True])
+        self.assertEqual(len(self.coalescer.submit_many.call_args.args[0]), 1)
+        self.assertEqual(QueuedCommand.objects.get().device_id, self.devices[1].id)
+
+    def test_plan_follows_device_changes(self):
+        scene_id = self.create_scene([
+            {'device': self.devices[0].id, 'state': {'power': True}},
+            {'device': self.devices[1].id, 'state': {'power': True}},
+        ])
+        device = self.devices[0]
+        device.mac_address = 'SC:FF'
+        device.save()
+        self.assertEqual(Scene.objects.get(pk=scene_id).plan[0]['mac'], 'SC:FF')
+
+        self.devices[1].delete()
+        scene = Scene.objects.get(pk=scene_id)
+        self.assertEqual([entry['device'] for entry in scene.plan], [device.id])
+        self.assertEqual(len(scene.actions), 1)
+
+    def test_snapshot_captures_room_controls(self):
+        device_type = self.create_device_type('Scene Dimmer')
+        template = DeviceCardTemplate.objects.create(device_type=device_type)
+        DeviceControl.objects.create(template=template, widget_type='TOGGLE', label='Power', variable_mapping='power')
+        DeviceControl.objects.create(template=template, widget_type='SLIDER', label='Level', variable_mapping='level')
+        DeviceControl.objects.create(template=template, widget_type='TEMPERATURE', label='Temp', variable_mapping='temp')
+        room = Room.objects.create(name='Lounge', user=self.admin)
+        dimmer = Device.objects.create(name='Dimmer', ip_address='10.20.1.1', mac_address='SC:D1', room=room,
+                                       device_type=device_type, user=self.admin, status=Device.STATUS_ONLINE,
+                                       current_state={'power': True, 'level': 40, 'temp': 21.5})
+        Device.objects.create(name='Blank', ip_address='10.20.1.2', mac_address='SC:D2', room=room,
+                              device_type=device_type, user=self.admin, current_state={})
+
+        response = self.client.post('/api/scenes/snapshot/', {'name': 'Lounge now', 'room': room.id}, format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertTrue(response.data['snapshot'])
+        self.assertEqual(response.data['actions'], [{'device': dimmer.id, 'state': {'power': True, 'level': 40}}])
+        self.assertEqual(Scene.objects.get(pk=response.data['id']).plan[0]['mac'], 'SC:D1')
+
+        empty = Room.objects.create(name='Empty', user=self.admin)
+        response = self.client.post('/api/scenes/snapshot/', {'name': 'Nothing', 'room': empty.id}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.client.force_authenticate(user=self.user)
+        response = self.client.post('/api/scenes/snapshot/', {'name': 'Mine'}, format='json')
+        self.assertEqual(response.status_code, 403)
+
+    def test_restore_sends_only_differences(self):
+        for device, state in zip(self.devices, [{'power': True, 'level': 50}, {'power': 'on', 'level': 10}, {}]):
+            Device.objects.filter(pk=device.id).update(current_state=state)
+        scene_id = self.create_scene([
+            {'device': device.id, 'state': {'power': True, 'level': 50}} for device in self.devices[:3]
+        ])
+        self.client.force_authenticate(user=self.user)
+        # scene lookup, present state, desired_state UPDATE, activation stamp
+        with self.assertNumQueries(4):
+            response = self.client.post(f'/api/scenes/{scene_id}/restore/')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data['unchanged'], [self.devices[0].id])
+        commands = self.coalescer.submit_many.call_args.args[0]
+        self.assertEqual(commands, [
+            ('SC:01', {'level': 50}, 0),
+            ('SC:02', {'power': True, 'level': 50, 'relay_1': True}, 0),
+        ])
+        self.assertEqual(Device.objects.get(pk=self.devices[1].id).desired_state, {'level': 50})
+
+
+class AutomationRuleTest(HomeForgeTestCase):
+    """Tests for the automation rules engine (api/rules.py)."""
+
+    def setUp(self):
+        super().setUp()
+        self.admin = self.create_user('ruleadmin', admin=True)
+        self.client.force_authenticate(user=self.admin)
+        device_type = self.create_device_type('Rule Relay')
+        self.sensor = Device.objects.create(name='Bathroom Sensor', ip_address='10.30.0.1', mac_address='RU:01',
+                                            device_type=device_type, user=self.admin, status=Device.STATUS_ONLINE)
+        self.fan = Device.objects.create(name='Bathroom Fan', ip_address='10.30.0.2', mac_address='RU:02',
+                                         device_type=device_type, user=self.admin, status=Device.STATUS_ONLINE)
+        self.coalescer = self.patch_coalescer()
+
+    def create_rule(self, **fields):
+        data = {'name': 'Humid', 'device': self.sensor.id, 'metric': 'humidity', 'operator': 'gt', 'threshold': 70,
+                'hysteresis': 5, 'cooldown': 0, 'action_device': self.fan.id, 'action_state': {'relay_1': True}}
+        response = self.client.post('/api/rules/', {**data, **fields}, format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+        return response.data['id']
+
+    def test_hysteresis_and_cooldown(self):
+        rule = CompiledRule(1, 'Humid', 1, 'humidity', 'gt', 70, hysteresis=5, cooldown=60)
+        self.assertTrue(rule.update(75, now=0))
+        self.assertFalse(rule.update(80, now=100))  # still above: disarmed
+        self.assertFalse(rule.update(68, now=110))  # below the threshold, not past the hysteresis
+        self.assertFalse(rule.update(72, now=120))
+        self.assertFalse(rule.update(65, now=130))  # re-armed
+        self.assertTrue(rule.update(71, now=140))
+        self.assertFalse(rule.update(60, now=150))
+        self.assertFalse(rule.update(75, now=160))  # armed, but within the cooldown
+        self.assertTrue(rule.update(75, now=201))
+
+        falling = CompiledRule(2, 'Cold', 1, 'temperature', 'lte', 18, hysteresis=1)
+        self.assertTrue(falling.update('17.5', now=0))
+        self.assertFalse(falling.update(18.5, now=1))
+        self.assertFalse(falling.update(19, now=2))
+        self.assertTrue(falling.update(18, now=3))
+        motion = CompiledRule(3, 'Motion', 1, 'motion', 'eq', 'on')
+        self.assertFalse(motion.update(False, now=0))
+        self.assertTrue(motion.update(True, now=1))
+        self.assertFalse(motion.update(True, now=2))
+
+    def test_index_only_evaluates_referenced_rules(self):
+        engine = RuleEngine(loader=list)
+        rules = [CompiledRule(1, 'a', 1, 'humidity', 'gt', 70), CompiledRule(2, 'b', 2, 'humidity', 'gt', 70),
+                 CompiledRule(3, 'c', 1, 'temperature', 'gt', 30)]
+        engine.load(rules)
+        self.assertEqual(engine.evaluate(1, {'humidity': 80, 'pressure': 1000}), [rules[0]])
+        self.assertTrue(rules[1].armed and rules[2].armed)  # never evaluated
+        engine.load([CompiledRule(1, 'a', 1, 'humidity', 'gt', 70)])
+        self.assertFalse(engine.evaluate(1, {'humidity': 85}))  # arming state kept across reloads
+
+    def test_listener_fires_rule_on_report(self):
+        rule_id = self.create_rule()
+        command = Command(stdout=StringIO())
+        broker = mock.Mock()
+
+        def report(values):
+            command.on_message(broker, None, SimpleNamespace(topic='homeforge/devices/RU:01/state',
+                                                            payload=json.dumps(values).encode()))
+
+        report({'humidity': 65})
+        self.coalescer.submit_many.assert_not_called()
+        report({'humidity': 75})
+        self.coalescer.submit_many.assert_called_once_with([('RU:02', {'relay_1': True}, 0)])
+        self.assertIsNotNone(AutomationRule.objects.get(pk=rule_id).last_fired_at)
+        self.assertEqual(Device.objects.get(pk=self.fan.id).desired_state, {'relay_1': True})
+        report({'humidity': 76})
+        self.assertEqual(self.coalescer.submit_many.call_count, 1)
+
+    def test_rule_changes_hot_reload(self):
+        clock = [0.0]
+        engine = RuleEngine(reload_interval=2, clock=lambda: clock[0])
+        self.assertTrue(engine.refresh())
+        self.assertEqual(engine.count, 0)
+        rule_id = self.create_rule()
+        self.assertFalse(engine.refresh())  # checked less than reload_interval ago
+        clock[0] = 3
+        self.assertTrue(engine.refresh())
+        self.assertEqual(engine.count, 1)
+        clock[0] = 6
+        self.assertFalse(engine.refresh())  # unchanged
+
+        self.fan.mac_address = 'RU:FF'
+        self.fan.save()
+        clock[0] = 9
+        self.assertTrue(engine.refresh())
+        self.assertEqual(engine.evaluate(self.sensor.id, {'humidity': 90})[0].sends[0][0]['mac'], 'RU:FF')
+        self.client.patch(f'/api/rules/{rule_id}/', {'enabled': False}, format='json')
+        clock[0] = 12
+        self.assertTrue(engine.refresh())
+        self.assertEqual(engine.count, 0)
+
+    def test_reload_when_listener_does_not_share_the_api_cache(self):
+        listener_cache = LocMemCache('rules-listener', {})
+        clock = [0.0]
+        engine = RuleEngine(reload_interval=2, clock=lambda: clock[0])
+        with mock.patch('api.caching.cache', listener_cache):
+            self.assertTrue(engine.refresh())
+        self.create_rule()  # through the API, with the default cache
+        clock[0] = 3
+        with mock.patch('api.caching.cache', listener_cache):
+            self.assertTrue(engine.refresh())
+        self.assertEqual(engine.count, 1)
+
+    def test_scene_action(self):
+        scene = self.client.post('/api/scenes/', {'name': 'Vent', 'actions': [
+            {'device': self.fan.id, 'state': {'level': 3}}]}, format='json').data
+        self.create_rule(action_device=None, action_state={}, action_scene=scene['id'])
+        engine = RuleEngine()
+        engine.refresh()
+        [rule] = engine.evaluate(self.sensor.id, {'humidity': 90})
+        self.assertEqual(rule.sends[0][2], {'level': 3})
+
+    def test_validation_and_permissions(self):
+        base = {'name': 'Bad', 'device': self.sensor.id, 'metric': 'humidity', 'operator': 'gt', 'threshold': 70,
+                'action_device': self.fan.id, 'action_state': {'relay_1': True}}
+        for changes in ({'threshold': 'high'}, {'threshold': True}, {'action_state': {}},
+                        {'action_device': None}, {'hysteresis': -1}, {'operator': 'between'}):
+            response = self.client.post('/api/rules/', {**base, **changes}, format='json')
+            self.assertEqual(response.status_code, 400, changes)
+        response = self.client.post('/api/rules/', {**base, 'operator': 'eq', 'threshold': 'on'}, format='json')
+        self.assertEqual(response.status_code, 201)
+
+        user = self.create_user('ruleuser')
+        self.client.force_authenticate(user=user)
+        self.assertEqual(self.client.post('/api/rules/', base, format='json').status_code, 403)
+        self.assertEqual(self.client.get('/api/rules/').status_code, 200)
+
+    def test_benchmark_command(self):
+        out = StringIO()
+        call_command('benchmark_rules', rules=200, devices=20, messages=200, stdout=out)
+        self.assertIn('indexed', out.getvalue())
+        self.assertIn('scan', out.getvalue())
+
+
+class ScheduleTest(HomeForgeTestCase):
+    """Tests for cron and sunrise/sunset schedules (api/scheduler.py)."""
+
+    def setUp(self):
+        super().setUp()
+        self.admin = self.create_user('scheduleadmin', admin=True)
+        self.client.force_authenticate(user=self.admin)
+        device_type = self.create_device_type('Schedule Relay')
+        self.lamp = Device.objects.create(name='Porch Lamp', ip_address='10.40.0.1', mac_address='SH:01',
+                                          device_type=device_type, user=self.admin, status=Device.STATUS_ONLINE)
+        self.coalescer = self.patch_coalescer()
+
+    def at(self, *args):
+        return datetime(*args, tzinfo=dt_timezone.utc)
+
+    def test_cron_next_run(self):
+        utc = ZoneInfo('UTC')
+        friday = self.at(2026, 10, 16, 8, 0)
+        self.assertEqual(CronExpression('*/15 * * * *').next_after(friday, utc), self.at(2026, 10, 16, 8, 15))
+        self.assertEqual(CronExpression('30 7 * * 1-5').next_after(friday, utc), self.at(2026, 10, 19, 7, 30))
+        self.assertEqual(CronExpression('@daily').next_after(friday, utc), self.at(2026, 10, 17, 0, 0))
+        # Both day fields restricted: the 1st of the month or a Sunday
+        self.assertEqual(CronExpression('0 9 1 * 7').next_after(friday, utc), self.at(2026, 10, 18, 9, 0))
+        self.assertEqual(CronExpression('0 0 29 2 *').next_after(friday, utc), self.at(2028, 2, 29, 0, 0))
+        berlin = CronExpression('30 7 * * *').next_after(friday, ZoneInfo('Europe/Berlin'))
+        self.assertEqual(berlin, self.at(2026, 10, 17, 5, 30))
+        for expression in ('* * * *', '60 * * * *', 'x * * * *', '*/0 * * * *', '5-1 * * * *'):
+            with self.assertRaises(ValueError):
+                CronExpression(expression)
+        with self.assertRaises(ValueError):
+            CronExpression('0 0 30 2 *').next_after(friday, utc)
+
+    @override_settings(HOME_LATITUDE=51.5074, HOME_LONGITUDE=-0.1278)
+    def test_sun_schedules(self):
+        sunrise, sunset = sun_times(date(2024, 6, 21), 51.5074, -0.1278)
+        self.assertLess(abs(sunrise - self.at(2024, 6, 21, 3, 43)), timedelta(minutes=2))
+        self.assertLess(abs(sunset - self.at(2024, 6, 21, 20, 21)), timedelta(minutes=2))
+        self.assertEqual(sun_times(date(2024, 6, 21), 78, 15), (None, None))  # midnight sun
+
+        before_sunset = CompiledSchedule(1, 'Porch', 'sunset', offset=-30)
+        run = before_sunset.next_after(self.at(2024, 6, 21, 12, 0))
+        self.assertLess(abs(run - self.at(2024, 6, 21, 19, 51)), timedelta(minutes=2))
+        run = before_sunset.next_after(self.at(2024, 6, 21, 20, 0))  # today's run has passed
+        self.assertEqual(run.date(), date(2024, 6, 22))
+
+    def test_heap_pops_due_schedules_in_order(self):
+        now = [self.at(2026, 10, 19, 6, 59, 30)]
+        scheduler = Scheduler(loader=list, clock=lambda: now[0])
+        hourly, daily = CompiledSchedule(1, 'hourly', 'cron', '0 * * * *'), CompiledSchedule(2, 'daily', 'cron', '0 7 * * *')
+        scheduler.load([daily, hourly, CompiledSchedule(3, 'never', 'cron', '0 0 30 2 *')])
+        self.assertEqual(scheduler.count, 3)
+        self.assertEqual(scheduler.next_run(), self.at(2026, 10, 19, 7, 0))
+        self.assertEqual(scheduler.seconds_until_next(), 30)
+        self.assertEqual(scheduler.due(), [])
+        now[0] = self.at(2026, 10, 19, 7, 0, 1)
+        self.assertEqual(sorted(s.name for s in scheduler.due()), ['daily', 'hourly'])
+        self.assertEqual(scheduler.due(), [])
+        self.assertEqual(scheduler.next_run(), self.at(2026, 10, 19, 8, 0))
+
+    def test_listener_runs_schedules_and_hot_reloads(self):
+        response = self.client.post('/api/schedules/', {
+            'name': 'Porch on', 'cron': '0 19 * * *', 'action_device': self.lamp.id, 'action_state': {'relay_1': True},
+        }, format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(response.data['kind'], 'cron')
+        self.assertIsNotNone(response.data['next_run'])
+
+        now = [timezone.now().replace(hour=18, minute=59, second=0, microsecond=0)]
+        command = Command(stdout=StringIO())
+        command.scheduler = Scheduler(clock=lambda: now[0])
+        listener_cache = LocMemCache('schedules-listener', {})
+
+        def run_schedules():
+            # The listener process does not share the API's cache
+            with mock.patch('api.caching.cache', listener_cache):
+                command.run_schedules()
+
+        run_schedules()
+        self.assertEqual(command.scheduler.count, 1)
+        now[0] += timedelta(seconds=30)
+        run_schedules()
+        self.coalescer.submit_many.assert_not_called()
+        now[0] += timedelta(seconds=31)
+        run_schedules()
+        self.coalescer.submit_many.assert_called_once_with([('SH:01', {'relay_1': True}, 0)])
+        self.assertIsNotNone(Schedule.objects.get().last_run_at)
+
+        # Changed through the API: picked up on the next reload check, no restart
+        self.client.patch(f"/api/schedules/{response.data['id']}/", {'cron': '5 19 * * *'}, format='json')
+        now[0] += timedelta(minutes=1)
+        run_schedules()
+        self.assertEqual(command.scheduler.next_run(), now[0].replace(hour=19, minute=5, second=0))
+        self.client.patch(f"/api/schedules/{response.data['id']}/", {'enabled': False}, format='json')
+        now[0] += timedelta(minutes=1)
+        run_schedules()
+        self.assertIsNone(command.scheduler.next_run())
+
+    def test_validation(self):
+        base = {'name': 'Bad', 'cron': '0 7 * * *', 'action_device': self.lamp.id, 'action_state': {'relay_1': True}}
+        for changes in ({'cron': '0 7 * *'}, {'cron': '0 0 30 2 *'}, {'cron': ''}, {'action_state': {}},
+                        {'kind': 'sunset', 'offset': 1000}, {'kind': 'noon'}):
+            response = self.client.post('/api/schedules/', {**base, **changes}, format='json')
+            self.assertEqual(response.status_code, 400, changes)
+        response = self.client.post('/api/schedules/', {**base, 'kind': 'sunrise', 'offset': -15}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['cron'], '')
+
+        user = self.create_user('scheduleuser')
+        self.client.force_authenticate(user=user)
+        self.assertEqual(self.client.post('/api/schedules/', base, format='json').status_code, 403)
+        self.assertEqual(self.client.get('/api/schedules/').status_code, 200)
+
@@ -0,0 +1,385 @@
+"""
+Network topology graph for the topology page.
+
+The graph has two parts with very different lifetimes:
+
+- the static layout (node positions, labels, room/type, binding style, edges),
+  which only changes when devices, rooms or device types change, and
+- the status overlay (status, colors, opacity, edge animation, current_state),
+  which changes with every heartbeat.
+
+The static layout is cached through the ``topology_layout`` resource, per
+layout and level of detail, and rebuilt only when its generation moves. The
+generation is shared with the MQTT listener, which binds MAC addresses. Each
+request then reads the generation, runs a single narrow query for statuses
+and patches them onto shallow copies of the cached nodes and edges.
+
+Positions come from ``api/topology_layout.py``:
+
+- ``radial`` (default): every device on one circle
+- ``rings``: devices clustered by room in concentric rings
+- ``force``: force-directed, warm-started from the last positions so the
+  graph stays stable when a device is added
+
+The default level of detail is one node per device. With ``lod=rooms`` (or
+``lod=auto`` above ``settings.TOPOLOGY_LOD_THRESHOLD`` devices) each room is
+collapsed into one aggregate node with status counts; clients opt in because
+they must render ``room`` nodes.
+
+``status_changes`` supports incremental refreshes: every status map is stored
+under a content-addressed cursor, and a client that sends its last cursor
+gets back only the nodes whose status or state differ.
+"""
+import hashlib
+import json
+from collections import Counter
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+
+from . import topology_layout as engine
+from .caching import topology_layout
+from .models import Device
+
+GATEWAY_ID = "homeforge-gateway"
+
+LAYOUTS = ('radial', 'rings', 'force')
+DEFAULT_LAYOUT = 'radial'
+LOD_MODES = ('devices', 'rooms', 'auto')
+DEFAULT_LOD = 'devices'
+
+STATUS_COLORS = {
+    Device.STATUS_ONLINE: "#10B981",
+    Device.STATUS_OFFLINE: "#EF4444",
+    Device.STATUS_ERROR: "#F59E0B",
+}
+DEFAULT_STATUS_COLOR = "#EF4444"
+PARTIAL_STATUS_COLOR = "#F59E0B"
+
+# How long a status snapshot stays addressable by its cursor
+STATUS_SNAPSHOT_TIMEOUT = 600
+
+# Last force-directed positions, kept across layout generations for warm starts
+FORCE_POSITIONS_KEY = "topology:positions:force"
+
+UNASSIGNED_ROOM = "Unassigned"
+
+
+def _gateway_node():
+    return {
+        "id": GATEWAY_ID,
+        "type": "input",
+        "data": {
+            "label": "MQTT Broker",
+            "ip": "HomeForge Hub",
+            "status": "online",
+            "type": "server",
+            "room": "Server Room",
+        },
+        "position": {"x": 0, "y": 0},
+        "style": {
+            "background": "#F3F4F6",
+            "color": "#1F2937",
+            "border": "2px solid #3B82F6",
+            "borderRadius": "8px",
+            "fontWeight": "bold",
+        },
+    }
+
+
+def _load_devices():
+    """Devices ordered room by room (unassigned last), and ``[(room_id, devices)]`` groups."""
+    devices = list(Device.objects.select_related('room', 'device_type').only(
+        'id', 'name', 'ip_address', 'mac_address', 'icon',
+        'room__name', 'device_type__name',
+    ).order_by('room__name', 'room_id', 'id'))
+    # NULL rooms sort first on some databases; keep them in one trailing group
+    devices.sort(key=lambda d: d.room_id is None)
+    groups = []
+    for device in devices:
+        if groups and groups[-1][0] == device.room_id:
+            groups[-1][1].append(device)
+        else:
+            groups.append((device.room_id, [device]))
+    return devices, groups
+
+
+def _force_layout(devices, groups):
+    """
+    Force-directed positions for ``devices``.
+
+    When at least half of the devices have cached positions, those devices
+    stay pinned and only new devices (seeded next to their room) are settled,
+    so adding a device never rearranges the rest of the graph. Otherwise the
+    layout is computed from scratch, starting from the ring layout.
+    """
+    sizes = [len(members) for _, members in groups]
+    centers, ring = engine.ring_positions(sizes)
+    previous = cache.get(FORCE_POSITIONS_KEY) or {}
+
+    ids = [str(d.id) for d in devices]
+    known = np.array([i in previous for i in ids], dtype=bool)
+    warm = known.mean() >= 0.5
+    room_of = np.repeat(np.arange(len(groups)), sizes)
+    initial_devices = ring.copy()
+
+    # Room anchors are invisible nodes that pull a room's devices together
+    anchors = centers.copy()
+    if warm:
+        initial_devices[known] = [previous[i] for i, k in zip(ids, known) if k]
+        for r in range(len(groups)):
+            placed = known & (room_of == r)
+            if placed.any():
+                anchors[r] = initial_devices[placed].mean(axis=0)
+        # New devices start on a small golden-angle spiral around their room
+        new = np.flatnonzero(~known)
+        angle = new * 2.399963
+        initial_devices[new] = anchors[room_of[new]] + 0.5 * engine.NODE_SPACING * np.column_stack((np.cos(angle), np.sin(angle)))
+
+    # Node order: gateway, room anchors, devices
+    n_rooms = len(groups)
+    initial = np.vstack(([[0.0, 0.0]], anchors, initial_devices))
+    edges = np.vstack((
+        np.column_stack((np.zeros(n_rooms, dtype=int), 1 + np.arange(n_rooms))),
+        np.column_stack((1 + room_of, 1 + n_rooms + np.arange(len(devices)))),
+    ))
+    fixed = np.concatenate(([True], np.zeros(n_rooms, dtype=bool), known if warm else np.zeros(len(devices), dtype=bool)))
+
+    positions = engine.force_positions(
+        initial, edges, fixed,
+        iterations=engine.FORCE_WARM_ITERATIONS if warm else engine.FORCE_ITERATIONS,
+        temperature=0.5 * engine.NODE_SPACING if warm else None,
+    )[1 + n_rooms:]
+    cache.set(FORCE_POSITIONS_KEY, dict(zip(ids, positions.round(1).tolist())), None)
+    return positions
+
+
+def build_static_layout(layout=DEFAULT_LAYOUT):
+    """
+    Build nodes and edges with everything that does not depend on device status.
+    ``layout`` in the result is the layout used: ``force`` falls back to
+    ``rings`` above ``FORCE_MAX_NODES`` devices.
+    """
+    devices, groups = _load_devices()
+
+    if layout == 'force' and len(devices) > engine.FORCE_MAX_NODES:
+        layout = 'rings'
+    if layout == 'radial':
+        positions = engine.radial_positions(len(devices))
+    elif layout == 'force' and devices:
+        positions = _force_layout(devices, groups)
+    else:
+        positions = engine.ring_positions([len(members) for _, members in groups])[1]
+
+    nodes = [_gateway_node()]
+    edges = []
+    for device, (x, y) in zip(devices, positions.round(1).tolist()):
+        node_id = str(device.id)
+        is_bound = bool(device.mac_address)
+
+        nodes.append({
+            "id": node_id,
+            "type": "device",
+            "data": {
+                "label": device.name,
+                "ip": device.ip_address,
+                "mac": device.mac_address,
+                "room": device.room.name if device.room else UNASSIGNED_ROOM,
+                "device_type": device.device_type.name if device.device_type else "Unknown",
+                "icon": device.icon,
+                "is_bound": is_bound,
+            },
+            "position": {"x": x, "y": y},
+            "style": {
+                "width": 180,
+                "borderWidth": "2px" if is_bound else "1px",
+                "borderStyle": "solid" if is_bound else "dashed",
+                "padding": "10px",
+                "borderRadius": "5px",
+                "background": "white",
+            },
+        })
+        edges.append({
+            "id": f"edge-{GATEWAY_ID}-{node_id}",
+            "source": GATEWAY_ID,
+            "target": node_id,
+            "style": {"strokeWidth": 2},
+        })
+
+    return {"nodes": nodes, "edges": edges, "members": {}, "layout": layout}
+
+
+def build_room_layout():
+    """One aggregate node per room (level-of-detail view for large homes)."""
+    devices, groups = _load_devices()
+    centers = engine.ring_positions([1] * len(groups))[0]
+
+    nodes = [_gateway_node()]
+    edges = []
+    members = {}
+    for (room_id, room_devices), (x, y) in zip(groups, centers.round(1).tolist()):
+        node_id = f"room-{room_id}" if room_id is not None else "room-unassigned"
+        room_name = room_devices[0].room.name if room_id is not None else UNASSIGNED_ROOM
+        members[node_id] = [str(d.id) for d in room_devices]
+        nodes.append({
+            "id": node_id,
+            "type": "room",
+            "data": {
+                "label": room_name,
+                "room": room_name,
+                "room_id": room_id,
+                "device_count": len(room_devices),
+            },
+            "position": {"x": x, "y": y},
+            "style": {
+                "width": 200,
+                "borderWidth": "2px",
+                "borderStyle": "solid",
+                "padding": "12px",
+                "borderRadius": "12px",
+                "background": "#F9FAFB",
+            },
+        })
+        edges.append({
+            "id": f"edge-{GATEWAY_ID}-{node_id}",
+            "source": GATEWAY_ID,
+            "target": node_id,
+            "style": {"strokeWidth": 3},
+        })
+
+    return {"nodes": nodes, "edges": edges, "members": members}
+
+
+def get_static_layout(layout=DEFAULT_LAYOUT, lod=DEFAULT_LOD):
+    """The cached static layout, with the generation it was built at as ``version``."""
+    if lod == 'rooms':
+        build, part = build_room_layout, 'rooms'
+    else:
+        build, part = (lambda: build_static_layout(layout)), layout
+    return topology_layout.get_or_set(lambda: {"version": topology_layout.generation(), **build()}, part)
+
+
+def current_statuses():
+    """{node_id: (status, current_state)} for every device, in one query."""
+    return {
+        str(pk): (device_status, current_state)
+        for pk, device_status, current_state in Device.objects.order_by().values_list('id', 'status', 'current_state')
+    }
+
+
+def status_overlay(device_status, current_state):
+    """The status-dependent node/edge fields for one device."""
+    color = STATUS_COLORS.get(device_status, DEFAULT_STATUS_COLOR)
+    online = device_status == Device.STATUS_ONLINE
+    return {
+        "status": device_status,
+        "current_state": current_state,
+        "color": color,
+        "opacity": 1.0 if online else 0.6,
+        "animated": online,
+    }
+
+
+def _room_overlay(member_ids, statuses):
+    counts = Counter(statuses[m][0] for m in member_ids if m in statuses)
+    online = counts.get(Device.STATUS_ONLINE, 0)
+    if online == len(member_ids):
+        color = STATUS_COLORS[Device.STATUS_ONLINE]
+    elif online == 0 and not counts.get(Device.STATUS_ERROR):
+        color = STATUS_COLORS[Device.STATUS_OFFLINE]
+    else:
+        color = PARTIAL_STATUS_COLOR
+    return {
+        "status_counts": {s: counts.get(s, 0) for s, _ in Device.STATUS_CHOICES},
+        "color": color,
+        "opacity": 1.0 if online else 0.6,
+        "animated": online > 0,
+    }
+
+
+def resolve_lod(lod, device_count):
+    if lod == 'auto':
+        return 'rooms' if device_count > settings.TOPOLOGY_LOD_THRESHOLD else 'devices'
+    return lod
+
+
+def build_topology(layout=DEFAULT_LAYOUT, lod=DEFAULT_LOD):
+    """The full graph: cached static layout patched with current statuses."""
+    statuses = current_statuses()
+    lod = resolve_lod(lod, len(statuses))
+    static = get_static_layout(layout, lod)
+    nodes = [static["nodes"][0]]
+    edges = []
+
+    for node, edge in zip(static["nodes"][1:], static["edges"]):
+        if lod == 'rooms':
+            overlay = _room_overlay(static["members"][node["id"]], statuses)
+            data = {**node["data"], "status_counts": overlay["status_counts"]}
+        else:
+            device_status, current_state = statuses.get(node["id"], (Device.STATUS_OFFLINE, {}))
+            overlay = status_overlay(device_status, current_state)
+            data = {**node["data"], "status": device_status, "current_state": current_state}
+        nodes.append({
+            **node,
+            "data": data,
+            "style": {**node["style"], "borderColor": overlay["color"], "opacity": overlay["opacity"]},
+        })
+        edges.append({
+            **edge,
+            "animated": overlay["animated"],
+            "style": {**edge["style"], "stroke": overlay["color"]},
+        })
+
+    return {
+        "nodes": nodes,
+        "edges": edges,
+        "layout": static.get("layout", layout),
+        "lod": lod,
+        "layout_version": static["version"],
+    }
+
+
+# ── Incremental status ──
+
+def _fingerprint(device_status, current_state):
+    state = json.dumps(current_state, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.blake2b(f"{device_status}|{state}".encode(), digest_size=8).hexdigest()
+
+
+def _snapshot_key(cursor):
+    return f"topology:status:{cursor}"
+
+
+def status_changes(since=None):
+    """
+    Return the statuses that changed since the snapshot identified by ``since``.
+
+    The response carries a new ``cursor`` for the next call. When ``since`` is
+    missing, unknown or expired, every node is returned with ``full: true``.
+    A changed ``layout_version`` tells the client to reload ``/topology/``.
+    """
+    statuses = current_statuses()
+    fingerprints = {node_id: _fingerprint(*value) for node_id, value in statuses.items()}
+    cursor = hashlib.blake2b(
+        json.dumps(sorted(fingerprints.items())).encode(), digest_size=12
+    ).hexdigest()
+
+    previous = cache.get(_snapshot_key(since)) if since else None
+    if previous is None:
+        changed = sorted(statuses, key=int)
+    else:
+        changed = sorted((n for n, fp in fingerprints.items() if previous.get(n) != fp), key=int)
+
+    if since != cursor:
+        cache.set(_snapshot_key(cursor), fingerprints, STATUS_SNAPSHOT_TIMEOUT)
+    else:
+        cache.touch(_snapshot_key(cursor), STATUS_SNAPSHOT_TIMEOUT)
+
+    return {
+        "cursor": cursor,
+        "layout_version": topology_layout.generation(),
+        "full": previous is None,
+        "nodes": [{"id": node_id, **status_overlay(*statuses[node_id])} for node_id in changed],
+        "removed": sorted(set(previous) - set(statuses), key=int) if previous else [],
+    }
@@ -0,0 +1,134 @@
+"""
+Vectorized layout engine for the topology graph.
+
+All functions work on NumPy arrays for every node at once and return an
+``(n, 2)`` array of positions. The gateway sits at the origin.
+
+- ``radial_positions``: every device on one circle (the original layout)
+- ``ring_positions``: devices grouped by room; each room is a cluster of
+  concentric rings, and the clusters sit on an outer ring sized so they do
+  not overlap
+- ``force_positions``: Fruchterman-Reingold force-directed layout, seeded
+  from previous positions so nodes stay put when the device set changes
+
+Layouts are deterministic for the same input, so cached positions and freshly
+computed ones agree.
+"""
+import math
+
+import numpy as np
+
+# Distance between neighbouring device nodes (node width is 180px)
+NODE_SPACING = 220.0
+# Minimum distance between a room cluster and the gateway
+MIN_RING_RADIUS = 450.0
+# Space between neighbouring room clusters on the outer ring
+ROOM_GAP = 160.0
+RADIAL_RADIUS = 350.0
+
+FORCE_ITERATIONS = 80
+FORCE_WARM_ITERATIONS = 20
+# The repulsion step is O(n^2) in time and memory; larger graphs use rings
+FORCE_MAX_NODES = 1000
+
+
+def radial_positions(count, radius=RADIAL_RADIUS):
+    angles = 2 * math.pi * np.arange(count) / max(count, 1)
+    return np.column_stack((radius * np.cos(angles), radius * np.sin(angles)))
+
+
+def _ring_capacities(max_size, spacing):
+    """Cumulative device capacity of the concentric rings inside a room cluster."""
+    capacities = []
+    total = 0
+    k = 0
+    while total < max_size:
+        # Ring k has radius (k + 1) * spacing
+        cap = max(1, int(2 * math.pi * (k + 1)))
+        capacities.append(cap)
+        total += cap
+        k += 1
+    return np.cumsum(capacities) if capacities else np.zeros(0, dtype=int)
+
+
+def ring_positions(group_sizes, spacing=NODE_SPACING):
+    """
+    Lay out devices grouped by room.
+
+    ``group_sizes`` lists the number of devices per room; devices are expected
+    to be ordered room by room. Returns ``(room_centers, device_positions)``.
+    """
+    sizes = np.asarray(group_sizes, dtype=int)
+    if sizes.size == 0 or sizes.sum() == 0:
+        return np.zeros((len(sizes), 2)), np.zeros((0, 2))
+
+    cumulative = _ring_capacities(int(sizes.max()), spacing)
+    starts = np.concatenate(([0], cumulative[:-1]))
+
+    # Radius of each room cluster = radius of its outermost ring
+    rings_used = np.searchsorted(cumulative, sizes, side='left') + 1
+    radii = np.where(sizes > 0, rings_used * spacing, 0.0)
+
+    # Rooms get a share of the outer ring proportional to their diameter
+    diameters = 2 * radii + ROOM_GAP
+    circumference = diameters.sum()
+    outer = max(MIN_RING_RADIUS + radii.max(), circumference / (2 * math.pi))
+    arcs = diameters / circumference * 2 * math.pi
+    room_angles = np.cumsum(arcs) - arcs / 2
+    centers = outer * np.column_stack((np.cos(room_angles), np.sin(room_angles)))
+
+    # Per device: room, index inside the room, ring and slot on that ring
+    room_of = np.repeat(np.arange(len(sizes)), sizes)
+    local = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    ring = np.searchsorted(cumulative, local, side='right')
+    slot = local - starts[ring]
+    on_ring = np.minimum(cumulative[ring], sizes[room_of]) - starts[ring]
+    # Start each room's rings facing away from the gateway
+    angle = room_angles[room_of] + 2 * math.pi * slot / on_ring
+    radius = (ring + 1) * spacing
+    positions = centers[room_of] + np.column_stack((radius * np.cos(angle), radius * np.sin(angle)))
+    return centers, positions
+
+
+def force_positions(initial, edges, fixed=None, iterations=FORCE_ITERATIONS,
+                    spacing=NODE_SPACING, temperature=None):
+    """
+    Fruchterman-Reingold layout.
+
+    - initial: ``(n, 2)`` starting positions (also fixes the result for a given input)
+    - edges: ``(m, 2)`` integer array of node index pairs
+    - fixed: boolean mask of nodes that must not move (e.g. the gateway)
+    """
+    pos = np.array(initial, dtype=float, copy=True)
+    n = len(pos)
+    if n < 2:
+        return pos
+    edges = np.asarray(edges, dtype=int).reshape(-1, 2)
+    fixed = np.zeros(n, dtype=bool) if fixed is None else np.asarray(fixed, dtype=bool)
+    k = spacing
+    t = 2 * k if temperature is None else temperature
+    cooling = t / max(iterations, 1)
+
+    for _ in range(iterations):
+        delta = pos[:, None, :] - pos[None, :, :]
+        dist2 = np.einsum('ijk,ijk->ij', delta, delta)
+        np.fill_diagonal(dist2, np.inf)
+        np.maximum(dist2, 1e-2, out=dist2)
+        # Repulsion k^2 / d along the unit vector = delta * k^2 / d^2
+        disp = np.einsum('ijk,ij->ik', delta, (k * k) / dist2)
+
+        if len(edges):
+            d = pos[edges[:, 0]] - pos[edges[:, 1]]
+            length = np.sqrt(np.einsum('ij,ij->i', d, d))
+            # Attraction d^2 / k along the unit vector = d * |d| / k
+            pull = d * (length / k)[:, None]
+            np.subtract.at(disp, edges[:, 0], pull)
+            np.add.at(disp, edges[:, 1], pull)
+
+        step = np.sqrt(np.einsum('ij,ij->i', disp, disp))
+        scale = np.minimum(step, t) / np.maximum(step, 1e-9)
+        disp *= scale[:, None]
+        disp[fixed] = 0
+        pos += disp
+        t = max(t - cooling, 1.0)
+    return pos
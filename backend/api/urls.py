@@ -4,6 +4,8 @@ from .views import (
     RegisterView, 
     ProfileView, 
     TopologyView,
+    TopologyStatusView,
+    HomeSummaryView,
     CustomDeviceTypeListCreateView,
     CustomDeviceTypeDetailView,
     AdminPendingDeviceTypeListView,
@@ -13,6 +15,8 @@ from .views import (
     DeviceListCreateView,
     DeviceDetailView,
     DeviceStateUpdateView,
+    DeviceBulkStateView,
+    DeviceCommandQueueView,
     DeviceTypeProposeView,
     DeviceTypeWiringImageView,
     DeviceTypeDocImageUploadView,
@@ -22,6 +26,15 @@ from .views import (
     DeviceTypeImportView,
     RoomListCreateView,
     RoomDetailView,
+    SceneListCreateView,
+    SceneDetailView,
+    SceneActivateView,
+    SceneSnapshotView,
+    SceneRestoreView,
+    AutomationRuleListCreateView,
+    AutomationRuleDetailView,
+    ScheduleListCreateView,
+    ScheduleDetailView,
     UserListView,
     UserDetailView,
     # Notification Views
@@ -34,8 +47,12 @@ from .views import (
     AdminNotificationBroadcastView,
     # Dashboard Layout Views
     DashboardLayoutView,
+    DashboardBootstrapView,
     AdminDashboardLayoutView,
     DeviceOrderView,
+    AdminCacheStatsView,
+    AdminMQTTStatsView,
+    AdminCommandMetricsView,
 )
 from rest_framework_simplejwt.views import (
     TokenObtainPairView,
@@ -49,6 +66,8 @@ urlpatterns = [
     path('token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
     path('me/', ProfileView.as_view(), name='profile'),
     path('topology/', TopologyView.as_view(), name='topology'),
+    path('topology/status/', TopologyStatusView.as_view(), name='topology-status'),
+    path('summary/', HomeSummaryView.as_view(), name='home-summary'),
     path('device-types/', CustomDeviceTypeListCreateView.as_view(), name='device-types-list'),
     path('device-types/propose/', DeviceTypeProposeView.as_view(), name='device-types-propose'),
     path('device-types/import-defaults/', DeviceTypeImportDefaultsView.as_view(), name='device-types-import-defaults'),
@@ -71,8 +90,19 @@ urlpatterns = [
     path('devices/', DeviceListCreateView.as_view(), name='device-list-create'),
     path('devices/<int:pk>/', DeviceDetailView.as_view(), name='device-detail'),
     path('devices/<int:pk>/state/', DeviceStateUpdateView.as_view(), name='device-state-update'),
+    path('devices/bulk-state/', DeviceBulkStateView.as_view(), name='device-bulk-state'),
+    path('devices/command-queue/', DeviceCommandQueueView.as_view(), name='device-command-queue'),
     path('rooms/', RoomListCreateView.as_view(), name='room-list-create'),
     path('rooms/<int:pk>/', RoomDetailView.as_view(), name='room-detail'),
+    path('scenes/', SceneListCreateView.as_view(), name='scene-list-create'),
+    path('scenes/snapshot/', SceneSnapshotView.as_view(), name='scene-snapshot'),
+    path('scenes/<int:pk>/', SceneDetailView.as_view(), name='scene-detail'),
+    path('scenes/<int:pk>/activate/', SceneActivateView.as_view(), name='scene-activate'),
+    path('scenes/<int:pk>/restore/', SceneRestoreView.as_view(), name='scene-restore'),
+    path('rules/', AutomationRuleListCreateView.as_view(), name='rule-list-create'),
+    path('rules/<int:pk>/', AutomationRuleDetailView.as_view(), name='rule-detail'),
+    path('schedules/', ScheduleListCreateView.as_view(), name='schedule-list-create'),
+    path('schedules/<int:pk>/', ScheduleDetailView.as_view(), name='schedule-detail'),
     path('users/', UserListView.as_view(), name='user-list'),
     path('users/<int:pk>/', UserDetailView.as_view(), name='user-detail'),
     
@@ -92,4 +122,10 @@ urlpatterns = [
     path('dashboard-layout/', DashboardLayoutView.as_view(), name='dashboard-layout'),
     path('admin/dashboard-layout/', AdminDashboardLayoutView.as_view(), name='admin-dashboard-layout'),
     path('device-order/', DeviceOrderView.as_view(), name='device-order'),
+    path('dashboard/bootstrap/', DashboardBootstrapView.as_view(), name='dashboard-bootstrap'),
+
+    # Cache Diagnostics
+    path('admin/cache-stats/', AdminCacheStatsView.as_view(), name='admin-cache-stats'),
+    path('admin/mqtt-stats/', AdminMQTTStatsView.as_view(), name='admin-mqtt-stats'),
+    path('admin/command-metrics/', AdminCommandMetricsView.as_view(), name='admin-command-metrics'),
 ]
\ No newline at end of file
@@ -4,22 +4,47 @@ from rest_framework.permissions import AllowAny
 from .serializers import (
     RegisterSerializer, UserSerializer, DeviceSerializer, RoomSerializer, 
     CustomDeviceTypeSerializer, NotificationSerializer, NotificationCreateSerializer,
-    DashboardLayoutSerializer
+    DashboardLayoutSerializer, SceneSerializer, AutomationRuleSerializer, ScheduleSerializer
 )
 from rest_framework.parsers import MultiPartParser, FormParser, JSONParser
 from rest_framework import status
 from rest_framework.response import Response
-from .models import Device, Room, CustomDeviceType, DeviceCardTemplate, DeviceControl, Notification, DashboardLayout
-from .permissions import IsAdmin, IsOwner
-from django.core.cache import cache
+from .models import Device, Room, CustomDeviceType, Notification, DashboardLayout, Scene, AutomationRule, Schedule
+from .permissions import IsAdmin
+from . import shared_state
+from .caching import approved_device_types
+from .dashboard_bootstrap import build_bootstrap, render_with_etag
+from .command_queue import queue_depths
+from .command_tracking import METRICS_MAX_AGE as COMMAND_METRICS_MAX_AGE, METRICS_STATE as COMMAND_METRICS_STATE
+from .device_commands import NOT_FOUND_DETAIL, resolve_targets, send_commands
+from .device_query import filter_devices, group_devices
+from .device_twin import record_desired
+from .fixture_catalog import default_types
+from .home_summary import get_summary
+from .scenes import activate_scene, compile_scene, restore_scene, snapshot_actions
+from .sparse_fields import SparseFieldsViewMixin
+from .topology import (
+    DEFAULT_LAYOUT as TOPOLOGY_DEFAULT_LAYOUT, DEFAULT_LOD as TOPOLOGY_DEFAULT_LOD, LAYOUTS as TOPOLOGY_LAYOUTS,
+    LOD_MODES as TOPOLOGY_LOD_MODES,
+    build_topology, status_changes,
+)
+from .device_type_transfer import (
+    EXPORT_COMPRESSIONS, EXPORT_FORMATS, ImportParseError, compression_available,
+    export_content_type, export_filename, export_queryset, import_device_types,
+    iter_import_items, serialize_for_export, stream_export,
+)
 from django.conf import settings
-import json
+from django.core.cache import caches
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.decorators import method_decorator
+from django.utils.http import parse_etags
+from django.views.decorators.gzip import gzip_page
 import os
 import re
 import base64
 import uuid
 
-class CustomDeviceTypeListCreateView(generics.ListCreateAPIView):
+class CustomDeviceTypeListCreateView(SparseFieldsViewMixin, generics.ListCreateAPIView):
     serializer_class = CustomDeviceTypeSerializer
     permission_classes = [permissions.IsAuthenticated]
 
@@ -32,29 +57,18 @@ class CustomDeviceTypeListCreateView(generics.ListCreateAPIView):
                 'card_template__controls'
             ).all()
         
-        # Cache approved device types for non-admin users (5 minutes)
-        cache_key = 'approved_device_types_qs'
-        cached_ids = cache.get(cache_key)
-        
-        base_qs = CustomDeviceType.objects.select_related(
+        # Cache approved device type IDs for non-admin users (invalidated on change)
+        approved_ids = approved_device_types.get_or_set(
+            lambda: list(CustomDeviceType.objects.filter(approved=True).values_list('id', flat=True))
+        )
+
+        return CustomDeviceType.objects.select_related(
             'card_template'
         ).prefetch_related(
             'card_template__controls'
-        )
-        
-        if cached_ids is not None:
-            return base_qs.filter(id__in=cached_ids)
-        
-        # Cache the IDs of approved types
-        approved_qs = base_qs.filter(approved=True)
-        approved_ids = list(approved_qs.values_list('id', flat=True))
-        cache.set(cache_key, approved_ids, timeout=300)
-        
-        return approved_qs
+        ).filter(id__in=approved_ids)
 
     def perform_create(self, serializer):
-        # Invalidate cache when new type is created
-        cache.delete('approved_device_types_qs')
         is_admin = IsAdmin().has_permission(self.request, self)
         serializer.save(approved=is_admin)
 
@@ -81,7 +95,7 @@ class CustomDeviceTypeDetailView(generics.RetrieveUpdateDestroyAPIView):
         instance.delete()
 
 
-class UserListView(generics.ListAPIView):
+class UserListView(SparseFieldsViewMixin, generics.ListAPIView):
     """
     List all users (Admin only).
     """
@@ -93,7 +107,7 @@ class UserListView(generics.ListAPIView):
         # Enforce admin permission
         if not IsAdmin().has_permission(self.request, self):
              self.permission_denied(self.request, message="Only Admins/Owners can list users.")
-        return User.objects.all()
+        return User.objects.select_related('profile')
 
 class UserDetailView(generics.RetrieveUpdateAPIView):
     """
@@ -146,7 +160,7 @@ class UserDetailView(generics.RetrieveUpdateAPIView):
         return Response(UserSerializer(user, context={'request': request}).data, status=status.HTTP_200_OK)
 
 
-class RoomListCreateView(generics.ListCreateAPIView):
+class RoomListCreateView(SparseFieldsViewMixin, generics.ListCreateAPIView):
     serializer_class = RoomSerializer
     permission_classes = [permissions.IsAuthenticated]
 
@@ -182,6 +196,171 @@ class RoomDetailView(generics.RetrieveUpdateDestroyAPIView):
 
 
 
+class SceneListCreateView(generics.ListCreateAPIView):
+    """
+    GET/POST /api/scenes/
+    Any user can list scenes; only Admins/Owners create them.
+    """
+    serializer_class = SceneSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_queryset(self):
+        return Scene.objects.select_related('user')
+
+    def perform_create(self, serializer):
+        if not IsAdmin().has_permission(self.request, self):
+            self.permission_denied(self.request, message="Only Admins/Owners can create scenes.")
+        compile_scene(serializer.save(user=self.request.user))
+
+
+class SceneDetailView(generics.RetrieveUpdateDestroyAPIView):
+    serializer_class = SceneSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_queryset(self):
+        return Scene.objects.select_related('user')
+
+    def perform_update(self, serializer):
+        if not IsAdmin().has_permission(self.request, self):
+            self.permission_denied(self.request, message="Only Admins/Owners can update scenes.")
+        compile_scene(serializer.save())
+
+    def perform_destroy(self, instance):
+        if not IsAdmin().has_permission(self.request, self):
+            self.permission_denied(self.request, message="Only Admins/Owners can delete scenes.")
+        instance.delete()
+
+
+class SceneActivateView(views.APIView):
+    """
+    POST /api/scenes/{pk}/activate/
+    Apply a scene: publish its precompiled plan. Any authenticated user.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def post(self, request, pk):
+        scene = Scene.objects.only('id', 'name', 'plan').filter(pk=pk).first()
+        if scene is None:
+            return Response({"detail": "Scene not found."}, status=status.HTTP_404_NOT_FOUND)
+        result = activate_scene(scene)
+        return Response({"status": "Scene activated", "scene": scene.id, **result}, status=status.HTTP_202_ACCEPTED)
+
+
+class SceneSnapshotView(views.APIView):
+    """
+    POST /api/scenes/snapshot/
+    Create a scene from the present state of a room's devices (``room``: ID or
+    "none") or of the whole home (no ``room``). Admins/Owners only.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def post(self, request):
+        if not IsAdmin().has_permission(request, self):
+            return Response({"detail": "Only Admins/Owners can create scenes."}, status=status.HTTP_403_FORBIDDEN)
+        room = request.data.get('room')
+        devices = Device.objects.all()
+        if room == 'none':
+            devices = devices.filter(room__isnull=True)
+        elif room is not None:
+            if isinstance(room, bool) or not isinstance(room, int):
+                return Response({"detail": "room must be a room ID or \"none\"."}, status=status.HTTP_400_BAD_REQUEST)
+            devices = devices.filter(room_id=room)
+        actions = snapshot_actions(devices)
+        if not actions:
+            return Response({"detail": "No device state to capture."}, status=status.HTTP_400_BAD_REQUEST)
+        serializer = SceneSerializer(data={**{k: v for k, v in request.data.items() if k in ('name', 'icon')},
+                                           'actions': actions})
+        serializer.is_valid(raise_exception=True)
+        scene = compile_scene(serializer.save(user=request.user, snapshot=True))
+        return Response(SceneSerializer(scene).data, status=status.HTTP_201_CREATED)
+
+
+class SceneRestoreView(views.APIView):
+    """
+    POST /api/scenes/{pk}/restore/
+    Apply a scene sending only the values that differ from the devices'
+    present state. Any authenticated user.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def post(self, request, pk):
+        scene = Scene.objects.only('id', 'name', 'plan').filter(pk=pk).first()
+        if scene is None:
+            return Response({"detail": "Scene not found."}, status=status.HTTP_404_NOT_FOUND)
+        result = restore_scene(scene)
+        return Response({"status": "Scene restored", "scene": scene.id, **result}, status=status.HTTP_202_ACCEPTED)
+
+
+class AutomationRuleListCreateView(generics.ListCreateAPIView):
+    """
+    GET/POST /api/rules/
+    Any user can list automation rules; only Admins/Owners create them.
+    """
+    serializer_class = AutomationRuleSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_queryset(self):
+        return AutomationRule.objects.select_related('user')
+
+    def perform_create(self, serializer):
+        if not IsAdmin().has_permission(self.request, self):
+            self.permission_denied(self.request, message="Only Admins/Owners can create rules.")
+        serializer.save(user=self.request.user)
+
+
+class AutomationRuleDetailView(generics.RetrieveUpdateDestroyAPIView):
+    serializer_class = AutomationRuleSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_queryset(self):
+        return AutomationRule.objects.select_related('user')
+
+    def perform_update(self, serializer):
+        if not IsAdmin().has_permission(self.request, self):
+            self.permission_denied(self.request, message="Only Admins/Owners can update rules.")
+        serializer.save()
+
+    def perform_destroy(self, instance):
+        if not IsAdmin().has_permission(self.request, self):
+            self.permission_denied(self.request, message="Only Admins/Owners can delete rules.")
+        instance.delete()
+
+
+class ScheduleListCreateView(generics.ListCreateAPIView):
+    """
+    GET/POST /api/schedules/
+    Any user can list schedules; only Admins/Owners create them.
+    """
+    serializer_class = ScheduleSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_queryset(self):
+        return Schedule.objects.select_related('user')
+
+    def perform_create(self, serializer):
+        if not IsAdmin().has_permission(self.request, self):
+            self.permission_denied(self.request, message="Only Admins/Owners can create schedules.")
+        serializer.save(user=self.request.user)
+
+
+class ScheduleDetailView(generics.RetrieveUpdateDestroyAPIView):
+    serializer_class = ScheduleSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_queryset(self):
+        return Schedule.objects.select_related('user')
+
+    def perform_update(self, serializer):
+        if not IsAdmin().has_permission(self.request, self):
+            self.permission_denied(self.request, message="Only Admins/Owners can update schedules.")
+        serializer.save()
+
+    def perform_destroy(self, instance):
+        if not IsAdmin().has_permission(self.request, self):
+            self.permission_denied(self.request, message="Only Admins/Owners can delete schedules.")
+        instance.delete()
+
+
 class SystemStatusView(views.APIView):
     """
     GET /api/system-status/
@@ -265,128 +444,81 @@ class TopologyView(views.APIView):
     """
     Returns the network topology of the home environment.
     Visualizes the HomeForge Server connected to all registered devices.
-    Uses a radial layout for visualization.
+    The static layout is cached (see api/topology.py); only statuses are
+    read and patched in per request.
+
+    Query parameters:
+    - layout=radial|rings|force   one circle (default), room-clustered rings or force-directed
+    - lod=devices|rooms|auto      one node per device (default), or rooms collapsed into
+                                  aggregate nodes (auto: above settings.TOPOLOGY_LOD_THRESHOLD devices)
     """
     permission_classes = (permissions.IsAuthenticated,)
 
     def get(self, request):
-        import math
-        user = request.user
+        layout = request.query_params.get('layout', TOPOLOGY_DEFAULT_LAYOUT)
+        if layout not in TOPOLOGY_LAYOUTS:
+            return Response({"detail": f"layout must be one of: {', '.join(TOPOLOGY_LAYOUTS)}."}, status=status.HTTP_400_BAD_REQUEST)
+        lod = request.query_params.get('lod', TOPOLOGY_DEFAULT_LOD)
+        if lod not in TOPOLOGY_LOD_MODES:
+            return Response({"detail": f"lod must be one of: {', '.join(TOPOLOGY_LOD_MODES)}."}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(build_topology(layout, lod))
 
-        # Optimized: select_related and only() for required fields
-        devices = Device.objects.select_related(
-            'room', 'device_type'
-        ).only(
-            'id', 'name', 'ip_address', 'status', 'icon', 'current_state',
-            'room__name', 'device_type__name'
-        )
-        
-        # Evaluate queryset once to avoid multiple DB hits
-        device_list = list(devices)
-        device_count = len(device_list)
 
-        nodes = []
-        edges = []
-        
-        # Create Central Server Node (The "Hub")
-        gateway_id = "homeforge-gateway"
-        nodes.append({
-            "id": gateway_id,
-            "type": "input",
-            "data": { 
-                "label": "MQTT Broker",
-                "ip": "HomeForge Hub",
-                "status": "online",
-                "type": "server",
-                "room": "Server Room"
-            },
-            "position": { "x": 0, "y": 0 },
-            "style": { 
-                "background": "#F3F4F6", 
-                "color": "#1F2937", 
-                "border": "2px solid #3B82F6",
-                "borderRadius": "8px",
-                "fontWeight": "bold"
-            }
-        })
+class TopologyStatusView(views.APIView):
+    """
+    GET /api/topology/status/?since=<cursor>
+    Status-only refresh for the topology page. Returns the nodes whose status
+    or current_state changed since the snapshot identified by ``since`` and a
+    new cursor for the next poll.
+    """
+    permission_classes = (permissions.IsAuthenticated,)
 
-        # Pre-compute status colors mapping
-        status_colors = {
-            Device.STATUS_ONLINE: "#10B981",
-            Device.STATUS_OFFLINE: "#EF4444",
-            Device.STATUS_ERROR: "#F59E0B"
-        }
+    def get(self, request):
+        return Response(status_changes(request.query_params.get('since')))
 
-        # Generate Device Nodes using pre-fetched list
-        radius = 350
-        
-        for index, device in enumerate(device_list):
-            angle = (2 * math.pi * index) / device_count if device_count > 0 else 0
-            x_pos = radius * math.cos(angle)
-            y_pos = radius * math.sin(angle)
-            
-            node_id = str(device.id)
-            status_color = status_colors.get(device.status, "#EF4444")
-
-            # Determine label style based on binding status
-            is_bound = bool(device.mac_address)
-            border_style = "solid" if is_bound else "dashed"
-
-            nodes.append({
-                "id": node_id,
-                "type": "device",
-                "data": { 
-                    "label": device.name,
-                    "ip": device.ip_address,
-                    "mac": device.mac_address,
-                    "status": device.status,
-                    "room": device.room.name if device.room else "Unassigned",
-                    "device_type": device.device_type.name if device.device_type else "Unknown",
-                    "icon": device.icon,
-                    "current_state": device.current_state,
-                    "is_bound": is_bound
-                },
-                "position": { "x": x_pos, "y": y_pos },
-                "style": {
-                    "width": 180,
-                    "borderColor": status_color,
-                    "borderWidth": "2px" if is_bound else "1px",
-                    "borderStyle": border_style,
-                    "padding": "10px",
-                    "borderRadius": "5px",
-                    "background": "white",
-                    "opacity": 1.0 if device.status == Device.STATUS_ONLINE else 0.6
-                }
-            })
 
-            edges.append({
-                "id": f"edge-{gateway_id}-{node_id}",
-                "source": gateway_id,
-                "target": node_id,
-                "animated": device.status == Device.STATUS_ONLINE,
-                "style": { 
-                    "stroke": status_color,
-                    "strokeWidth": 2
-                },
-            })
+class HomeSummaryView(views.APIView):
+    """
+    GET /api/summary/
+    Device totals by status, per room and per device type, plus per-room
+    temperature/humidity averages of online sensors. Cached; see api/home_summary.py.
+    """
+    permission_classes = (permissions.IsAuthenticated,)
 
-        return Response({ "nodes": nodes, "edges": edges })
+    def get(self, request):
+        return Response(get_summary())
 
 
-class DeviceListCreateView(generics.ListCreateAPIView):
+class DeviceListCreateView(SparseFieldsViewMixin, generics.ListCreateAPIView):
     """
     List all devices or register a new one.
+
+    GET query parameters (see api/device_query.py), all applied in SQL:
+    - room=<id>|none, status=online,error, type=<id>, search=<text>
+    - ordering=name|status|room|type|updated_at|id, prefix - for descending
+    - group_by=room|type|status|name|custom (DashboardLayout.ORDER_CHOICES):
+      returns all matching devices in groups with per-group counts instead of a page
     """
     serializer_class = DeviceSerializer
     permission_classes = [permissions.IsAuthenticated]
 
     def get_queryset(self):
         # Optimized: select_related for ForeignKeys to avoid N+1 queries
-        return Device.objects.select_related(
+        queryset = Device.objects.select_related(
             'room', 'user', 'device_type', 'device_type__card_template'
         ).prefetch_related(
             'device_type__card_template__controls'
         )
+        if self.request.method == 'GET':
+            queryset = filter_devices(queryset, self.request.query_params)
+        return queryset
+
+    def list(self, request, *args, **kwargs):
+        group_by = request.query_params.get('group_by')
+        if not group_by:
+            return super().list(request, *args, **kwargs)
+        queryset = self.filter_queryset(self.get_queryset())
+        return Response(group_devices(queryset, group_by, lambda devices: self.get_serializer(devices, many=True).data))
 
     def perform_create(self, serializer):
         """
@@ -499,8 +631,10 @@ class DeviceStateUpdateView(views.APIView):
         # The hardware will report back (via MQTT) when the state actually changes.
         # This fulfills the requirement: "platform should say it's on only when the esp device performed the task"
         
-        # Future Hook: Sync with hardware
-        self.sync_with_hardware(device, new_state)
+        # Remember the command until a state report confirms it, so the MQTT
+        # listener can resend it if the device misses it (api/device_twin.py)
+        record_desired(Device.objects.filter(pk=device.pk), new_state)
+        queued = self.sync_with_hardware(device, new_state)
 
         # Prepare optimistic state for the frontend to render immediately
         # while waiting for the hardware confirmation.
@@ -509,8 +643,11 @@ class DeviceStateUpdateView(views.APIView):
         optimistic_state = {**current_state, **new_state}
 
         return Response({
-            "status": "Command sent", 
-            "detail": "State will update when device confirms.",
+            "status": "Command queued" if queued else "Command sent",
+            "detail": (
+                "Device is offline; the command will be sent when it reconnects." if queued
+                else "State will update when device confirms."
+            ),
             "device_status": device.status,
             "current_state": optimistic_state
         }, status=status.HTTP_202_ACCEPTED)
@@ -518,45 +655,62 @@ class DeviceStateUpdateView(views.APIView):
     def sync_with_hardware(self, device, state_changes):
         """
         Send command via MQTT.
-        If MAC is known, use it. Otherwise attempt to control via IP binding (less reliable).
+        Devices are addressed by MAC; one that has not checked in yet cannot be controlled.
+        Returns True when the device is offline and the command was queued for it.
         """
         import logging
         logger = logging.getLogger(__name__)
 
+        queued = False
         try:
-            from .mqtt_client import mqtt_client
-            
-            identifier = device.mac_address
-            # If MAC is missing, we can't control it reliably as per the new firmware protocol.
-            # However, the user might not have waited for the device to "check in".
-            # For now, we only support MAC-based pub if it's stored.
-            
-            if identifier:
-                # Compatibility Layer: ensure single-relay devices receive 'relay_1' command
-                # regardless of UI variable name.
-                payload = state_changes.copy()
-                
-                # Check if payload has boolean values but misses 'relay_1' or 'switch-*' keys
-                has_relay_key = any(k == "relay_1" or k.startswith("switch-") for k in payload.keys())
-                
-                if not has_relay_key:
-                    # Find first boolean value in payload to use as relay state
-                    for k, v in payload.items():
-                        if isinstance(v, bool) or (isinstance(v, str) and v.lower() in ['true', 'false', 'on', 'off']):
-                            payload["relay_1"] = v
-                            break
-
-                mqtt_client.publish(identifier, payload)
-            else:
-                # Log warning: Device hasn't checked in yet to establish MAC binding
-                logger.warning(f"Cannot control device {device.name} (ID: {device.id}) - No MAC address bound yet.")
-                
+            queued = send_commands([device], state_changes)[0]["queued"]
         except Exception as e:
             logger.error(f"Failed to publish MQTT command: {e}")
         logger.info(f"HARDWARE SYNC: Device {device.id} ({device.ip_address}) -> {state_changes}")
-        # Logic to publish to MQTT topic would go here
-        # topic = f"homeforge/devices/{device.id}/set"
-        # mqtt_client.publish(topic, json.dumps(state_changes))
+        return queued
+
+
+class DeviceBulkStateView(views.APIView):
+    """
+    POST /api/devices/bulk-state/
+    Send one state change to many devices, selected by ``devices`` (IDs),
+    ``room`` (ID or "none") or ``type`` (device type ID).
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def post(self, request):
+        state_changes = request.data.get('state') if isinstance(request.data, dict) else None
+        if not isinstance(state_changes, dict) or not state_changes:
+            return Response({"detail": "state must be a non-empty JSON object."}, status=status.HTTP_400_BAD_REQUEST)
+
+        devices, missing = resolve_targets(request.data)
+        record_desired(Device.objects.filter(pk__in=[device.id for device in devices]), state_changes)
+        results = send_commands(devices, state_changes)
+        results += [{"id": pk, "accepted": False, "queued": False, "detail": NOT_FOUND_DETAIL} for pk in missing]
+
+        return Response({
+            "status": "Commands sent",
+            "detail": "States will update when devices confirm.",
+            "accepted": sum(1 for result in results if result["accepted"]),
+            "results": results,
+        }, status=status.HTTP_202_ACCEPTED)
+
+
+class DeviceCommandQueueView(views.APIView):
+    """
+    GET /api/devices/command-queue/
+    Commands waiting for offline devices: queue depth per device.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request):
+        devices = queue_depths()
+        return Response({
+            "delivery": settings.MQTT_OFFLINE_DELIVERY,
+            "total": sum(entry["depth"] for entry in devices),
+            "devices": devices,
+        })
+
 
 class DeviceTypeProposeView(generics.CreateAPIView):
     """
@@ -645,32 +799,26 @@ class DeviceTypeImportDefaultsView(views.APIView):
     POST /api/device-types/import-defaults/
     Import platform-default device types from the fixture file.
     Skips types that already exist (by name). Admin/Owner only.
+    The fixture is served from the in-process catalog in api/fixture_catalog.py.
     """
     permission_classes = [permissions.IsAuthenticated]
 
     def get(self, request):
         """Return the list of available defaults and which are already imported."""
-        fixture_path = os.path.join(
-            os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
-            'api', 'fixtures', 'default_device_types.json'
-        )
-        if not os.path.exists(fixture_path):
+        try:
+            names = default_types.names()
+        except FileNotFoundError:
             return Response({"detail": "No defaults available."}, status=status.HTTP_404_NOT_FOUND)
 
-        with open(fixture_path, 'r') as f:
-            device_types = json.load(f)
-
         existing_names = set(
-            CustomDeviceType.objects.filter(
-                name__in=[dt['name'] for dt in device_types]
-            ).values_list('name', flat=True)
+            CustomDeviceType.objects.filter(name__in=names).values_list('name', flat=True)
         )
 
         result = []
-        for dt in device_types:
+        for name in names:
             result.append({
-                'name': dt['name'],
-                'already_imported': dt['name'] in existing_names,
+                'name': name,
+                'already_imported': name in existing_names,
             })
 
         return Response({
@@ -686,78 +834,13 @@ class DeviceTypeImportDefaultsView(views.APIView):
                 status=status.HTTP_403_FORBIDDEN
             )
 
-        base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-        fixture_path = os.path.join(base_dir, 'api', 'fixtures', 'default_device_types.json')
-
-        if not os.path.exists(fixture_path):
+        try:
+            device_types = default_types.device_types()
+        except FileNotFoundError:
             return Response({"detail": "No defaults available."}, status=status.HTTP_404_NOT_FOUND)
 
-        with open(fixture_path, 'r') as f:
-            device_types = json.load(f)
-
-        created = []
-        skipped = []
-
-        for dt_data in device_types:
-            name = dt_data['name']
-            if CustomDeviceType.objects.filter(name=name).exists():
-                skipped.append(name)
-                continue
-
-            firmware_code = self._read_file(base_dir, dt_data.get('firmware_code_file', ''))
-            wiring_text = self._read_file(base_dir, dt_data.get('wiring_diagram_text_file', ''))
-            documentation = self._read_file(base_dir, dt_data.get('documentation_file', ''))
-
-            device_type = CustomDeviceType.objects.create(
-                name=name,
-                definition=dt_data['definition'],
-                approved=True,
-                firmware_code=firmware_code,
-                wiring_diagram_text=wiring_text,
-                documentation=documentation,
-            )
-
-            card_data = dt_data.get('card_template')
-            if card_data:
-                template = DeviceCardTemplate.objects.create(
-                    device_type=device_type,
-                    layout_config=card_data.get('layout_config', {}),
-                )
-                for ctrl in card_data.get('controls', []):
-                    DeviceControl.objects.create(
-                        template=template,
-                        widget_type=ctrl['widget_type'],
-                        label=ctrl['label'],
-                        variable_mapping=ctrl['variable_mapping'],
-                        unit=ctrl.get('unit', ''),
-                        min_value=ctrl.get('min_value'),
-                        max_value=ctrl.get('max_value'),
-                        step=ctrl.get('step'),
-                        variant=ctrl.get('variant', ''),
-                        size=ctrl.get('size', ''),
-                    )
-
-            created.append(name)
-
-        # Invalidate cache
-        cache.delete('approved_device_types_qs')
-
-        return Response({
-            "status": "Import complete",
-            "created": created,
-            "skipped": skipped,
-            "created_count": len(created),
-            "skipped_count": len(skipped),
-        })
-
-    def _read_file(self, base_dir, relative_path):
-        if not relative_path:
-            return ''
-        full_path = os.path.join(base_dir, relative_path)
-        if os.path.exists(full_path):
-            with open(full_path, 'r') as f:
-                return f.read()
-        return ''
+        result = import_device_types(device_types)
+        return Response(result.as_dict())
 
 
 class DeviceTypeExportView(views.APIView):
@@ -765,6 +848,11 @@ class DeviceTypeExportView(views.APIView):
     GET /api/device-types/export/         — Export all approved device types as JSON
     GET /api/device-types/export/?ids=1,2 — Export specific device types by ID
     GET /api/device-types/{id}/export/    — Export a single device type
+
+    Bulk exports are streamed one device type at a time, so memory stays flat
+    regardless of catalog size. Optional query parameters:
+    - output=json|ndjson   JSON array (default) or one object per line
+    - compress=gzip|zstd   compress on the fly (zstd needs the zstandard package)
     """
     permission_classes = [permissions.IsAuthenticated]
 
@@ -772,76 +860,45 @@ class DeviceTypeExportView(views.APIView):
         if pk:
             # Single export
             try:
-                device_type = CustomDeviceType.objects.select_related(
-                    'card_template'
-                ).prefetch_related(
-                    'card_template__controls'
-                ).get(pk=pk)
+                device_type = export_queryset().get(pk=pk)
             except CustomDeviceType.DoesNotExist:
                 return Response({"detail": "Device Type not found."}, status=status.HTTP_404_NOT_FOUND)
-            data = [self._serialize_for_export(device_type)]
+            response = Response([serialize_for_export(device_type)])
+            response['Content-Disposition'] = 'attachment; filename="device_types_export.json"'
+            return response
+
+        # Bulk export
+        fmt = request.query_params.get('output', 'json')
+        if fmt not in EXPORT_FORMATS:
+            return Response({"detail": f"output must be one of: {', '.join(EXPORT_FORMATS)}."}, status=status.HTTP_400_BAD_REQUEST)
+        compress = request.query_params.get('compress') or None
+        if compress and compress not in EXPORT_COMPRESSIONS:
+            return Response({"detail": f"compress must be one of: {', '.join(EXPORT_COMPRESSIONS)}."}, status=status.HTTP_400_BAD_REQUEST)
+        if compress and not compression_available(compress):
+            return Response({"detail": f"{compress} compression is not available on this server."}, status=status.HTTP_400_BAD_REQUEST)
+
+        ids_param = request.query_params.get('ids')
+        qs = export_queryset()
+        if ids_param:
+            try:
+                ids = [int(i.strip()) for i in ids_param.split(',')]
+            except ValueError:
+                return Response({"detail": "ids must be comma-separated integers."}, status=status.HTTP_400_BAD_REQUEST)
+            qs = qs.filter(pk__in=ids)
         else:
-            # Bulk export
-            ids_param = request.query_params.get('ids')
-            qs = CustomDeviceType.objects.select_related(
-                'card_template'
-            ).prefetch_related(
-                'card_template__controls'
-            )
-            if ids_param:
-                try:
-                    ids = [int(i.strip()) for i in ids_param.split(',')]
-                except ValueError:
-                    return Response({"detail": "ids must be comma-separated integers."}, status=status.HTTP_400_BAD_REQUEST)
-                qs = qs.filter(pk__in=ids)
-            else:
-                qs = qs.filter(approved=True)
+            qs = qs.filter(approved=True)
+        qs = qs.order_by('id')
 
-            data = [self._serialize_for_export(dt) for dt in qs]
-
-        if not data:
+        if not qs.exists():
             return Response({"detail": "No device types found."}, status=status.HTTP_404_NOT_FOUND)
 
-        response = Response(data)
-        response['Content-Disposition'] = 'attachment; filename="device_types_export.json"'
+        response = StreamingHttpResponse(
+            stream_export(qs, fmt=fmt, compress=compress),
+            content_type=export_content_type(fmt, compress),
+        )
+        response['Content-Disposition'] = f'attachment; filename="{export_filename(fmt, compress)}"'
         return response
 
-    def _serialize_for_export(self, dt):
-        result = {
-            'name': dt.name,
-            'definition': dt.definition,
-            'firmware_code': dt.firmware_code,
-            'wiring_diagram_text': dt.wiring_diagram_text,
-            'documentation': dt.documentation,
-            # All images stored in DB — always included in exports
-            'wiring_diagram_base64': dt.wiring_diagram_base64 or '',
-            'documentation_images_base64': dt.documentation_images_base64 or [],
-        }
-
-        tmpl = getattr(dt, 'card_template', None)
-        if tmpl:
-            controls = []
-            for c in tmpl.controls.all().order_by('id'):
-                ctrl = {
-                    'widget_type': c.widget_type,
-                    'label': c.label,
-                    'variable_mapping': c.variable_mapping,
-                }
-                if c.unit: ctrl['unit'] = c.unit
-                if c.min_value is not None: ctrl['min_value'] = float(c.min_value)
-                if c.max_value is not None: ctrl['max_value'] = float(c.max_value)
-                if c.step is not None: ctrl['step'] = float(c.step)
-                if c.variant: ctrl['variant'] = c.variant
-                if c.size: ctrl['size'] = c.size
-                controls.append(ctrl)
-            result['card_template'] = {
-                'layout_config': tmpl.layout_config,
-                'controls': controls,
-            }
-        else:
-            result['card_template'] = None
-        return result
-
 
 class DeviceTypeDocImageUploadView(views.APIView):
     """
@@ -955,54 +1012,16 @@ class DeviceTypeImportView(views.APIView):
     """
     POST /api/device-types/import/
     Import device types from an uploaded JSON file.
-    Accepts the same format as the export. Admin/Owner only.
+    Accepts the same format as the export (JSON array or NDJSON, optionally
+    gzip/zstd compressed). Admin/Owner only.
     Skips types whose name already exists.
     All images are stored as base64 in the DB (no filesystem).
+    The upload is parsed incrementally and written in bulk, chunk by chunk,
+    inside a single transaction.
     """
     permission_classes = [permissions.IsAuthenticated]
     parser_classes = [MultiPartParser, FormParser, JSONParser]
 
-    def _import_documentation_images(self, device_type, doc_images_from_export):
-        """
-        Import documentation images from export format into the DB.
-        Handles both new format (documentation_images_base64 array) and
-        legacy format (documentation_images with original_url/data).
-        Rewrites markdown URLs to point to the API serving endpoint.
-        """
-        if not doc_images_from_export or not isinstance(doc_images_from_export, list):
-            return
-
-        images_list = []
-        documentation = device_type.documentation or ''
-
-        for img_entry in doc_images_from_export:
-            if not isinstance(img_entry, dict):
-                continue
-            data = img_entry.get('data', '')
-            if not data:
-                continue
-            filename = img_entry.get('filename', f"{uuid.uuid4()}.png")
-            filename = os.path.basename(filename)
-
-            images_list.append({
-                'filename': filename,
-                'data': data,
-            })
-
-            # Rewrite old URL references in documentation to new API-based URL
-            original_url = img_entry.get('original_url') or img_entry.get('url', '')
-            new_url = f"/api/device-types/{device_type.pk}/doc-image/{filename}"
-            if original_url and original_url in documentation:
-                documentation = documentation.replace(original_url, new_url)
-
-        if images_list:
-            device_type.documentation_images_base64 = images_list
-            update_fields = ['documentation_images_base64']
-            if documentation != (device_type.documentation or ''):
-                device_type.documentation = documentation
-                update_fields.append('documentation')
-            device_type.save(update_fields=update_fields)
-
     def post(self, request):
         if not IsAdmin().has_permission(request, self):
             return Response(
@@ -1013,105 +1032,27 @@ class DeviceTypeImportView(views.APIView):
         # Accept either uploaded file or JSON body
         uploaded = request.FILES.get('file')
         if uploaded:
-            try:
-                content = uploaded.read().decode('utf-8')
-                device_types = json.loads(content)
-            except (json.JSONDecodeError, UnicodeDecodeError):
-                return Response({"detail": "Invalid JSON file."}, status=status.HTTP_400_BAD_REQUEST)
+            device_types = iter_import_items(uploaded)
         else:
             device_types = request.data
             if isinstance(device_types, dict):
                 device_types = [device_types]
 
-        if not isinstance(device_types, list):
-            return Response(
-                {"detail": "Expected a JSON array of device types."},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-
-        created = []
-        skipped = []
-        errors = []
-
-        for i, dt_data in enumerate(device_types):
-            name = dt_data.get('name')
-            if not name:
-                errors.append(f"Item {i}: missing 'name' field.")
-                continue
-
-            if CustomDeviceType.objects.filter(name=name).exists():
-                skipped.append(name)
-                continue
-
-            definition = dt_data.get('definition', {})
-            if not isinstance(definition, dict):
-                errors.append(f"Item {i} ({name}): 'definition' must be an object.")
-                continue
-
-            firmware_code = dt_data.get('firmware_code', '')
-            wiring_text = dt_data.get('wiring_diagram_text', '')
-            documentation = dt_data.get('documentation', '')
-            wiring_base64 = dt_data.get('wiring_diagram_base64', '')
-            doc_images_base64 = dt_data.get('documentation_images_base64', [])
-
-            # Legacy support: if wiring_diagram_image_data exists but wiring_diagram_base64 doesn't
-            if not wiring_base64:
-                wiring_base64 = dt_data.get('wiring_diagram_image_data', '')
-
-            device_type = CustomDeviceType.objects.create(
-                name=name,
-                definition=definition,
-                approved=True,
-                proposed_by=request.user,
-                firmware_code=firmware_code,
-                wiring_diagram_text=wiring_text,
-                documentation=documentation,
-                wiring_diagram_base64=wiring_base64,
-                documentation_images_base64=doc_images_base64 if doc_images_base64 else [],
-            )
-
-            # Handle legacy format documentation_images (with original_url/data)
-            legacy_doc_images = dt_data.get('documentation_images')
-            if legacy_doc_images and not doc_images_base64:
-                self._import_documentation_images(device_type, legacy_doc_images)
-
-            card_data = dt_data.get('card_template')
-            if card_data and isinstance(card_data, dict):
-                template = DeviceCardTemplate.objects.create(
-                    device_type=device_type,
-                    layout_config=card_data.get('layout_config', {}),
+            if not isinstance(device_types, list):
+                return Response(
+                    {"detail": "Expected a JSON array of device types."},
+                    status=status.HTTP_400_BAD_REQUEST
                 )
-                for ctrl in card_data.get('controls', []):
-                    if not isinstance(ctrl, dict):
-                        continue
-                    DeviceControl.objects.create(
-                        template=template,
-                        widget_type=ctrl.get('widget_type', 'TOGGLE'),
-                        label=ctrl.get('label', ''),
-                        variable_mapping=ctrl.get('variable_mapping', ''),
-                        unit=ctrl.get('unit', ''),
-                        min_value=ctrl.get('min_value'),
-                        max_value=ctrl.get('max_value'),
-                        step=ctrl.get('step'),
-                        variant=ctrl.get('variant', ''),
-                        size=ctrl.get('size', ''),
-                    )
-
-            created.append(name)
-
-        cache.delete('approved_device_types_qs')
 
-        return Response({
-            "status": "Import complete",
-            "created": created,
-            "skipped": skipped,
-            "errors": errors,
-            "created_count": len(created),
-            "skipped_count": len(skipped),
-        })
+        try:
+            result = import_device_types(device_types, proposed_by=request.user)
+        except ImportParseError:
+            return Response({"detail": "Invalid JSON file."}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(result.as_dict())
 
 
-class AdminPendingDeviceTypeListView(generics.ListAPIView):
+class AdminPendingDeviceTypeListView(SparseFieldsViewMixin, generics.ListAPIView):
     """
     Admin: Get all pending (unapproved, not denied) device types with full details.
     These are types waiting for review (no rejection_reason set).
@@ -1126,7 +1067,7 @@ class AdminPendingDeviceTypeListView(generics.ListAPIView):
         return CustomDeviceType.objects.filter(approved=False, rejection_reason__isnull=True)
 
 
-class AdminDeniedDeviceTypeListView(generics.ListAPIView):
+class AdminDeniedDeviceTypeListView(SparseFieldsViewMixin, generics.ListAPIView):
     """
     Admin: Get all denied device types with full details.
     These are types that have been reviewed and rejected.
@@ -1275,8 +1216,6 @@ class AdminDeviceTypeReviewView(views.APIView):
             instance.approved = True
             instance.rejection_reason = None # Clear any previous rejection
             instance.save()
-            # Invalidate cache when approval status changes
-            cache.delete('approved_device_types_qs')
             
             # Create system notification about new approved device type
             Notification.objects.create(
@@ -1297,8 +1236,6 @@ class AdminDeviceTypeReviewView(views.APIView):
             instance.approved = False
             instance.rejection_reason = reason
             instance.save()
-            # Invalidate cache when approval status changes
-            cache.delete('approved_device_types_qs')
             
             # Create notification about denial
             Notification.objects.create(
@@ -1314,11 +1251,86 @@ class AdminDeviceTypeReviewView(views.APIView):
         return Response({"detail": "Invalid action. Use 'approve' or 'deny'."}, status=status.HTTP_400_BAD_REQUEST)
 
 
+class AdminCacheStatsView(views.APIView):
+    """
+    GET /api/admin/cache-stats/
+    Per-tier hit/miss counters and hit ratios for the cache backends of the
+    process serving the request. Admin/Owner only.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request):
+        if not IsAdmin().has_permission(request, self):
+            return Response({"detail": "Only Admins can view cache statistics."}, status=status.HTTP_403_FORBIDDEN)
+
+        backends = {}
+        for alias in settings.CACHES:
+            backend = caches[alias]
+            entry = {"backend": f"{type(backend).__module__}.{type(backend).__name__}"}
+            if hasattr(backend, 'get_stats'):
+                entry["stats"] = backend.get_stats()
+            backends[alias] = entry
+
+        return Response({"pid": os.getpid(), "caches": backends})
+
+
+class AdminMQTTStatsView(views.APIView):
+    """
+    GET /api/admin/mqtt-stats/
+    Command publisher and coalescer counters of the process serving the
+    request. Admin/Owner only.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request):
+        if not IsAdmin().has_permission(request, self):
+            return Response({"detail": "Only Admins can view MQTT statistics."}, status=status.HTTP_403_FORBIDDEN)
+
+        from .command_coalescer import command_coalescer
+        from .mqtt_client import mqtt_client
+        return Response({
+            "pid": os.getpid(),
+            "publisher": mqtt_client.stats(),
+            "coalescer": command_coalescer.stats(),
+        })
+
+
+class AdminCommandMetricsView(views.APIView):
+    """
+    GET /api/admin/command-metrics/
+    Publish -> confirm latency histogram and per-device failure rates of device
+    commands, as last reported by the MQTT listener. Admin/Owner only.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request):
+        if not IsAdmin().has_permission(request, self):
+            return Response({"detail": "Only Admins can view command metrics."}, status=status.HTTP_403_FORBIDDEN)
+
+        metrics = shared_state.read(COMMAND_METRICS_STATE, max_age=COMMAND_METRICS_MAX_AGE)
+        if metrics is None:
+            return Response(
+                {"detail": "No command metrics reported. Is the MQTT listener running?"},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE,
+            )
+
+        names = {
+            row['mac_address']: row
+            for row in Device.objects.filter(mac_address__in=list(metrics['devices'])).values('id', 'name', 'mac_address')
+        }
+        devices = [
+            {"mac_address": mac, "id": names.get(mac, {}).get('id'), "name": names.get(mac, {}).get('name'), **counts}
+            for mac, counts in metrics['devices'].items()
+        ]
+        devices.sort(key=lambda entry: (-(entry['failure_rate'] or 0), entry['mac_address']))
+        return Response({**metrics, "devices": devices})
+
+
 # =============================================================================
 # NOTIFICATION VIEWS
 # =============================================================================
 
-class NotificationListView(generics.ListAPIView):
+class NotificationListView(SparseFieldsViewMixin, generics.ListAPIView):
     """
     List notifications for the authenticated user.
     
@@ -1613,6 +1625,31 @@ class DashboardLayoutView(views.APIView):
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
+@method_decorator(gzip_page, name='dispatch')
+class DashboardBootstrapView(views.APIView):
+    """
+    Everything the dashboard needs for its first paint in one response.
+
+    GET - Returns profile, devices, rooms, device types (lite), dashboard layout,
+          device order and unread notification counts. Gzip-compressed when the
+          client accepts it. Sends an ETag; a matching If-None-Match gets 304.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request):
+        content, etag = render_with_etag(build_bootstrap(request))
+
+        # GZip turns the ETag into a weak one, so compare without the W/ prefix
+        client_etags = {tag.removeprefix('W/') for tag in parse_etags(request.headers.get('If-None-Match', ''))}
+        if etag in client_etags or '*' in client_etags:
+            response = HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = HttpResponse(content, content_type='application/json')
+        response['ETag'] = etag
+        response['Cache-Control'] = 'private, no-cache'
+        return response
+
+
 class AdminDashboardLayoutView(views.APIView):
     """
     Shared/default dashboard layout managed by admin/owner.
@@ -172,6 +172,38 @@ CACHES = {
     }
 }
 
+# CACHE_BACKEND=shared: one cache for all workers and the MQTT listener, stored in
+# an UNLOGGED PostgreSQL table (no Redis needed). Create it with:
+#   python manage.py setup_shared_cache
+# The default alias then puts a short-lived per-process LRU in front of it so hot
+# keys skip the database round trip; invalidations reach every process within
+# GENERATION_CHECK_INTERVAL seconds.
+if os.environ.get('CACHE_BACKEND', 'locmem') == 'shared':
+    CACHES['shared'] = {
+        'BACKEND': 'api.cache_backends.SharedDatabaseCache',
+        'LOCATION': 'homeforge_cache',
+        'TIMEOUT': 300,
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+            'SWEEP_INTERVAL': 60,  # seconds between expired-row sweeps
+        }
+    }
+    CACHES['default'] = {
+        'BACKEND': 'api.cache_backends.TwoTierCache',
+        'LOCATION': 'homeforge-two-tier',
+        'TIMEOUT': 300,
+        'OPTIONS': {
+            'SHARED_ALIAS': 'shared',
+            'LOCAL_TIMEOUT': 5,
+            'LOCAL_MAX_ENTRIES': 1000,
+            'GENERATION_CHECK_INTERVAL': 1,
+        }
+    }
+
+# Topology page: with ?lod=auto, above this many devices /api/topology/ collapses
+# each room into one aggregate node
+TOPOLOGY_LOD_THRESHOLD = int(os.environ.get('TOPOLOGY_LOD_THRESHOLD', 300))
+
 # Media files (user uploaded files like avatars)
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
@@ -188,5 +220,49 @@ CORS_ALLOW_CREDENTIALS = True
 # MQTT Broker config
 MQTT_BROKER_HOST = os.environ.get('MQTT_BROKER_HOST', None)
 
+# Device commands published while the broker is unreachable wait in a per-process
+# outbox of this many commands (oldest dropped first) and expire after MQTT_OUTBOX_TTL seconds
+MQTT_OUTBOX_SIZE = int(os.environ.get('MQTT_OUTBOX_SIZE', 1000))
+MQTT_OUTBOX_TTL = int(os.environ.get('MQTT_OUTBOX_TTL', 60))
+# QoS of published device commands (always 1 with MQTT_OFFLINE_DELIVERY = 'session')
+MQTT_COMMAND_QOS = int(os.environ.get('MQTT_COMMAND_QOS', 0))
+
+# Commands for offline devices: 'queue' stores them in the database for
+# COMMAND_QUEUE_TTL seconds and the listener delivers them merged when the device
+# reconnects; 'session' publishes them anyway (QoS 1) for firmware that keeps a
+# persistent MQTT session
+MQTT_OFFLINE_DELIVERY = os.environ.get('MQTT_OFFLINE_DELIVERY', 'queue')
+COMMAND_QUEUE_TTL = int(os.environ.get('COMMAND_QUEUE_TTL', 300))
+
+# The MQTT listener counts a command as failed when no state report confirms it
+# within COMMAND_ACK_TIMEOUT seconds; it tracks at most COMMAND_TRACKING_MAX_PENDING
+COMMAND_ACK_TIMEOUT = int(os.environ.get('COMMAND_ACK_TIMEOUT', 10))
+COMMAND_TRACKING_MAX_PENDING = 1000
+
+# Reconciliation: when a device reports a value other than the commanded one, the
+# listener resends it after RECONCILE_BASE_DELAY seconds, doubling the delay up to
+# RECONCILE_MAX_DELAY, and gives up after RECONCILE_MAX_ATTEMPTS resends
+RECONCILE_BASE_DELAY = 5
+RECONCILE_MAX_DELAY = 300
+RECONCILE_MAX_ATTEMPTS = int(os.environ.get('RECONCILE_MAX_ATTEMPTS', 5))
+# Desired keys a reporting device leaves out of its reports (buttons, sliders without
+# echo) for this many seconds are dropped from desired_state
+DESIRED_STATE_TTL = int(os.environ.get('DESIRED_STATE_TTL', 300))
+
+# Commands to a device within this many milliseconds of the previous publish are
+# merged into one (latest value per key wins), per widget type; others go out at once
+MQTT_COALESCE_WINDOWS = {
+    'SLIDER': 150,
+    'TOGGLE': 100,
+}
+
+# The MQTT listener checks for changed automation rules and schedules at most this often (seconds)
+RULES_RELOAD_INTERVAL = 2
+
+# Home location for sunrise/sunset schedules (decimal degrees, east/north positive).
+# Cron schedules run in TIME_ZONE.
+HOME_LATITUDE = float(os.environ.get('HOME_LATITUDE', 0))
+HOME_LONGITUDE = float(os.environ.get('HOME_LONGITUDE', 0))
+
 
 CORS_ALLOW_CREDENTIALS = True
\ No newline at end of file
@@ -16,6 +16,9 @@ else
     python manage.py migrate
 fi
 
+echo "🗄️  Preparing shared cache table (if configured)..."
+python manage.py setup_shared_cache
+
 # Ensure directories for services
 mkdir -p /run/dbus /var/run/dbus /run/avahi-daemon
 